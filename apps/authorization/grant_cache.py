@@ -0,0 +1,51 @@
+"""
+Cache of DataAccessGrant membership for DataAccessGrantPermission, keyed
+by (beneficiary, application).
+
+An entry records whether the pair has a grant and the grant's
+expiration_date, so expired grants are denied without a query. Entries
+live DATA_ACCESS_GRANT_CACHE_TTL seconds and are dropped when a grant is
+created, updated or deleted (archived), see apps.authorization.signals.
+
+Settings:
+    DATA_ACCESS_GRANT_CACHE_TTL = 300       # 0 disables the cache
+    DATA_ACCESS_GRANT_CACHE_ALIAS = "tiered"
+"""
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+from .models import DataAccessGrant
+
+KEY = "data_access_grant:{}:{}"
+
+
+def _cache():
+    return caches[getattr(settings, "DATA_ACCESS_GRANT_CACHE_ALIAS", "default")]
+
+
+def get_grant(beneficiary_id, application_id):
+    """
+    Returns (granted, expiration_date) of the pair.
+    """
+    ttl = getattr(settings, "DATA_ACCESS_GRANT_CACHE_TTL", 0)
+    key = KEY.format(beneficiary_id, application_id)
+    if ttl:
+        entry = _cache().get(key)
+        if entry is not None:
+            return entry
+    row = DataAccessGrant.objects.filter(
+        beneficiary_id=beneficiary_id,
+        application_id=application_id,
+    ).values_list("expiration_date").first()
+    entry = (True, row[0]) if row is not None else (False, None)
+    if ttl:
+        _cache().set(key, entry, ttl)
+    return entry
+
+
+def invalidate_grant(beneficiary_id, application_id):
+    key = KEY.format(beneficiary_id, application_id)
+    _cache().delete(key)
+    # Again once committed, a request may have cached the pair in between
+    transaction.on_commit(lambda: _cache().delete(key))
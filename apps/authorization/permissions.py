@@ -1,5 +1,6 @@
+from django.utils import timezone
 from rest_framework import (permissions, exceptions)
-from .models import DataAccessGrant
+from .grant_cache import get_grant
 
 
 class DataAccessGrantPermission(permissions.BasePermission):
@@ -7,10 +8,10 @@ class DataAccessGrantPermission(permissions.BasePermission):
     Permission check for a Grant related to the token used.
     """
     def has_permission(self, request, view):
-        return DataAccessGrant.objects.filter(
-            beneficiary=request.auth.user,
-            application=request.auth.application,
-        ).exists()
+        granted, expiration_date = get_grant(request.auth.user_id, request.auth.application_id)
+        if granted and expiration_date is not None and expiration_date <= timezone.now():
+            raise exceptions.PermissionDenied("The data access grant of this application has expired.")
+        return granted
 
     def has_object_permission(self, request, view, obj):
         # Now check that the user has permission to access the data
@@ -2,7 +2,11 @@ from apps.dot_ext.signals import beneficiary_authorized_application
 from oauth2_provider.models import get_access_token_model, get_refresh_token_model
 from django.db.models.signals import (
     post_delete,
+    post_save,
 )
+from apps.fhir.bluebutton.cache import response_cache
+from apps.fhir.bluebutton.export import cancel_jobs
+from .grant_cache import invalidate_grant
 from .models import DataAccessGrant, ArchivedDataAccessGrant
 
 AccessToken = get_access_token_model()
@@ -41,5 +45,26 @@ def archive_removed_grant(sender, instance=None, **kwargs):
         beneficiary=instance.beneficiary)
 
 
+def invalidate_cached_responses(sender, instance=None, **kwargs):
+    # Drop the beneficiary's cached FHIR responses on grant or token revocation
+    user = getattr(instance, 'beneficiary', None) or getattr(instance, 'user', None)
+    crosswalk = getattr(user, 'crosswalk', None) if user is not None else None
+    if crosswalk is not None and crosswalk.fhir_id:
+        response_cache.invalidate(crosswalk.fhir_id)
+
+
+def cancel_export_jobs(sender, instance=None, **kwargs):
+    cancel_jobs(instance.application_id, instance.beneficiary_id)
+
+
+def invalidate_cached_grant(sender, instance=None, **kwargs):
+    invalidate_grant(instance.beneficiary_id, instance.application_id)
+
+
+post_save.connect(invalidate_cached_grant, sender='authorization.DataAccessGrant')
+post_delete.connect(invalidate_cached_grant, sender='authorization.DataAccessGrant')
 post_delete.connect(revoke_associated_tokens, sender='authorization.DataAccessGrant')
 post_delete.connect(archive_removed_grant, sender='authorization.DataAccessGrant')
+post_delete.connect(invalidate_cached_responses, sender='authorization.DataAccessGrant')
+post_delete.connect(invalidate_cached_responses, sender=AccessToken)
+post_delete.connect(cancel_export_jobs, sender='authorization.DataAccessGrant')
@@ -1,4 +1,5 @@
 import pytz
+from django.core.cache import cache
 from django.db import transaction
 from django.db.utils import IntegrityError
 from django.http import HttpRequest
@@ -10,8 +11,12 @@ from oauth2_provider.models import (
     get_application_model,
     get_access_token_model,
 )
+from django.test import override_settings
 from django.urls import reverse
+from rest_framework.exceptions import PermissionDenied
 from apps.test import BaseApiTest
+from apps.authorization.grant_cache import get_grant
+from apps.authorization.permissions import DataAccessGrantPermission
 from apps.authorization.models import (
     DataAccessGrant,
     ArchivedDataAccessGrant,
@@ -312,3 +317,44 @@ class TestDataAccessGrant(BaseApiTest):
         # set back app and user to active - not to affect other tests
         application.active = True
         application.save()
+
+
+@override_settings(DATA_ACCESS_GRANT_CACHE_TTL=300)
+class TestDataAccessGrantPermission(BaseApiTest):
+    def setUp(self):
+        cache.clear()
+        self.bene_user = self._create_user("test_beneficiary", "123456")
+        self.test_app = self._create_application("test_app", user=self._create_user("developer_test", "123456"))
+        self.request = HttpRequest()
+        self.request.auth = AccessToken(user=self.bene_user, application=self.test_app)
+
+    def _has_permission(self):
+        return DataAccessGrantPermission().has_permission(self.request, None)
+
+    def test_cached_grant(self):
+        self.assertFalse(self._has_permission())
+
+        # Creating the grant drops the cached miss
+        grant = DataAccessGrant.objects.create(application=self.test_app, beneficiary=self.bene_user)
+        self.assertTrue(self._has_permission())
+        with self.assertNumQueries(0):
+            self.assertTrue(self._has_permission())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            grant.delete()
+        self.assertFalse(self._has_permission())
+
+    def test_expired_grant(self):
+        grant = DataAccessGrant.objects.create(application=self.test_app, beneficiary=self.bene_user,
+                                               expiration_date=timezone.now() + timedelta(hours=1))
+        self.assertTrue(self._has_permission())
+        self.assertEqual(get_grant(self.bene_user.id, self.test_app.id), (True, grant.expiration_date))
+
+        grant.expiration_date = timezone.now() - timedelta(hours=1)
+        grant.save()
+        with self.assertRaises(PermissionDenied):
+            self._has_permission()
+        # Denied from the cache
+        with self.assertNumQueries(0):
+            with self.assertRaises(PermissionDenied):
+                self._has_permission()
@@ -6,6 +6,9 @@ from django.contrib.auth.models import Group
 # from django.utils.lru_cache import lru_cache
 from functools import lru_cache
 from django.db.models import CASCADE
+from django.db.models.signals import post_delete, post_save
+
+from .scope_routes import scope_route_table
 
 
 class ProtectedCapability(models.Model):
@@ -108,3 +111,11 @@ def _match(request_path, allowed_path):
             return False
 
     return True
+
+
+def invalidate_scope_route_table(sender, instance=None, **kwargs):
+    scope_route_table.invalidate()
+
+
+post_save.connect(invalidate_scope_route_table, sender=ProtectedCapability)
+post_delete.connect(invalidate_scope_route_table, sender=ProtectedCapability)
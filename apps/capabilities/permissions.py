@@ -1,11 +1,8 @@
-import json
-import re
-
 from rest_framework import permissions, status
 from rest_framework.exceptions import APIException, ParseError
 from waffle import switch_is_active
 
-from .models import ProtectedCapability
+from .scope_routes import scope_route_table
 
 
 class BBCapabilitiesPermissionTokenScopeMissingException(APIException):
@@ -32,20 +29,17 @@ class TokenHasProtectedCapability(permissions.BasePermission):
             return True
 
         if hasattr(token, "scope"):  # OAuth 2
-            scopes = list(ProtectedCapability.objects.filter(
-                slug__in=token.scope.split()
-            ).values_list('protected_resources', flat=True).all())
-            for scope in scopes:
-                for method, path in json.loads(scope):
-                    if method != request.method:
-                        continue
-                    if path == request.path:
-                        return True
-                    if re.fullmatch(path, request.path) is not None:
-                        return True
-            return False
+            scopes = token.scope.split()
+            return all(scope_route_table.allows(scopes, method, path)
+                       for method, path in self.required_capabilities(request, view))
         else:
             # BB2-237: Replaces ASSERT with exception. We should never reach here.
             mesg = ("TokenHasScope requires the `oauth2_provider.rest_framework.OAuth2Authentication`"
                     " authentication class to be used.")
             raise BBCapabilitiesPermissionTokenScopeMissingException(mesg)
+
+    def required_capabilities(self, request, view):
+        """
+        The (method, path) pairs the token scopes must all allow.
+        """
+        return [(request.method, request.path)]
@@ -0,0 +1,93 @@
+"""
+In-process table of the routes allowed by each scope, read by
+TokenHasProtectedCapability instead of querying ProtectedCapability and
+parsing its protected_resources on every request.
+
+The table maps a scope slug to {method: (exact paths, compiled patterns)}.
+It is rebuilt after a ProtectedCapability is saved or deleted: the worker
+saving it drops its table right away, and the others notice the version
+stamp bumped in the cache within SCOPE_ROUTE_TABLE_CHECK_INTERVAL seconds.
+
+Settings:
+    SCOPE_ROUTE_TABLE = True              # False builds the table per request
+    SCOPE_ROUTE_TABLE_CHECK_INTERVAL = 5
+"""
+import json
+import re
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+VERSION_KEY = "capabilities:scope_route_table_version"
+
+
+def compile_scope_routes(capabilities):
+    """
+    Returns the table of an iterable of (slug, protected_resources).
+    """
+    table = {}
+    for slug, protected_resources in capabilities:
+        routes = table.setdefault(slug, {})
+        for method, path in json.loads(protected_resources):
+            exact, patterns = routes.setdefault(method, (set(), []))
+            exact.add(path)
+            try:
+                patterns.append(re.compile(path))
+            except re.error:
+                # Only matched as is
+                pass
+    return table
+
+
+class ScopeRouteTable(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._table = None
+        self._version = None
+        self._checked_at = 0
+
+    def build(self):
+        from .models import ProtectedCapability
+        return compile_scope_routes(ProtectedCapability.objects.values_list("slug", "protected_resources"))
+
+    def table(self):
+        if not getattr(settings, "SCOPE_ROUTE_TABLE", False):
+            return self.build()
+        now = time.monotonic()
+        with self._lock:
+            if self._table is not None and now - self._checked_at < settings.SCOPE_ROUTE_TABLE_CHECK_INTERVAL:
+                return self._table
+            version = cache.get(VERSION_KEY)
+            if self._table is None or version != self._version:
+                self._table = self.build()
+                self._version = version
+            self._checked_at = now
+            return self._table
+
+    def allows(self, scopes, method, path):
+        """
+        True when one of scopes allows method on path.
+        """
+        table = self.table()
+        for scope in scopes:
+            routes = table.get(scope, {}).get(method)
+            if routes is None:
+                continue
+            exact, patterns = routes
+            if path in exact or any(pattern.fullmatch(path) for pattern in patterns):
+                return True
+        return False
+
+    def invalidate(self):
+        with self._lock:
+            self._table = None
+        # Other workers rebuild once the change is visible to them
+        transaction.on_commit(lambda: cache.set(VERSION_KEY, uuid.uuid4().hex, None))
+
+
+scope_route_table = ScopeRouteTable()
@@ -1,12 +1,14 @@
 import json
 
 from django.contrib.auth.models import Group
-from django.test import TestCase
+from django.core.cache import cache
+from django.test import TestCase, override_settings
 from waffle.testutils import override_switch
 
 from apps.capabilities.permissions import BBCapabilitiesPermissionTokenScopeMissingException
 from .models import ProtectedCapability
 from .permissions import TokenHasProtectedCapability
+from .scope_routes import ScopeRouteTable, scope_route_table
 
 
 class SimpleToken(object):
@@ -126,3 +128,43 @@ class TestTokenHasProtectedCapabilityScopesSwitchFalse(TestCase):
         perm = TokenHasProtectedCapability()
         # Note that this is allowed with the scopes switch False/Off
         self.assertTrue(perm.has_permission(request, None))
+
+
+@override_settings(SCOPE_ROUTE_TABLE=True, SCOPE_ROUTE_TABLE_CHECK_INTERVAL=60)
+class TestScopeRouteTable(TestCase):
+    def setUp(self):
+        cache.clear()
+        scope_route_table.invalidate()
+        self.capability = ProtectedCapability.objects.create(
+            title="test capability",
+            slug="scope",
+            group=Group.objects.create(name="test"),
+            protected_resources=json.dumps([["GET", "/path"], ["GET", r"/patient/\d+"]]),
+        )
+
+    def test_allows(self):
+        self.assertTrue(scope_route_table.allows(["scope"], "GET", "/path"))
+        with self.assertNumQueries(0):
+            self.assertTrue(scope_route_table.allows(["other", "scope"], "GET", "/patient/123"))
+            self.assertFalse(scope_route_table.allows(["scope"], "GET", "/patient/abc"))
+            self.assertFalse(scope_route_table.allows(["scope"], "POST", "/path"))
+            self.assertFalse(scope_route_table.allows(["other"], "GET", "/path"))
+
+    def test_rebuilt_on_change(self):
+        other_worker = ScopeRouteTable()
+        self.assertFalse(other_worker.allows(["scope"], "POST", "/path"))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.capability.protected_resources = json.dumps([["POST", "/path"]])
+            self.capability.save()
+        self.assertTrue(scope_route_table.allows(["scope"], "POST", "/path"))
+
+        # Other workers check the version stamp every SCOPE_ROUTE_TABLE_CHECK_INTERVAL
+        self.assertFalse(other_worker.allows(["scope"], "POST", "/path"))
+        with override_settings(SCOPE_ROUTE_TABLE_CHECK_INTERVAL=0):
+            self.assertTrue(other_worker.allows(["scope"], "POST", "/path"))
+            self.assertFalse(other_worker.allows(["scope"], "GET", "/path"))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.capability.delete()
+        self.assertFalse(scope_route_table.allows(["scope"], "POST", "/path"))
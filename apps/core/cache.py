@@ -0,0 +1,320 @@
+"""
+Two-tier cache backend: a bounded in-process LRU with a TTL in front of a
+shared cache (the database cache by default), for small lookups read far
+more often than they change, e.g. waffle switches, validated bearer tokens
+with their application and data access grants.
+
+Reads are served from the process when they can, otherwise from the shared
+cache and kept in the process. Writes and deletes go to the shared cache and
+bump the version stamp of the key's prefix (the part of the key before the
+first ":") with a log of the changed keys. Workers check the stamp of a
+prefix at most every VERSION_CHECK_INTERVAL seconds when reading it and drop
+the logged keys, or all the keys of the prefix when the log does not cover
+what they missed. A change is seen right away by the worker making it and
+within that interval by the others, LOCAL_TIMEOUT bounds it in any case.
+
+Local hits, shared hits and misses are counted per prefix and process, see
+TieredCache.stats() and the metrics "caches" view, and in the cache_reads
+metric over the workers.
+
+    CACHES["tiered"] = {
+        "BACKEND": "apps.core.cache.TieredCache",
+        "LOCATION": "default",          # alias of the shared cache
+        "OPTIONS": {
+            "MAX_ENTRIES": 10000,       # kept in process
+            "LOCAL_TIMEOUT": 60,        # seconds kept in process
+            "VERSION_CHECK_INTERVAL": 2,
+            "INVALIDATION_LOG_SIZE": 1000,
+        },
+    }
+
+incr() and decr() go to the shared cache and bump the stamp each time,
+counters such as the throttle ones belong in a cache of their own, e.g. an
+AtomicDatabaseCache.
+"""
+import base64
+import pickle
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+from django.core.cache.backends.db import DatabaseCache
+from django.db import connections, models, router, transaction
+from django.utils import timezone
+
+from apps.metrics.instruments import cache_reads
+
+MISSING = object()
+
+# Stat -> result label of the cache_reads metric
+READ_RESULTS = {"hits": "hit", "shared_hits": "shared_hit", "misses": "miss"}
+
+# In-process tiers by (shared alias, key prefix, version): django keeps
+# a backend instance per thread, the threads of a worker share its tier
+_tiers = {}
+_tiers_lock = threading.Lock()
+
+
+def key_prefix(key):
+    return str(key).split(":", 1)[0]
+
+
+def bump_stamp(cache, key):
+    """
+    Increments the version stamp key of cache, an absent stamp counts as 0.
+    Concurrent bumps are not lost with a shared cache of atomic incr.
+    """
+    try:
+        return cache.incr(key)
+    except ValueError:
+        if cache.add(key, 1, timeout=None):
+            return 1
+        # Started by another process in between
+        return cache.incr(key)
+
+
+class LocalTier(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # key -> (expires, prefix, pickled value), least recently used first
+        self.entries = OrderedDict()
+        # prefix -> (version, checked at)
+        self.versions = {}
+        self.stats = defaultdict(lambda: {"hits": 0, "shared_hits": 0, "misses": 0})
+
+    def drop_prefix(self, prefix):
+        for key in [key for key, entry in self.entries.items() if entry[1] == prefix]:
+            del self.entries[key]
+
+
+class TieredCache(BaseCache):
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = params.get("OPTIONS", {})
+        self._shared_alias = location or "default"
+        self._local_timeout = options.get("LOCAL_TIMEOUT", 60)
+        self._check_interval = options.get("VERSION_CHECK_INTERVAL", 2)
+        self._log_size = options.get("INVALIDATION_LOG_SIZE", 1000)
+        with _tiers_lock:
+            self._tier = _tiers.setdefault((self._shared_alias, self.key_prefix, self.version), LocalTier())
+
+    @property
+    def shared(self):
+        return caches[self._shared_alias]
+
+    def _version_key(self, prefix):
+        return "tiered:%s:version" % prefix
+
+    def _log_key(self, prefix, version):
+        return "tiered:%s:log:%s" % (prefix, version)
+
+    def _sync(self, prefix):
+        """
+        Drops the local keys of prefix changed by other workers.
+        """
+        tier = self._tier
+        now = time.monotonic()
+        known = tier.versions.get(prefix)
+        if known is not None and now - known[1] < self._check_interval:
+            return
+        version = self.shared.get(self._version_key(prefix), 0)
+        changed = None
+        if known is not None and known[0] < version <= known[0] + self._log_size:
+            numbers = range(known[0] + 1, version + 1)
+            logged = self.shared.get_many([self._log_key(prefix, n) for n in numbers])
+            if len(logged) == len(numbers):
+                changed = set(logged.values())
+        with tier.lock:
+            if known is not None and version != known[0]:
+                if changed is None:
+                    tier.drop_prefix(prefix)
+                else:
+                    for key in changed:
+                        tier.entries.pop(key, None)
+            tier.versions[prefix] = (version, now)
+
+    def _invalidate(self, key, prefix):
+        """
+        Drops key here and logs it for the other workers.
+        """
+        with self._tier.lock:
+            self._tier.entries.pop(key, None)
+        shared = self.shared
+        version_key = self._version_key(prefix)
+        # The log entries outlive any local copy of their key
+        log_timeout = self._local_timeout + self._check_interval
+        for attempt in range(5):
+            try:
+                version = shared.incr(version_key)
+            except ValueError:
+                shared.add(version_key, 0, None)
+                version = shared.incr(version_key)
+            # add() so a shared cache without an atomic incr cannot lose a change
+            if shared.add(self._log_key(prefix, version), key, log_timeout):
+                return
+
+    def _get_local(self, key):
+        tier = self._tier
+        with tier.lock:
+            entry = tier.entries.get(key)
+            if entry is None:
+                return MISSING
+            if entry[0] <= time.monotonic():
+                del tier.entries[key]
+                return MISSING
+            tier.entries.move_to_end(key)
+        return pickle.loads(entry[2])
+
+    def _set_local(self, key, prefix, value, timeout=DEFAULT_TIMEOUT):
+        if timeout is DEFAULT_TIMEOUT or timeout is None:
+            timeout = self._local_timeout
+        else:
+            timeout = min(timeout, self._local_timeout)
+        tier = self._tier
+        with tier.lock:
+            if timeout <= 0:
+                tier.entries.pop(key, None)
+                return
+            # Pickled like the locmem cache, callers get their own copy
+            tier.entries[key] = (time.monotonic() + timeout, prefix, pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+            tier.entries.move_to_end(key)
+            while len(tier.entries) > self._max_entries:
+                tier.entries.popitem(last=False)
+
+    def _count(self, prefix, stat):
+        with self._tier.lock:
+            self._tier.stats[prefix][stat] += 1
+        cache_reads.labels(self._shared_alias, prefix, READ_RESULTS[stat]).inc()
+
+    def _make_key(self, key, version=None):
+        local_key = self.make_key(key, version=version)
+        self.validate_key(local_key)
+        return local_key
+
+    def get(self, key, default=None, version=None):
+        local_key = self._make_key(key, version)
+        prefix = key_prefix(key)
+        self._sync(prefix)
+        value = self._get_local(local_key)
+        if value is not MISSING:
+            self._count(prefix, "hits")
+            return value
+        value = self.shared.get(key, MISSING, version=version)
+        if value is MISSING:
+            self._count(prefix, "misses")
+            return default
+        self._count(prefix, "shared_hits")
+        self._set_local(local_key, prefix, value)
+        return value
+
+    def get_many(self, keys, version=None):
+        found = {}
+        for key in keys:
+            value = self.get(key, MISSING, version=version)
+            if value is not MISSING:
+                found[key] = value
+        return found
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        local_key = self._make_key(key, version)
+        prefix = key_prefix(key)
+        self.shared.set(key, value, timeout, version=version)
+        self._invalidate(local_key, prefix)
+        self._set_local(local_key, prefix, value, timeout)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        local_key = self._make_key(key, version)
+        prefix = key_prefix(key)
+        if not self.shared.add(key, value, timeout, version=version):
+            return False
+        self._invalidate(local_key, prefix)
+        self._set_local(local_key, prefix, value, timeout)
+        return True
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        for key, value in data.items():
+            self.set(key, value, timeout, version=version)
+        return []
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        return self.shared.touch(key, timeout, version=version)
+
+    def delete(self, key, version=None):
+        local_key = self._make_key(key, version)
+        deleted = self.shared.delete(key, version=version)
+        self._invalidate(local_key, key_prefix(key))
+        return deleted
+
+    def delete_many(self, keys, version=None):
+        for key in keys:
+            self.delete(key, version=version)
+
+    def has_key(self, key, version=None):
+        return self.get(key, MISSING, version=version) is not MISSING
+
+    def incr(self, key, delta=1, version=None):
+        value = self.shared.incr(key, delta, version=version)
+        self._invalidate(self._make_key(key, version), key_prefix(key))
+        return value
+
+    def clear(self):
+        self.shared.clear()
+        with self._tier.lock:
+            self._tier.entries.clear()
+            self._tier.versions.clear()
+
+    def stats(self):
+        """
+        Returns {prefix: {hits, shared_hits, misses, hit_rate, local_hit_rate}}
+        of this process, hit_rate counting the hits of both tiers.
+        """
+        with self._tier.lock:
+            counts = {prefix: dict(stats) for prefix, stats in self._tier.stats.items()}
+        for stats in counts.values():
+            reads = stats["hits"] + stats["shared_hits"] + stats["misses"]
+            stats["hit_rate"] = round((stats["hits"] + stats["shared_hits"]) / reads, 4) if reads else None
+            stats["local_hit_rate"] = round(stats["hits"] / reads, 4) if reads else None
+        return counts
+
+
+class AtomicDatabaseCache(DatabaseCache):
+    """
+    Database cache with an atomic incr(): the row of the key is locked while
+    it is incremented and keeps its expiry, where the base class reads and
+    sets the value again, losing concurrent increments and the timeout.
+    """
+
+    def incr(self, key, delta=1, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        db = router.db_for_write(self.cache_model_class)
+        connection = connections[db]
+        quote_name = connection.ops.quote_name
+        table = quote_name(self._table)
+        with transaction.atomic(using=db), connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT %s, %s FROM %s WHERE %s = %%s%s" % (
+                    quote_name("value"), quote_name("expires"), table, quote_name("cache_key"),
+                    " FOR UPDATE" if connection.features.has_select_for_update else "",
+                ),
+                [key],
+            )
+            row = cursor.fetchone()
+            if row is None or self._expires(connection, row[1]) < timezone.now():
+                raise ValueError("Key '%s' not found" % key)
+            value = pickle.loads(base64.b64decode(connection.ops.process_clob(row[0]).encode())) + delta
+            cursor.execute(
+                "UPDATE %s SET %s = %%s WHERE %s = %%s" % (table, quote_name("value"), quote_name("cache_key")),
+                [base64.b64encode(pickle.dumps(value, self.pickle_protocol)).decode("latin1"), key],
+            )
+        return value
+
+    def _expires(self, connection, expires):
+        expression = models.Expression(output_field=models.DateTimeField())
+        for converter in connection.ops.get_db_converters(expression) + expression.get_db_converters(connection):
+            expires = converter(expires, expression, connection)
+        return expires
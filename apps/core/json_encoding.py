@@ -0,0 +1,54 @@
+"""
+Encoding of the API responses and audit log records with orjson, when it is
+installed and FAST_JSON_ENCODER is on, the standard library json otherwise.
+
+Both give the same JSON values. orjson hands the types it does not encode
+itself, and dates and times, to the default() of the encoder class, so they
+are formatted as the standard library would, and objects it cannot encode
+(integers over 64 bits, keys that are not strings, ...) are left to the
+standard library. The text may only differ in insignificant whitespace, the
+escaping of non-ASCII characters and the notation of floats, except for NaN
+and infinities which orjson encodes as null.
+
+See the benchmark_json command for the gain on EOB bundles and log records.
+"""
+import json
+
+from django.conf import settings
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+def fast_encoder_enabled():
+    return orjson is not None and getattr(settings, "FAST_JSON_ENCODER", False)
+
+
+def orjson_dumps(obj, cls=None, pretty=False):
+    """
+    Returns obj encoded by orjson (bytes), or None when the fast encoder is
+    not enabled or cannot encode obj.
+    """
+    if not fast_encoder_enabled():
+        return None
+    option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+    if pretty:
+        option |= orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS
+    try:
+        return orjson.dumps(obj, default=(cls or json.JSONEncoder)().default, option=option)
+    except orjson.JSONEncodeError:
+        return None
+
+
+def dumps(obj, cls=None, pretty=False):
+    """
+    json.dumps(obj, cls=cls) or, pretty, with sorted keys and an indent of 2.
+    """
+    encoded = orjson_dumps(obj, cls=cls, pretty=pretty)
+    if encoded is not None:
+        return encoded.decode("utf-8")
+    if pretty:
+        return json.dumps(obj, cls=cls, sort_keys=True, indent=2)
+    return json.dumps(obj, cls=cls)
@@ -0,0 +1,88 @@
+import datetime
+import json
+import os
+import timeit
+import uuid
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+
+from apps.core.json_encoding import dumps, orjson
+from apps.fhir.renderers import JSONRenderer
+
+FHIR_RESOURCES_DIR = os.path.join(
+    os.path.dirname(__file__), "..", "..", "..", "fhir", "bluebutton", "tests", "fhir_resources"
+)
+
+FHIR_RESOURCES = (
+    "eob_search_v2.json",
+    "eob_read_out_pt_v2.json",
+    "patient_read_v2.json",
+)
+
+
+def request_response_log():
+    # Shaped as a request_response_middleware record
+    log = {
+        "type": "request_response_middleware",
+        "request_uuid": str(uuid.uuid1()),
+        "start_time": 1668000000.123456,
+        "end_time": 1668000000.223456,
+        "elapsed": 0.1,
+        "path": "/v2/fhir/ExplanationOfBenefit/",
+        "request_method": "GET",
+        "response_code": 200,
+        "size": 276577,
+        "access_token_hash": "0" * 64,
+        "access_token_scopes": "patient/Patient.read patient/Coverage.read patient/ExplanationOfBenefit.read",
+        "app_id": 42,
+        "app_name": "Benchmark App",
+        "dev_id": 7,
+        "dev_name": "developer",
+        "fhir_id": "-20140000008325",
+        "user": "00112233-4455-6677-8899-aabbccddeeff",
+        "created": datetime.datetime(2022, 11, 9, 12, 0, 0, 123456, tzinfo=datetime.timezone.utc),
+    }
+    log.update({"req_qparam_%s" % n: "value %s" % n for n in range(60)})
+    return log
+
+
+class Command(BaseCommand):
+    help = "Compare the JSON encoding of FHIR responses and audit log records with and without orjson"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--number", type=int, default=200, help="Encodings timed per case")
+
+    def handle(self, *args, **options):
+        if orjson is None:
+            self._log("orjson is not installed, only the standard library is timed")
+        renderer = JSONRenderer()
+        cases = []
+        for name in FHIR_RESOURCES:
+            with open(os.path.join(FHIR_RESOURCES_DIR, name)) as f:
+                data = json.load(f)
+            cases.append((name, lambda data=data: renderer.render(data)))
+        log = request_response_log()
+        cases.append(("audit log record", lambda: dumps(log, cls=DjangoJSONEncoder)))
+
+        self._log("%-26s %14s %14s %8s" % ("case", "stdlib us/op", "orjson us/op", "speedup"))
+        for name, encode in cases:
+            with override_settings(FAST_JSON_ENCODER=False):
+                stdlib = self._time(encode, options["number"])
+            fast = None
+            if orjson is not None:
+                with override_settings(FAST_JSON_ENCODER=True):
+                    fast = self._time(encode, options["number"])
+            self._log("%-26s %14.1f %14s %8s" % (
+                name, stdlib,
+                "%.1f" % fast if fast is not None else "-",
+                "%.1fx" % (stdlib / fast) if fast else "-",
+            ))
+
+    def _time(self, encode, number):
+        encode()
+        return min(timeit.repeat(encode, number=number, repeat=3)) / number * 1e6
+
+    def _log(self, message):
+        self.stdout.write(message)
@@ -14,6 +14,8 @@ WAFFLE_FEATURE_SWITCHES = (
     ("show_testclient_link", True),
     ("interim-prod-access", True),
     ("enable_swaggerui", True),
+    ("fhir_bulk_export", True),
+    ("server_timing", True),
 )
 
 
@@ -0,0 +1,156 @@
+import datetime
+import decimal
+import json
+import os
+import uuid
+from unittest import skipIf
+from unittest.mock import patch
+
+from django.core.cache import caches
+from django.core.serializers.json import DjangoJSONEncoder
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from rest_framework import renderers
+
+from apps.core.cache import AtomicDatabaseCache, LocalTier, TieredCache
+from apps.core.json_encoding import dumps, orjson
+from apps.fhir.renderers import JSONRenderer
+
+
+def worker(**options):
+    # A backend with a tier of its own, as in another worker process
+    tiered = TieredCache("default", {"OPTIONS": {"MAX_ENTRIES": 3, "VERSION_CHECK_INTERVAL": 0, **options}})
+    tiered._tier = LocalTier()
+    return tiered
+
+
+class TestTieredCache(SimpleTestCase):
+
+    def setUp(self):
+        caches["default"].clear()
+        self.shared = caches["default"]
+        self.first = worker()
+        self.second = worker()
+
+    def test_read_through(self):
+        self.shared.set("app:1", "one")
+        self.assertEqual(self.first.get("app:1"), "one")
+        self.shared.set("app:1", "changed behind the tier")
+        self.assertEqual(self.first.get("app:1"), "one")
+        self.assertIsNone(self.first.get("app:2"))
+        self.assertEqual(self.first.stats()["app"], {
+            "hits": 1, "shared_hits": 1, "misses": 1, "hit_rate": 0.6667, "local_hit_rate": 0.3333,
+        })
+
+    def test_workers_converge(self):
+        self.first.set("app:1", "one")
+        self.first.set("app:2", "two")
+        self.assertEqual(self.second.get("app:1"), "one")
+        self.assertEqual(self.second.get("app:2"), "two")
+
+        self.first.set("app:1", "changed")
+        self.assertEqual(self.second.get("app:1"), "changed")
+        # Only the logged key is dropped
+        self.assertEqual(self.second._tier.stats["app"]["hits"], 0)
+        self.second.get("app:2")
+        self.assertEqual(self.second._tier.stats["app"]["hits"], 1)
+
+        self.first.delete("app:2")
+        self.assertIsNone(self.second.get("app:2"))
+
+    def test_version_check_interval(self):
+        second = worker(VERSION_CHECK_INTERVAL=60)
+        self.first.set("app:1", "one")
+        self.assertEqual(second.get("app:1"), "one")
+        self.first.set("app:1", "changed")
+        self.assertEqual(second.get("app:1"), "one")
+
+    def test_log_not_covering_changes(self):
+        self.first.set("app:1", "one")
+        self.assertEqual(self.second.get("app:1"), "one")
+        self.shared.set("app:1", "changed")
+        self.first.set("app:2", "two")
+        self.shared.delete("tiered:app:log:2")
+        # The whole prefix is dropped
+        self.assertEqual(self.second.get("app:1"), "changed")
+
+    def test_lru(self):
+        for n in range(4):
+            self.first.set("app:%s" % n, n)
+        self.first.get("app:1")
+        self.first.set("app:4", 4)
+        self.assertEqual(
+            [key.split(":", 2)[-1] for key in self.first._tier.entries],
+            ["app:3", "app:1", "app:4"],
+        )
+
+    def test_local_copies(self):
+        self.first.set("app:1", {"name": "one"})
+        self.first.get("app:1")["name"] = "changed"
+        self.assertEqual(self.first.get("app:1"), {"name": "one"})
+
+    def test_incr(self):
+        self.first.set("count:1", 1)
+        self.assertEqual(self.second.get("count:1"), 1)
+        self.assertEqual(self.first.incr("count:1"), 2)
+        self.assertEqual(self.second.get("count:1"), 2)
+
+
+class TestAtomicDatabaseCache(TestCase):
+
+    def setUp(self):
+        self.cache = AtomicDatabaseCache("django_throttle_cache", {})
+
+    def test_incr(self):
+        self.cache.add("count", 0, 60)
+        self.assertEqual(self.cache.incr("count"), 1)
+        self.assertEqual(self.cache.incr("count", 2), 3)
+        self.assertEqual(self.cache.decr("count"), 2)
+        self.assertEqual(self.cache.get("count"), 2)
+        with self.assertRaises(ValueError):
+            self.cache.incr("missing")
+
+    def test_incr_keeps_expiry(self):
+        self.cache.add("count", 0, 60)
+        self.cache.incr("count")
+        later = timezone.now() + datetime.timedelta(seconds=61)
+        with patch("apps.core.cache.timezone.now", return_value=later), \
+                patch("django.core.cache.backends.db.timezone.now", return_value=later):
+            self.assertIsNone(self.cache.get("count"))
+            with self.assertRaises(ValueError):
+                self.cache.incr("count")
+
+
+@skipIf(orjson is None, "orjson is not installed")
+@override_settings(FAST_JSON_ENCODER=True)
+class TestJSONEncoding(SimpleTestCase):
+
+    def test_same_values(self):
+        log = {
+            "created": datetime.datetime(2022, 11, 9, 12, 0, 0, 123456, tzinfo=datetime.timezone.utc),
+            "amount": decimal.Decimal("1.10"),
+            "request_uuid": uuid.UUID("00112233-4455-6677-8899-aabbccddeeff"),
+            "name": "caf\u00e9",
+            "count": 3,
+        }
+        with override_settings(FAST_JSON_ENCODER=False):
+            expected = dumps(log, cls=DjangoJSONEncoder)
+        self.assertEqual(json.loads(dumps(log, cls=DjangoJSONEncoder)), json.loads(expected))
+        self.assertEqual(json.loads(expected)["created"], "2022-11-09T12:00:00.123Z")
+
+        with override_settings(FAST_JSON_ENCODER=False):
+            expected = dumps(log, cls=DjangoJSONEncoder, pretty=True)
+        self.assertEqual(dumps(log, cls=DjangoJSONEncoder, pretty=True), expected.replace("\\u00e9", "\u00e9"))
+
+    def test_fallback(self):
+        self.assertEqual(dumps({1: 2 ** 70}), json.dumps({1: 2 ** 70}))
+        with self.assertRaises(TypeError):
+            dumps({"set": {1}})
+
+    def test_renderer(self):
+        path = os.path.join(os.path.dirname(__file__), "..", "fhir", "bluebutton", "tests", "fhir_resources",
+                            "eob_search_v2.json")
+        with open(path) as f:
+            data = json.load(f)
+        data["text"] = "line\u2028separator"
+        self.assertEqual(JSONRenderer().render(data), renderers.JSONRenderer().render(data))
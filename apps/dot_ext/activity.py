@@ -0,0 +1,202 @@
+"""
+Write-behind tracking of the Application first_active / last_active
+activity metric fields, set by every authenticated FHIR request.
+
+Instead of saving the application row on each call, the timestamps are
+buffered per worker process and written with one bulk UPDATE every
+APPLICATION_ACTIVITY_FLUSH_INTERVAL seconds (0 writes on every call).
+
+With APPLICATION_ACTIVITY_SHARED the workers flush their buffer to the
+cache instead, and the flush_application_activity management command
+writes the cached timestamps to the database (run from cron). Each worker
+flush adds an entry to the current generation of entries, in the first free
+slot. The command starts a new generation, then writes and deletes the
+entries it finds in the older ones. It keeps the slot it got to in each,
+so an entry a worker adds to a generation after it was read is written by
+the next run.
+
+A flush that fails puts the activity back in the buffer for the next one.
+
+The metrics in apps.metrics lag the API calls by at most the flush
+interval (plus the command schedule with APPLICATION_ACTIVITY_SHARED).
+
+Settings:
+    APPLICATION_ACTIVITY_FLUSH_INTERVAL = 60
+    APPLICATION_ACTIVITY_SHARED = False
+"""
+import atexit
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import DateTimeField, F, Value
+from django.db.models.functions import Coalesce, Greatest
+from oauth2_provider.models import get_application_model
+
+import apps.logging.request_logger as bb2logging
+
+logger = logging.getLogger(bb2logging.HHS_SERVER_LOGNAME_FMT.format(__name__))
+
+GENERATION_KEY = "application_activity:generation"
+# Oldest generation that may still get entries
+OLDEST_GENERATION_KEY = "application_activity:oldest"
+# {application id: (first_active, last_active)} flushed by a worker
+ENTRY_KEY = "application_activity:{}:entry:{}"
+# Highest slot taken in a generation, where the workers start looking
+SLOTS_KEY = "application_activity:{}:slots"
+# Slots of a generation written to the database
+READ_KEY = "application_activity:{}:read"
+
+ENTRIES_READ_AT_ONCE = 100
+
+
+def merge_activity(activity, first_active, last_active, pk):
+    """
+    Merges first_active/last_active of application pk into activity,
+    {application id: [first_active or None, last_active]}.
+    """
+    entry = activity.get(pk)
+    if entry is None:
+        activity[pk] = [first_active, last_active]
+        return
+    entry[1] = max(entry[1], last_active)
+    if first_active is not None and (entry[0] is None or first_active < entry[0]):
+        entry[0] = first_active
+
+
+def update_application_activity(activity):
+    """
+    Writes {application id: (first_active, last_active)} with one bulk UPDATE,
+    first_active is only set when empty and last_active never moves back.
+    Returns the number of applications updated.
+    """
+    if not activity:
+        return 0
+    Application = get_application_model()
+    applications = []
+    for pk, (first_active, last_active) in activity.items():
+        application = Application(pk=pk)
+        # bulk_update() only keeps expressions, a bare F() would be saved as a value
+        application.first_active = Coalesce(F("first_active"), Value(first_active, DateTimeField()))
+        last_active = Value(last_active, DateTimeField())
+        application.last_active = Coalesce(Greatest(F("last_active"), last_active), last_active)
+        applications.append(application)
+    Application.objects.bulk_update(applications, ["first_active", "last_active"])
+    return len(applications)
+
+
+class ApplicationActivityTracker(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # {application id: [first_active or None, last_active]}
+        self._activity = {}
+        self._flushed_at = time.monotonic()
+
+    def record(self, application, now):
+        """
+        Records an API call of application at now.
+        """
+        with self._lock:
+            entry = self._activity.get(application.pk)
+            if entry is None:
+                entry = self._activity[application.pk] = [None, now]
+            entry[1] = max(entry[1], now)
+            if application.first_active is None and entry[0] is None:
+                entry[0] = now
+            due = time.monotonic() - self._flushed_at >= settings.APPLICATION_ACTIVITY_FLUSH_INTERVAL
+        if due:
+            self.flush()
+
+    def _take(self):
+        with self._lock:
+            activity, self._activity = self._activity, {}
+            self._flushed_at = time.monotonic()
+        return {pk: tuple(entry) for pk, entry in activity.items()}
+
+    def flush(self):
+        """
+        Writes the buffered activity to the database, or to the cache with
+        APPLICATION_ACTIVITY_SHARED. Returns the number of applications.
+        """
+        activity = self._take()
+        if not activity:
+            return 0
+        try:
+            if getattr(settings, "APPLICATION_ACTIVITY_SHARED", False):
+                return self._flush_to_cache(activity)
+            return update_application_activity(activity)
+        except Exception:
+            logger.exception("Application activity flush failed for %s applications, kept for the next one"
+                             % len(activity))
+            self._put_back(activity)
+            return 0
+
+    def _put_back(self, activity):
+        with self._lock:
+            for pk, (first_active, last_active) in activity.items():
+                merge_activity(self._activity, first_active, last_active, pk)
+
+    def _flush_to_cache(self, activity):
+        generation = cache.get(GENERATION_KEY, 1)
+        slot = cache.get(SLOTS_KEY.format(generation), 0) + 1
+        # add() only succeeds for a free slot
+        while not cache.add(ENTRY_KEY.format(generation, slot), activity, timeout=None):
+            slot += 1
+        cache.set(SLOTS_KEY.format(generation), slot, timeout=None)
+        return len(activity)
+
+
+def flush_activity_generation(generation):
+    """
+    Writes the entries of generation not written yet to the database, then
+    deletes them. Returns the number of applications updated.
+    """
+    read = cache.get(READ_KEY.format(generation), 0)
+    activity = {}
+    keys = []
+    more = True
+    while more:
+        # Slots are taken in order, the first free one ends the entries
+        chunk = [ENTRY_KEY.format(generation, slot) for slot in range(read + 1, read + 1 + ENTRIES_READ_AT_ONCE)]
+        entries = cache.get_many(chunk)
+        for key in chunk:
+            more = key in entries
+            if not more:
+                break
+            keys.append(key)
+            read += 1
+            for pk, (first_active, last_active) in entries[key].items():
+                merge_activity(activity, first_active, last_active, pk)
+    if not keys:
+        return 0
+    count = update_application_activity({pk: tuple(entry) for pk, entry in activity.items()})
+    cache.set(READ_KEY.format(generation), read, timeout=None)
+    cache.delete_many(keys)
+    return count
+
+
+def flush_shared_application_activity():
+    """
+    Writes the activity flushed to the cache by the workers to the database.
+    Returns the number of applications updated.
+    """
+    generation = cache.get(GENERATION_KEY, 1)
+    # The workers flush to the next generation from now on
+    cache.set(GENERATION_KEY, generation + 1, timeout=None)
+    oldest = cache.get(OLDEST_GENERATION_KEY, generation)
+    count = 0
+    for closed in range(oldest, generation + 1):
+        count += flush_activity_generation(closed)
+    # Generations closed by an earlier run had a whole run to finish their
+    # flushes, the one just closed is read again by the next run
+    cache.delete_many([key.format(closed) for closed in range(oldest, generation)
+                       for key in (SLOTS_KEY, READ_KEY)])
+    cache.set(OLDEST_GENERATION_KEY, generation, timeout=None)
+    return count
+
+
+activity_tracker = ApplicationActivityTracker()
+atexit.register(activity_tracker.flush)
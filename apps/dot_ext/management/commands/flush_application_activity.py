@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from apps.dot_ext.activity import flush_shared_application_activity
+
+
+class Command(BaseCommand):
+    help = (
+        "Write the Application first_active/last_active activity buffered in the cache"
+        " by the workers (APPLICATION_ACTIVITY_SHARED) to the database, when called on a schedule."
+    )
+
+    def handle(self, *args, **options):
+        count = flush_shared_application_activity()
+        self.stdout.write("Application activity flushed for %s applications" % count)
@@ -0,0 +1,19 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("dot_ext", "0004_auto_20221117_2012"),
+    ]
+
+    # Rate limit counters of the "throttle" cache, see apps/dot_ext/throttling.py
+    operations = [
+        migrations.RunSQL("""CREATE TABLE "django_throttle_cache" (
+    "cache_key" varchar(255) NOT NULL PRIMARY KEY,
+    "value" text NOT NULL,
+    "expires" timestamp with time zone NOT NULL
+);
+CREATE INDEX "django_throttle_cache_expires" ON "django_throttle_cache" ("expires");
+""", reverse_sql='DROP TABLE "django_throttle_cache";'),
+    ]
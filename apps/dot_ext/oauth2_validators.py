@@ -1,8 +1,15 @@
+from oauth2_provider.models import AccessToken
 from oauth2_provider.oauth2_validators import OAuth2Validator as DotOAuth2Validator
 from django.core.exceptions import ObjectDoesNotExist
 from apps.pkce.oauth2_validators import PKCEValidatorMixin
 from oauthlib.oauth2.rfc6749.errors import InvalidGrantError
 
+from .token_cache import cache_token, get_cached_token
+
+# Rows of a bearer token read by the resource server (see
+# apps.fhir.bluebutton.authentication.AuthContext), loaded with the token
+BEARER_TOKEN_RELATED = ("application__user", "user__crosswalk")
+
 
 class OAuth2Validator(DotOAuth2Validator):
     def _extract_basic_auth(self, request):
@@ -27,6 +34,14 @@ class OAuth2Validator(DotOAuth2Validator):
 
         return auth_string
 
+    def _load_access_token(self, token):
+        access_token = get_cached_token(token)
+        if access_token is None:
+            access_token = AccessToken.objects.select_related(*BEARER_TOKEN_RELATED).filter(token=token).first()
+            if access_token is not None and not access_token.is_expired():
+                cache_token(access_token)
+        return access_token
+
 
 class SingleAccessTokenValidator(
         PKCEValidatorMixin,
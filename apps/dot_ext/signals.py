@@ -1,11 +1,12 @@
 import logging
 
 from django.dispatch import Signal
-from django.db.models.signals import post_save, pre_save
+from django.db.models.signals import post_delete, post_save, pre_save
 from oauth2_provider.models import get_application_model, get_access_token_model
 from libs.mail import Mailer
 from libs.decorators import waffle_function_switch
 from .models import ArchivedToken
+from .token_cache import invalidate_application_tokens, invalidate_tokens
 
 import apps.logging.request_logger as bb2logging
 
@@ -70,3 +71,18 @@ def outreach_first_api_call(sender, instance=None, **kwargs):
 
 post_save.connect(outreach_first_application, sender=Application)
 pre_save.connect(outreach_first_api_call, sender=Token)
+
+
+def invalidate_cached_token(sender, instance=None, **kwargs):
+    # Token saved, revoked, archived or removed with its grant
+    invalidate_tokens([instance.token])
+
+
+def invalidate_cached_application_tokens(sender, instance=None, **kwargs):
+    # Application saved, e.g. deactivated, its version stamp is bumped
+    invalidate_application_tokens(instance.pk)
+
+
+post_save.connect(invalidate_cached_token, sender=Token)
+post_delete.connect(invalidate_cached_token, sender=Token)
+post_save.connect(invalidate_cached_application_tokens, sender=Application)
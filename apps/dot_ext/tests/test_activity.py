@@ -0,0 +1,88 @@
+from datetime import timedelta
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import override_settings
+from django.utils import timezone
+
+from apps.dot_ext import activity
+from apps.dot_ext.activity import ApplicationActivityTracker, flush_shared_application_activity
+from apps.test import BaseApiTest
+
+
+class TestApplicationActivityTracker(BaseApiTest):
+
+    def setUp(self):
+        self.application = self._create_application("test_app", user=self._create_user("john", "123456"))
+        self.now = timezone.now()
+
+    @override_settings(APPLICATION_ACTIVITY_FLUSH_INTERVAL=60)
+    def test_write_behind(self):
+        tracker = ApplicationActivityTracker()
+        tracker.record(self.application, self.now)
+        tracker.record(self.application, self.now + timedelta(seconds=5))
+
+        # Buffered until the flush interval
+        self.application.refresh_from_db()
+        self.assertIsNone(self.application.first_active)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(tracker.flush(), 1)
+        self.application.refresh_from_db()
+        self.assertEqual(self.application.first_active, self.now)
+        self.assertEqual(self.application.last_active, self.now + timedelta(seconds=5))
+
+        # first_active is kept and last_active never moves back
+        tracker.record(self.application, self.now - timedelta(seconds=5))
+        tracker.flush()
+        self.application.refresh_from_db()
+        self.assertEqual(self.application.first_active, self.now)
+        self.assertEqual(self.application.last_active, self.now + timedelta(seconds=5))
+
+    @override_settings(APPLICATION_ACTIVITY_FLUSH_INTERVAL=60, APPLICATION_ACTIVITY_SHARED=True)
+    def test_shared(self):
+        cache.clear()
+        tracker = ApplicationActivityTracker()
+        tracker.record(self.application, self.now)
+        tracker.flush()
+        other = ApplicationActivityTracker()
+        other.record(self.application, self.now + timedelta(seconds=5))
+        other.flush()
+
+        self.application.refresh_from_db()
+        self.assertIsNone(self.application.first_active)
+
+        self.assertEqual(flush_shared_application_activity(), 1)
+        self.application.refresh_from_db()
+        self.assertEqual(self.application.first_active, self.now)
+        self.assertEqual(self.application.last_active, self.now + timedelta(seconds=5))
+        self.assertEqual(flush_shared_application_activity(), 0)
+
+    @override_settings(APPLICATION_ACTIVITY_FLUSH_INTERVAL=60)
+    def test_failed_flush_kept(self):
+        tracker = ApplicationActivityTracker()
+        tracker.record(self.application, self.now)
+        with mock.patch.object(activity, "update_application_activity", side_effect=Exception("down")):
+            self.assertEqual(tracker.flush(), 0)
+
+        tracker.record(self.application, self.now + timedelta(seconds=5))
+        self.assertEqual(tracker.flush(), 1)
+        self.application.refresh_from_db()
+        self.assertEqual(self.application.first_active, self.now)
+        self.assertEqual(self.application.last_active, self.now + timedelta(seconds=5))
+
+    @override_settings(APPLICATION_ACTIVITY_FLUSH_INTERVAL=60, APPLICATION_ACTIVITY_SHARED=True)
+    def test_shared_late_flush(self):
+        cache.clear()
+        tracker = ApplicationActivityTracker()
+        tracker.record(self.application, self.now)
+        tracker.flush()
+        # A worker that read the generation before the command started a new one
+        generation = cache.get(activity.GENERATION_KEY, 1)
+        self.assertEqual(flush_shared_application_activity(), 1)
+
+        cache.add(activity.ENTRY_KEY.format(generation, 2),
+                  {self.application.pk: (None, self.now + timedelta(seconds=5))}, timeout=None)
+        self.assertEqual(flush_shared_application_activity(), 1)
+        self.application.refresh_from_db()
+        self.assertEqual(self.application.last_active, self.now + timedelta(seconds=5))
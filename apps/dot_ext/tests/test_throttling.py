@@ -0,0 +1,112 @@
+from unittest import mock
+
+from django.conf import settings
+from django.core.cache import caches
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from apps.dot_ext.throttling import HEADERS, ApplicationRateThrottle, TokenRateThrottle
+
+
+class Token(object):
+
+    def __init__(self, token, application_id=1):
+        self.token = token
+        self.application_id = application_id
+
+    def __str__(self):
+        return self.token
+
+
+class Request(object):
+
+    def __init__(self, auth):
+        self.auth = auth
+        self.META = {}
+
+
+class MinuteTokenThrottle(TokenRateThrottle):
+    rate = '3/min'
+
+
+class MinuteApplicationThrottle(ApplicationRateThrottle):
+    rate = '2/min'
+
+
+class TestSlidingWindowRateThrottle(SimpleTestCase):
+
+    def setUp(self):
+        caches['throttle'].clear()
+        self.now = 1000.0
+
+    def _allow(self, request, throttle_class=MinuteTokenThrottle):
+        throttle = throttle_class()
+        throttle.timer = lambda: self.now
+        return throttle.allow_request(request, None), throttle
+
+    def test_sliding_window(self):
+        request = Request(Token('token'))
+        for remaining in (2, 1, 0):
+            allowed, throttle = self._allow(request)
+            self.assertTrue(allowed)
+            self.assertEqual(request.META[HEADERS['Remaining']], remaining)
+        self.assertEqual(request.META[HEADERS['Limit']], 3)
+        self.assertEqual(request.META[HEADERS['Reset']], 60.0)
+
+        allowed, throttle = self._allow(request)
+        self.assertFalse(allowed)
+        self.assertEqual(throttle.wait(), 60)
+
+        # The previous window still counts in full at the start of the next one
+        self.now += 60
+        allowed, throttle = self._allow(request)
+        self.assertFalse(allowed)
+        self.assertAlmostEqual(throttle.wait(), 20)
+
+        # Half of the previous window counts, denied requests are not counted
+        self.now += 30
+        self.assertTrue(self._allow(request)[0])
+        self.assertFalse(self._allow(request)[0])
+
+        # Other tokens have their own limit
+        self.assertTrue(self._allow(Request(Token('other')))[0])
+
+        self.now += 120
+        self.assertTrue(self._allow(request)[0])
+
+    def test_application_limit(self):
+        first, second = Request(Token('first')), Request(Token('second'))
+        self.assertTrue(self._allow(first, MinuteApplicationThrottle)[0])
+        self.assertTrue(self._allow(second, MinuteApplicationThrottle)[0])
+        self.assertFalse(self._allow(Request(Token('third')), MinuteApplicationThrottle)[0])
+        self.assertTrue(self._allow(Request(Token('other_app', 2)), MinuteApplicationThrottle)[0])
+
+    def test_headers_of_closest_limit(self):
+        request = Request(Token('token'))
+        self._allow(request, MinuteApplicationThrottle)
+        self._allow(request)
+        # 1 request left for the application, 2 for the token
+        self.assertEqual(request.META[HEADERS['Remaining']], 1)
+        self.assertEqual(request.META[HEADERS['Limit']], 2)
+
+    @override_settings(THROTTLE_CACHE_PER_PROCESS=False)
+    def test_per_process_store_warning(self):
+        with mock.patch('apps.dot_ext.throttling._per_process_warned', set()):
+            with self.assertLogs('hhs_server.apps.dot_ext.throttling', 'WARNING') as logs:
+                self._allow(Request(Token('token')))
+                self._allow(Request(Token('token')))
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('counted per worker process', logs.output[0])
+
+
+# The default store, counting across the workers
+@override_settings(CACHES={**settings.CACHES, 'throttle': {
+    'BACKEND': 'apps.core.cache.AtomicDatabaseCache',
+    'LOCATION': 'django_throttle_cache',
+}}, THROTTLE_CACHE_PER_PROCESS=False)
+class TestDatabaseSlidingWindowRateThrottle(TestSlidingWindowRateThrottle, TestCase):
+
+    def test_per_process_store_warning(self):
+        with mock.patch('apps.dot_ext.throttling._per_process_warned', set()):
+            with mock.patch('apps.dot_ext.throttling.logger') as logger:
+                self._allow(Request(Token('token')))
+        logger.warning.assert_not_called()
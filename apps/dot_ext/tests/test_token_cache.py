@@ -0,0 +1,76 @@
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.test import override_settings
+from oauth2_provider.models import AccessToken
+
+from apps.dot_ext.oauth2_validators import SingleAccessTokenValidator
+from apps.dot_ext.token_cache import cache_token, get_cached_token, token_cache_key
+from apps.test import BaseApiTest
+
+
+@override_settings(ACCESS_TOKEN_CACHE_TTL=300)
+class TestAccessTokenCache(BaseApiTest):
+
+    def setUp(self):
+        cache.clear()
+        self.read_capability = self._create_capability('Read', [])
+        self.write_capability = self._create_capability('Write', [])
+        self.token = self.create_token('John', 'Smith')
+        self.validator = SingleAccessTokenValidator()
+
+    def test_cached_token(self):
+        access_token = self.validator._load_access_token(self.token)
+        self.assertEqual(get_cached_token(self.token).pk, access_token.pk)
+
+        with self.assertNumQueries(0):
+            cached = self.validator._load_access_token(self.token)
+            self.assertEqual(cached.application.user, access_token.application.user)
+            self.assertEqual(cached.user, access_token.user)
+            self.assertFalse(cached.is_expired())
+        # The crosswalk is not cached
+        with self.assertNumQueries(1):
+            self.assertEqual(cached.user.crosswalk.fhir_id, access_token.user.crosswalk.fhir_id)
+
+    def test_cached_fields(self):
+        access_token = self.validator._load_access_token(self.token)
+        entry = caches[settings.ACCESS_TOKEN_CACHE_ALIAS].get(token_cache_key(self.token))
+        values = [value for fields in entry.values() if isinstance(fields, tuple) for value in fields]
+        self.assertNotIn(self.token, values)
+        self.assertNotIn(access_token.user.crosswalk.fhir_id, values)
+        self.assertNotIn(access_token.application.client_secret, values)
+
+    def test_revoked_token(self):
+        self.validator._load_access_token(self.token)
+        AccessToken.objects.get(token=self.token).revoke()
+        self.assertIsNone(get_cached_token(self.token))
+        self.assertIsNone(self.validator._load_access_token(self.token))
+
+    def test_deactivated_application(self):
+        access_token = self.validator._load_access_token(self.token)
+        application = access_token.application
+        application.active = False
+        application.save()
+        self.assertIsNone(get_cached_token(self.token))
+        self.assertFalse(self.validator._load_access_token(self.token).application.active)
+
+    def test_expired_token_not_cached(self):
+        AccessToken.objects.filter(token=self.token).update(expires="2000-01-01T00:00:00Z")
+        self.validator._load_access_token(self.token)
+        self.assertIsNone(get_cached_token(self.token))
+
+    def test_revoked_while_cached(self):
+        access_token = self.validator._load_access_token(self.token)
+        with self.captureOnCommitCallbacks(execute=True):
+            AccessToken.objects.get(token=self.token).revoke()
+            # A request caches the token before the revocation is committed
+            cache_token(access_token)
+        self.assertIsNone(get_cached_token(self.token))
+
+    def test_deactivated_while_cached(self):
+        access_token = self.validator._load_access_token(self.token)
+        with self.captureOnCommitCallbacks(execute=True):
+            application = AccessToken.objects.get(token=self.token).application
+            application.active = False
+            application.save()
+            cache_token(access_token)
+        self.assertIsNone(get_cached_token(self.token))
@@ -1,6 +1,39 @@
-from rest_framework.throttling import SimpleRateThrottle
+"""
+Rate limits of the FHIR API, per access token and per application.
+
+The throttles count requests with a sliding window counter: two fixed-size
+counters per client, the current and the previous window, and the previous
+one is weighted by how much of it still overlaps the sliding window. The
+windows of a client start with its first request. Counters are kept in the
+"throttle" cache (THROTTLE_CACHE_ALIAS) with atomic increments, by default
+the django_throttle_cache table (apps.core.cache.AtomicDatabaseCache), so
+limits apply across the workers at a few queries per request. Point
+THROTTLE_CACHE_BACKEND at memcached or redis to save the queries. Setting
+THROTTLE_CACHE_PER_PROCESS counts in process instead, limits then apply per
+worker and a rate allows that many requests per worker; a throttle with a
+rate logs a warning when its counters are in process without it.
+
+Rates are set in REST_FRAMEWORK["DEFAULT_THROTTLE_RATES"], e.g.
+"token": "100000/s", "application": None (no limit).
+"""
+import hashlib
+import logging
+import math
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
 from django.utils.deprecation import MiddlewareMixin
+from rest_framework.throttling import SimpleRateThrottle
 
+import apps.logging.request_logger as bb2logging
+
+from apps.metrics.instruments import throttle_rejections
+
+logger = logging.getLogger(bb2logging.HHS_SERVER_LOGNAME_FMT.format(__name__))
+
+# Scopes warned of their in-process counters
+_per_process_warned = set()
 
 HEADERS = {
     'Remaining': 'X-RateLimit-Remaining',
@@ -9,7 +42,96 @@ HEADERS = {
 }
 
 
-class TokenRateThrottle(SimpleRateThrottle):
+class SlidingWindowRateThrottle(SimpleRateThrottle):
+    """
+    Base of the API throttles, subclasses set scope and get_cache_key().
+    """
+
+    @property
+    def store(self):
+        return caches[getattr(settings, "THROTTLE_CACHE_ALIAS", "throttle")]
+
+    def check_store(self):
+        if (self.scope in _per_process_warned or getattr(settings, "THROTTLE_CACHE_PER_PROCESS", False)
+                or not isinstance(self.store, LocMemCache)):
+            return
+        _per_process_warned.add(self.scope)
+        logger.warning("The %s rate limit (%s) is counted per worker process, the throttle cache "
+                       "is in process. Set THROTTLE_CACHE_BACKEND to a shared cache, or "
+                       "DJANGO_THROTTLE_CACHE_PER_PROCESS to opt in to per worker limits."
+                       % (self.scope, self.rate))
+
+    def _start(self, key):
+        # The first request of a client starts its windows
+        start = self.store.get(key)
+        if start is None:
+            self.store.add(key, self.now, 2 * self.duration)
+            start = self.store.get(key, self.now)
+        return start
+
+    def _incr(self, key, delta=1):
+        try:
+            return self.store.incr(key, delta)
+        except ValueError:
+            self.store.add(key, 0, 2 * self.duration)
+            return self.store.incr(key, delta)
+
+    def allow_request(self, request, view):
+        if self.rate is None:
+            return True
+        self.check_store()
+
+        self.key = self.get_cache_key(request, view)
+        if self.key is None:
+            return True
+
+        self.now = self.timer()
+        start_key = "%s:start" % self.key
+        start = self._start(start_key)
+        window = int((self.now - start) // self.duration)
+        self.window_elapsed = self.now - start - window * self.duration
+        window_key = "%s:%s:%s" % (self.key, start, window)
+
+        self.previous = self.store.get("%s:%s:%s" % (self.key, start, window - 1), 0)
+        self.current = self._incr(window_key)
+        if self.current == 1:
+            # Keep the start of an active client
+            self.store.touch(start_key, 2 * self.duration)
+
+        allowed = self.count() <= self.num_requests
+        if not allowed:
+            # Denied requests are not counted
+            self.current = self._incr(window_key, -1)
+            throttle_rejections.labels(self.scope).inc()
+        self.set_headers(request)
+        return allowed
+
+    def count(self):
+        # Rounded so a window boundary does not deny a request on a float error
+        return round(self.previous * (1 - self.window_elapsed / self.duration) + self.current, 6)
+
+    def wait(self):
+        """
+        Seconds until the next request is allowed.
+        """
+        window_remaining = self.duration - self.window_elapsed
+        if self.current >= self.num_requests or not self.previous:
+            return window_remaining
+        # When the weighted previous window leaves room for one request
+        elapsed = self.duration * (1 - (self.num_requests - 1 - self.current) / self.previous)
+        return max(0, min(window_remaining, elapsed - self.window_elapsed))
+
+    def set_headers(self, request):
+        remaining = max(0, int(math.floor(self.num_requests - self.count())))
+        if remaining > request.META.get(HEADERS['Remaining'], remaining):
+            # Another throttle of the request is closer to its limit
+            return
+        request.META[HEADERS['Remaining']] = remaining
+        request.META[HEADERS['Limit']] = self.num_requests
+        request.META[HEADERS['Reset']] = self.duration - self.window_elapsed
+
+
+class TokenRateThrottle(SlidingWindowRateThrottle):
     """
     Limits the rate of API calls that may be made from a given token.
     The token will be used as a unique cache key.
@@ -20,7 +142,7 @@ class TokenRateThrottle(SimpleRateThrottle):
 
     def get_cache_key(self, request, view):
         try:
-            ident = request.auth
+            ident = hashlib.sha256(str(request.auth).encode('utf-8')).hexdigest()
         except AttributeError:
             ident = self.get_ident(request)
 
@@ -29,23 +151,23 @@ class TokenRateThrottle(SimpleRateThrottle):
             'ident': ident,
         }
 
-    def allow_request(self, request, view):
-        # run this first to populate/update self.history, self.now, self.duration, self.num_requests
-        result = super(TokenRateThrottle, self).allow_request(request, view)
-        try:
-            request.META[HEADERS['Remaining']] = self.num_requests - len(self.history)
-            request.META[HEADERS['Limit']] = self.num_requests
-            if self.history:
-                remaining_duration = self.duration - (self.now - self.history[-1])
-            else:
-                remaining_duration = self.duration
-
-            request.META[HEADERS['Reset']] = remaining_duration
-        # Allows for throttling to be turned off completely
-        except AttributeError:
-            pass
 
-        return result
+class ApplicationRateThrottle(SlidingWindowRateThrottle):
+    """
+    Limits the rate of API calls that may be made by all the tokens
+    of an application.
+    """
+    scope = 'application'
+
+    def get_cache_key(self, request, view):
+        application_id = getattr(getattr(request, 'auth', None), 'application_id', None)
+        if application_id is None:
+            return None
+
+        return self.cache_format % {
+            'scope': self.scope,
+            'ident': application_id,
+        }
 
 
 class ThrottleMiddleware(MiddlewareMixin):
@@ -0,0 +1,135 @@
+"""
+Cache of validated access tokens for the bearer authentication of the
+resource server (apps.dot_ext.oauth2_validators).
+
+Entries are keyed by the SHA256 of the token and hold the fields of the
+token, its application, the application's developer user and the
+beneficiary user the resource server reads, so an API call is
+authenticated without a query. Secrets and beneficiary identifiers are not
+cached: the token string is the one looked up, other fields are loaded when
+first read and the beneficiary's crosswalk is queried by the request. An
+entry lives at most ACCESS_TOKEN_CACHE_TTL seconds and never past the
+token's expires.
+
+Entries are dropped when the token is saved or deleted (revoke, archive,
+grant removal). Saving an application (e.g. deactivating it) bumps its
+version stamp, which the entries of its tokens are checked against, see
+apps.dot_ext.signals. Both are done again once the transaction commits, a
+request may have cached the token as it was before in between.
+
+Settings:
+    ACCESS_TOKEN_CACHE_TTL = 300        # 0 disables the cache
+    ACCESS_TOKEN_CACHE_ALIAS = "tiered"
+"""
+import hashlib
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.db import transaction
+from django.utils import timezone
+from oauth2_provider.models import get_access_token_model, get_application_model
+
+from apps.core.cache import bump_stamp
+
+KEY = "access_token:{}"
+APPLICATION_STAMP_KEY = "access_token_application:{}"
+
+# Fields cached by model, the token string is not
+TOKEN_FIELDS = ("id", "user_id", "source_refresh_token_id", "id_token_id", "application_id",
+                "expires", "scope", "created", "updated")
+APPLICATION_FIELDS = ("id", "client_id", "user_id", "name", "active", "first_active",
+                      "require_demographic_scopes", "data_access_type")
+USER_FIELDS = ("id", "username", "is_active")
+
+
+def token_cache_key(token):
+    return KEY.format(hashlib.sha256(str(token).encode("utf-8")).hexdigest())
+
+
+def _cache():
+    return caches[getattr(settings, "ACCESS_TOKEN_CACHE_ALIAS", "default")]
+
+
+def _ttl():
+    return getattr(settings, "ACCESS_TOKEN_CACHE_TTL", 0)
+
+
+def application_stamp(application_id):
+    key = APPLICATION_STAMP_KEY.format(application_id)
+    stamp = _cache().get(key)
+    if stamp is None:
+        # Stored so the next reads are served by the local tier
+        _cache().add(key, 0, timeout=None)
+        stamp = _cache().get(key, 0)
+    return stamp
+
+
+def _fields(instance, fields):
+    return None if instance is None else tuple(getattr(instance, field) for field in fields)
+
+
+def _instance(model, fields, values):
+    # Fields that are not cached are deferred, loaded when read
+    return None if values is None else model.from_db(None, fields, values)
+
+
+def get_cached_token(token):
+    """
+    Returns the cached AccessToken, loaded with its application, developer
+    and user, or None on a miss.
+    """
+    if not _ttl():
+        return None
+    entry = _cache().get(token_cache_key(token))
+    if entry is None or entry["application_stamp"] != application_stamp(entry["application_id"]):
+        return None
+    access_token = _instance(get_access_token_model(), TOKEN_FIELDS, entry["token"])
+    access_token.token = token
+    application = _instance(get_application_model(), APPLICATION_FIELDS, entry["application"])
+    if application is not None:
+        application.user = _instance(get_user_model(), USER_FIELDS, entry["developer"])
+    access_token.application = application
+    access_token.user = _instance(get_user_model(), USER_FIELDS, entry["user"])
+    return access_token
+
+
+def cache_token(access_token):
+    ttl = _ttl()
+    if not ttl:
+        return
+    remaining = int((access_token.expires - timezone.now()).total_seconds())
+    if remaining <= 0:
+        return
+    application = access_token.application
+    _cache().set(token_cache_key(access_token.token), {
+        "token": _fields(access_token, TOKEN_FIELDS),
+        "application": _fields(application, APPLICATION_FIELDS),
+        "developer": _fields(application.user if application is not None else None, USER_FIELDS),
+        "user": _fields(access_token.user, USER_FIELDS),
+        "application_id": access_token.application_id,
+        "application_stamp": application_stamp(access_token.application_id),
+    }, min(ttl, remaining))
+
+
+def invalidate_tokens(tokens):
+    """
+    Drops the cached entries of an iterable of token strings.
+    """
+    if not _ttl():
+        return
+    keys = [token_cache_key(token) for token in tokens]
+    if keys:
+        _cache().delete_many(keys)
+        transaction.on_commit(lambda: _cache().delete_many(keys))
+
+
+def invalidate_application_tokens(application_id):
+    """
+    Drops the cached entries of the tokens of an application.
+    """
+    if not _ttl():
+        return
+    key = APPLICATION_STAMP_KEY.format(application_id)
+    bump_stamp(_cache(), key)
+    transaction.on_commit(lambda: bump_stamp(_cache(), key))
@@ -1,4 +1,4 @@
-from apps.fhir.bluebutton.models import ArchivedCrosswalk, Crosswalk
+from apps.fhir.bluebutton.models import ArchivedCrosswalk, Crosswalk, ExportJob
 from django.contrib import admin
 
 
@@ -23,3 +23,15 @@ class ArchivedCrosswalkAdmin(admin.ModelAdmin):
 
 
 admin.site.register(ArchivedCrosswalk, ArchivedCrosswalkAdmin)
+
+
+class ExportJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'application', 'fhir_id', 'resource_types', 'status', 'attempts', 'transaction_time',
+                    'completed_at')
+    list_filter = ('status',)
+    search_fields = ('id', 'fhir_id', 'application__name')
+    raw_id_fields = ('application', 'user')
+    readonly_fields = ('backend_headers', 'progress')
+
+
+admin.site.register(ExportJob, ExportJobAdmin)
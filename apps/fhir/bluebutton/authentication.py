@@ -1,7 +1,43 @@
 from oauth2_provider.contrib.rest_framework import authentication
+from oauth2_provider.models import AccessToken
 from django.utils import timezone
 from rest_framework import exceptions
 
+from apps.dot_ext.activity import activity_tracker
+from apps.dot_ext.oauth2_validators import BEARER_TOKEN_RELATED
+
+
+class AuthContext(object):
+    """
+    Request-scoped view of the token of an authenticated FHIR request:
+    the access token, its application, the application's developer user,
+    the beneficiary user and the beneficiary's crosswalk, loaded together
+    by OAuth2ResourceOwner so headers, permissions and logging don't query
+    them again. The crosswalk of a cached token (apps.dot_ext.token_cache)
+    is queried here, it is not cached.
+    """
+
+    def __init__(self, access_token):
+        self.access_token = access_token
+        self.application = access_token.application
+        self.developer = access_token.application.user
+        self.user = access_token.user
+        self.crosswalk = getattr(access_token.user, "crosswalk", None)
+
+    @classmethod
+    def load(cls, access_token):
+        if not cls.is_loaded(access_token):
+            access_token = AccessToken.objects.select_related(*BEARER_TOKEN_RELATED).get(pk=access_token.pk)
+        return cls(access_token)
+
+    @staticmethod
+    def is_loaded(access_token):
+        # True when the bearer token validator loaded (or cached) the rows with the token
+        if not (AccessToken.application.is_cached(access_token) and AccessToken.user.is_cached(access_token)):
+            return False
+        application = access_token.application
+        return application is None or type(application).user.is_cached(application)
+
 
 class OAuth2ResourceOwner(authentication.OAuth2Authentication):
     def authenticate(self, request):
@@ -18,19 +54,17 @@ class OAuth2ResourceOwner(authentication.OAuth2Authentication):
             request.oauth2_error = {}
 
         if user_auth_tuple is not None:
-            user, access_token = user_auth_tuple
+            auth_context = AuthContext.load(user_auth_tuple[1])
+            user, access_token = auth_context.user, auth_context.access_token
             request.resource_owner = user
-            if not hasattr(user, "crosswalk"):
+            if auth_context.crosswalk is None:
                 return None
-            request.crosswalk = user.crosswalk
+            request.crosswalk = auth_context.crosswalk
+            # Set on the django request too, for the request logging middleware
+            getattr(request, "_request", request).auth_context = auth_context
 
             # Update Application activity metric datetime fields
-            access_token.application.last_active = timezone.now()
-            if access_token.application.first_active is None:
-                access_token.application.first_active = (
-                    access_token.application.last_active
-                )
-            access_token.application.save()
+            activity_tracker.record(access_token.application, timezone.now())
 
             return user, access_token
         return None
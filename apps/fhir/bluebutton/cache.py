@@ -0,0 +1,139 @@
+"""
+Opt-in per-beneficiary cache of backend FHIR responses.
+
+Patient and Coverage data changes rarely but is polled on every app sync.
+Responses are cached in-process, keyed by the beneficiary fhir_id, resource
+type, API version, backend url, normalized query parameters and the
+forwarded scheme and host the backend rewrites the Bundle links with.
+
+Settings:
+    FHIR_RESPONSE_CACHE_ENABLED = False
+    FHIR_RESPONSE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+    FHIR_RESPONSE_CACHE_TTLS = {"Patient": 300, "Coverage": 300}
+
+Only resource types listed in FHIR_RESPONSE_CACHE_TTLS are cached. Entries
+are evicted least recently used once the total size of the cached backend
+bodies passes MAX_BYTES.
+
+All entries of a beneficiary are dropped when one of their grants or tokens
+is revoked (see apps.authorization.signals). The keys hold a version stamp
+of the beneficiary kept in the FHIR_RESPONSE_CACHE_STAMP_ALIAS cache, shared
+by the workers: a revocation bumps it, so the other workers stop serving the
+entries once they see the new stamp, within the VERSION_CHECK_INTERVAL of
+the "tiered" cache. The stamp is bumped again once the revoking transaction
+commits, a request may have cached a response with the old one in between.
+"""
+import threading
+import time
+
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+from apps.core.cache import bump_stamp
+
+STAMP_KEY = "fhir_response_stamp:{}"
+
+
+def _stamps():
+    return caches[getattr(settings, "FHIR_RESPONSE_CACHE_STAMP_ALIAS", "tiered")]
+
+
+class ResponseCache(object):
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._keys_by_fhir_id = {}
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def ttl_for(self, resource_type):
+        if not getattr(settings, "FHIR_RESPONSE_CACHE_ENABLED", False):
+            return None
+        return getattr(settings, "FHIR_RESPONSE_CACHE_TTLS", {}).get(resource_type)
+
+    def is_enabled_for(self, resource_type):
+        return bool(self.ttl_for(resource_type))
+
+    def stamp(self, fhir_id):
+        key = STAMP_KEY.format(fhir_id)
+        stamp = _stamps().get(key)
+        if stamp is None:
+            # Stored so the next reads are served by the local tier
+            _stamps().add(key, 0, timeout=None)
+            stamp = _stamps().get(key, 0)
+        return stamp
+
+    def make_key(self, fhir_id, resource_type, version, target_url, params, forwarded=()):
+        """
+        forwarded is the (scheme, host) sent to the backend as
+        X-Forwarded-Proto and X-Forwarded-Host.
+        """
+        normalized = tuple(sorted(
+            (k, tuple(v) if isinstance(v, list) else v) for k, v in params.items()))
+        return (fhir_id, resource_type, version, target_url, normalized, tuple(forwarded), self.stamp(fhir_id))
+
+    def get(self, key):
+        """
+        Returns the cached data, or None on a miss.
+        The data is shared between requests and must not be modified.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, data, size):
+        ttl = self.ttl_for(key[1])
+        max_bytes = getattr(settings, "FHIR_RESPONSE_CACHE_MAX_BYTES", 0)
+        if not ttl or size > max_bytes:
+            return
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (time.monotonic() + ttl, data, size)
+            self._keys_by_fhir_id.setdefault(key[0], set()).add(key)
+            self._size += size
+            while self._size > max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, fhir_id):
+        self._invalidate(fhir_id)
+        # Again once committed, a request may have cached the beneficiary in between
+        transaction.on_commit(lambda: self._invalidate(fhir_id))
+
+    def _invalidate(self, fhir_id):
+        # Other workers see the new stamp, this one drops the entries now
+        bump_stamp(_stamps(), STAMP_KEY.format(fhir_id))
+        with self._lock:
+            for key in list(self._keys_by_fhir_id.get(fhir_id, ())):
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_fhir_id.clear()
+            self._size = 0
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self._size -= entry[2]
+        keys = self._keys_by_fhir_id.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_fhir_id[key[0]]
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,101 @@
+"""
+HTTP conditional request support (ETag / Last-Modified / 304) for the FHIR
+read and search views.
+
+The backend's ETag and Last-Modified headers are passed through when BFD
+sends them. Otherwise the ETag is a hash of the backend body and the
+rendered media type, and Last-Modified comes from the resource
+meta.lastUpdated.
+
+BFD generates a new Bundle id on every search response, so that id is left
+out of the hash and the ETag of a Bundle is weak: two bundles with the same
+entries are equivalent but not byte for byte identical.
+"""
+import hashlib
+import json
+
+from django.http import HttpResponseNotModified
+from django.utils.cache import get_conditional_response
+from django.utils.dateparse import parse_datetime
+from django.utils.http import http_date, parse_http_date_safe
+
+
+# Client conditional headers that can be forwarded to the backend
+CONDITIONAL_HEADERS = {
+    'HTTP_IF_NONE_MATCH': 'If-None-Match',
+    'HTTP_IF_MODIFIED_SINCE': 'If-Modified-Since',
+}
+
+
+def conditional_headers(request):
+    """
+    Returns the If-None-Match / If-Modified-Since headers of the client request.
+    """
+    return {header: request.META[key]
+            for key, header in CONDITIONAL_HEADERS.items() if request.META.get(key)}
+
+
+def backend_validators(r):
+    """
+    Returns the (etag, last_modified) passed through from the backend response.
+    last_modified is a timestamp, either may be None.
+    """
+    last_modified = r.headers.get('Last-Modified')
+    return (r.headers.get('ETag') or None,
+            parse_http_date_safe(last_modified) if last_modified else None)
+
+
+def response_validators(r, data, media_type):
+    """
+    Returns the (etag, last_modified) of a processed backend response.
+    """
+    etag, last_modified = backend_validators(r)
+
+    if etag is None:
+        content = r.content
+        weak = False
+        if isinstance(data, dict) and data.get('resourceType') == 'Bundle' and data.get('id'):
+            content = content.replace(json.dumps(data['id']).encode('utf-8'), b'', 1)
+            weak = True
+        digest = hashlib.sha256(media_type.encode('utf-8') + b'\n' + content).hexdigest()
+        etag = '%s"%s"' % ('W/' if weak else '', digest)
+
+    if last_modified is None and isinstance(data, dict):
+        updated = data.get('meta', {}).get('lastUpdated')
+        try:
+            updated = parse_datetime(updated) if updated else None
+        except ValueError:
+            updated = None
+        if updated is not None and updated.tzinfo is not None:
+            last_modified = int(updated.timestamp())
+
+    return etag, last_modified
+
+
+def set_validators(response, validators):
+    etag, last_modified = validators
+    if etag:
+        response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    return response
+
+
+def conditional_response(request, validators, response):
+    """
+    Evaluate the client's conditional headers against the validators.
+
+    Returns a 304 when the client copy is current, otherwise the response
+    with the ETag and Last-Modified headers set.
+    """
+    etag, last_modified = validators
+    set_validators(response, validators)
+    return get_conditional_response(request._request, etag=etag, last_modified=last_modified,
+                                    response=response)
+
+
+def not_modified_response(validators):
+    """
+    304 for a backend that already answered 304 to the forwarded headers.
+    """
+    return set_validators(HttpResponseNotModified(), validators)
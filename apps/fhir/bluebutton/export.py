@@ -0,0 +1,287 @@
+"""
+Background processing of FHIR Bulk Data $export jobs (models.ExportJob).
+
+A worker claims a queued job, pages the backend search of each requested
+resource type and appends the entries to one NDJSON file per type under
+FHIR_EXPORT_STORAGE_DIR/<job id>/. After every page the file offset and
+next startIndex are checkpointed on the job, so a job whose worker died
+(no heartbeat for FHIR_EXPORT_STALE_AFTER seconds) or that failed with a
+backend error is resumed from its last page by the next worker.
+
+The beneficiary's data access grant is checked before every page and at
+every checkpoint: a job whose grant was removed or has expired is cancelled
+and its files deleted. Removing a grant also cancels its queued and running
+jobs (apps.authorization.signals).
+
+The files are readable by the worker's user only. Idle workers delete the
+jobs finished more than FHIR_EXPORT_RETENTION seconds ago with their files.
+
+Workers are run with the run_export_worker management command.
+
+Settings:
+    FHIR_EXPORT_STORAGE_DIR
+    FHIR_EXPORT_STALE_AFTER = 300
+    FHIR_EXPORT_MAX_ATTEMPTS = 3
+    FHIR_EXPORT_POLL_INTERVAL = 5
+    FHIR_EXPORT_RETENTION = 86400
+"""
+import json
+import logging
+import os
+import shutil
+import threading
+
+from datetime import timedelta
+from django.conf import settings
+from django.db import close_old_connections, connection
+from django.db.models import Q
+from django.utils import timezone
+from rest_framework import exceptions
+
+import apps.logging.request_logger as bb2logging
+
+from apps.authorization.models import DataAccessGrant
+from apps.authorization.permissions import is_resource_for_patient
+from apps.fhir.server.client import backend_client
+from apps.fhir.server.settings import fhir_settings
+
+from .constants import MAX_PAGE_SIZE
+from .loggers import log_export_page
+from .models import ExportJob
+
+logger = logging.getLogger(bb2logging.HHS_SERVER_LOGNAME_FMT.format(__name__))
+
+EXPORT_RESOURCE_TYPES = ('Patient', 'Coverage', 'ExplanationOfBenefit')
+
+
+class ExportCancelled(Exception):
+    pass
+
+
+class ExportInterrupted(Exception):
+    pass
+
+
+def search_parameters(resource_type, fhir_id):
+    # Same beneficiary scoping as the search views
+    return {
+        'Patient': {'_id': fhir_id},
+        'Coverage': {'beneficiary': 'Patient/' + fhir_id},
+        'ExplanationOfBenefit': {'patient': fhir_id},
+    }[resource_type]
+
+
+def search_url(resource_type, version):
+    fhir_url = fhir_settings.fhir_url
+    if fhir_url.endswith('v1/fhir/'):
+        # only if called by tests
+        return "{}{}/".format(fhir_url, resource_type)
+    return "{}/{}/fhir/{}/".format(fhir_url, 'v2' if version == 2 else 'v1', resource_type)
+
+
+def job_dir(job):
+    return os.path.join(settings.FHIR_EXPORT_STORAGE_DIR, str(job.id))
+
+
+def file_path(job, resource_type):
+    return os.path.join(job_dir(job), "%s.ndjson" % resource_type)
+
+
+def delete_files(job):
+    shutil.rmtree(job_dir(job), ignore_errors=True)
+
+
+def grant_is_active(job):
+    # Not cached, a revoked grant stops the job at its next page
+    return DataAccessGrant.objects.filter(
+        Q(expiration_date__isnull=True) | Q(expiration_date__gt=timezone.now()),
+        beneficiary_id=job.user_id, application_id=job.application_id).exists()
+
+
+def check_grant(job):
+    if not grant_is_active(job):
+        ExportJob.objects.filter(id=job.id, status__in=ExportJob.ACTIVE_STATUSES).update(
+            status=ExportJob.STATUS_CANCELLED, error="The data access grant was removed or has expired")
+        raise ExportCancelled()
+
+
+def cancel_jobs(application_id, user_id):
+    """
+    Cancel the queued and running jobs of an application and beneficiary,
+    a running worker stops at its next page.
+    """
+    jobs = ExportJob.objects.filter(application_id=application_id, user_id=user_id,
+                                    status__in=ExportJob.ACTIVE_STATUSES)
+    for job in jobs:
+        delete_files(job)
+    jobs.update(status=ExportJob.STATUS_CANCELLED)
+
+
+def purge_expired_jobs():
+    """
+    Delete the jobs finished more than FHIR_EXPORT_RETENTION seconds ago
+    and their files. Failed and cancelled jobs count from their kick-off.
+    Returns the number of jobs deleted.
+    """
+    expired = timezone.now() - timedelta(seconds=settings.FHIR_EXPORT_RETENTION)
+    jobs = ExportJob.objects.filter(
+        Q(status=ExportJob.STATUS_COMPLETED, completed_at__lt=expired)
+        | Q(status__in=(ExportJob.STATUS_FAILED, ExportJob.STATUS_CANCELLED), transaction_time__lt=expired)
+    ).only('id')
+    count = 0
+    for job in jobs:
+        delete_files(job)
+        job.delete()
+        count += 1
+    if count:
+        logger.info("Deleted %s expired export jobs" % count)
+    return count
+
+
+def claim_job():
+    """
+    Claim the oldest queued job, or a running job whose worker stopped
+    sending heartbeats. Returns None when there is nothing to do.
+    """
+    now = timezone.now()
+    stale = now - timedelta(seconds=settings.FHIR_EXPORT_STALE_AFTER)
+    candidates = ExportJob.objects.filter(
+        Q(status=ExportJob.STATUS_QUEUED)
+        | Q(status=ExportJob.STATUS_RUNNING, heartbeat__lt=stale)
+    ).order_by('transaction_time').values_list('id', 'status', 'heartbeat')[:10]
+
+    for job_id, status, heartbeat in candidates:
+        # Only one worker wins the conditional update
+        claimed = ExportJob.objects.filter(id=job_id, status=status, heartbeat=heartbeat).update(
+            status=ExportJob.STATUS_RUNNING, heartbeat=now)
+        if claimed:
+            return ExportJob.objects.get(id=job_id)
+    return None
+
+
+def run_job(job, stop_event=None):
+    """
+    Export the job's resource types, resuming from its checkpoints.
+    When stop_event is set the job is put back in the queue after the
+    current page.
+    """
+    try:
+        for resource_type in job.resource_type_list:
+            export_resource_type(job, resource_type, stop_event)
+    except ExportCancelled:
+        logger.info("Export job %s cancelled" % job.id)
+        delete_files(job)
+        return
+    except ExportInterrupted:
+        logger.info("Export job %s interrupted, back in the queue" % job.id)
+        ExportJob.objects.filter(id=job.id, status=ExportJob.STATUS_RUNNING).update(
+            status=ExportJob.STATUS_QUEUED, heartbeat=None)
+        return
+    except Exception as e:
+        job.attempts += 1
+        job.error = str(e)
+        # Failed jobs go back to the queue and resume from the last page
+        job.status = (ExportJob.STATUS_FAILED if job.attempts >= settings.FHIR_EXPORT_MAX_ATTEMPTS
+                      else ExportJob.STATUS_QUEUED)
+        job.heartbeat = None
+        logger.error("Export job %s failed (attempt %s): %s" % (job.id, job.attempts, e))
+        ExportJob.objects.filter(id=job.id, status=ExportJob.STATUS_RUNNING).update(
+            attempts=job.attempts, error=job.error, status=job.status, heartbeat=None)
+        return
+
+    job.status = ExportJob.STATUS_COMPLETED
+    job.completed_at = timezone.now()
+    ExportJob.objects.filter(id=job.id, status=ExportJob.STATUS_RUNNING).update(
+        status=job.status, completed_at=job.completed_at, error="")
+
+
+def export_resource_type(job, resource_type, stop_event=None):
+    state = job.progress.setdefault(resource_type, {'start_index': 0, 'count': 0, 'offset': 0, 'done': False})
+    if state['done']:
+        return
+
+    # Beneficiary data, not readable by other users of the host
+    os.makedirs(job_dir(job), mode=0o700, exist_ok=True)
+    fd = os.open(file_path(job, resource_type), os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o600)
+    with os.fdopen(fd, 'a+b') as f:
+        # Drop anything written after the last checkpoint
+        f.truncate(state['offset'])
+
+        while not state['done']:
+            check_grant(job)
+            page = fetch_page(job, resource_type, state['start_index'])
+            entries = page.get('entry', [])
+            for entry in entries:
+                resource = entry['resource']
+                try:
+                    owned = is_resource_for_patient(resource, job.fhir_id)
+                except exceptions.NotFound:
+                    owned = False
+                if not owned:
+                    raise ValueError("Backend returned a resource of another beneficiary")
+                f.write(json.dumps(resource).encode('utf-8') + b'\n')
+            f.flush()
+
+            state['count'] += len(entries)
+            state['start_index'] += MAX_PAGE_SIZE
+            state['offset'] = f.tell()
+            state['done'] = not entries or state['start_index'] >= page.get('total', 0)
+            checkpoint(job)
+            if stop_event is not None and stop_event.is_set() and not state['done']:
+                raise ExportInterrupted()
+
+
+def checkpoint(job):
+    check_grant(job)
+    updated = ExportJob.objects.filter(id=job.id, status=ExportJob.STATUS_RUNNING).update(
+        progress=job.progress, heartbeat=timezone.now())
+    if not updated:
+        raise ExportCancelled()
+
+
+def fetch_page(job, resource_type, start_index):
+    url = search_url(resource_type, job.api_version)
+    params = {
+        '_format': 'application/json+fhir',
+        'startIndex': start_index,
+        '_count': MAX_PAGE_SIZE,
+        **search_parameters(resource_type, job.fhir_id),
+    }
+    if job.since is not None:
+        params['_lastUpdated'] = 'ge' + job.since.isoformat()
+
+    headers = {**job.backend_headers, 'BlueButton-BackendCall': url}
+    r = backend_client.get(url, params=params, headers=headers)
+    log_export_page(job, resource_type, start_index, r)
+
+    if r.status_code != 200:
+        raise ValueError("Backend returned status %s for %s" % (r.status_code, resource_type))
+
+    return r.json()
+
+
+class ExportWorker(threading.Thread):
+    """
+    Processes export jobs until stopped. With once=True the worker exits
+    as soon as there is no job to claim.
+    """
+
+    def __init__(self, stop_event, once=False, **kwargs):
+        super().__init__(daemon=True, **kwargs)
+        self.stop_event = stop_event
+        self.once = once
+
+    def run(self):
+        try:
+            while not self.stop_event.is_set():
+                close_old_connections()
+                job = claim_job()
+                if job is not None:
+                    run_job(job, self.stop_event)
+                    continue
+                purge_expired_jobs()
+                if self.once:
+                    break
+                self.stop_event.wait(settings.FHIR_EXPORT_POLL_INTERVAL)
+        finally:
+            connection.close()
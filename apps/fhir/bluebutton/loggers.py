@@ -19,3 +19,39 @@ def log_v2_blocked(user=None, path=None, app=None, err=None, **kwargs):
                 "message": str(err) if err else None}
     log_dict.update(kwargs)
     waffle_event_logger.info(log_dict)
+
+
+def log_response_cache(request, cache_key, hit, cache):
+    """
+    Logging for the per-beneficiary FHIR response cache lookups
+    (apps.fhir.bluebutton.cache), used to size the cache.
+    """
+    fhir_id, resource_type, version = cache_key[:3]
+    fhir_logger = logging.getLogger(logging.AUDIT_DATA_FHIR_LOGGER, request)
+    fhir_logger.info({"type": "fhir_response_cache",
+                      "fhir_id": fhir_id,
+                      "resource_type": resource_type,
+                      "api_ver": "v2" if version == 2 else "v1",
+                      "hit": hit,
+                      "hits": cache.hits,
+                      "misses": cache.misses})
+
+
+def log_export_page(job, resource_type, start_index, r):
+    """
+    Logging for the backend pages fetched by the $export worker
+    (apps.fhir.bluebutton.export), in place of the per request
+    fhir_pre_fetch / fhir_post_fetch events.
+    """
+    fhir_logger = logging.getLogger(logging.AUDIT_DATA_FHIR_LOGGER)
+    fhir_logger.info({"type": "fhir_export_page",
+                      "job_id": str(job.id),
+                      "app_id": job.application_id,
+                      "user": str(job.user_id),
+                      "fhir_id": job.fhir_id,
+                      "api_ver": "v2" if job.api_version == 2 else "v1",
+                      "resource_type": resource_type,
+                      "start_index": start_index,
+                      "response_code": r.status_code,
+                      "size": len(r.content),
+                      "elapsed": r.elapsed.total_seconds()})
@@ -0,0 +1,39 @@
+import signal
+import threading
+
+from django.core.management.base import BaseCommand
+
+from apps.fhir.bluebutton.export import ExportWorker
+
+
+class Command(BaseCommand):
+    help = (
+        "Run a pool of FHIR $export workers. Runs until interrupted, or with --once"
+        " until no job is left, e.g. when called on a schedule."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('-w', '--workers', type=int, default=2, help='Number of worker threads.')
+        parser.add_argument('--once', action="store_true", help='Exit when there is no job left.')
+
+    def handle(self, *args, **options):
+        stop_event = threading.Event()
+        workers = [ExportWorker(stop_event, once=options["once"], name="export-worker-%s" % i)
+                   for i in range(options["workers"])]
+
+        if threading.current_thread() is threading.main_thread():
+            # Finish the current page and checkpoint on shutdown
+            signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+
+        for worker in workers:
+            worker.start()
+        try:
+            for worker in workers:
+                while worker.is_alive():
+                    worker.join(1)
+        except KeyboardInterrupt:
+            stop_event.set()
+            for worker in workers:
+                worker.join()
+
+        self.stdout.write("Export workers stopped")
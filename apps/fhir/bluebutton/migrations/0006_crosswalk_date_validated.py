@@ -0,0 +1,18 @@
+# Generated by Django 3.2.15 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bluebutton', '0005_exportjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='crosswalk',
+            name='date_validated',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -1,4 +1,5 @@
 import binascii
+import uuid
 
 from datetime import datetime
 from django.conf import settings
@@ -119,6 +120,9 @@ class Crosswalk(models.Model):
         db_column="user_mbi_hash",
         db_index=True,
     )
+    # Last time the hashes were matched to the fhir_id via the backend FHIR server,
+    # see get_and_update_user() in apps/mymedicare_cb/models.py
+    date_validated = models.DateTimeField(null=True, blank=True)
 
     objects = models.Manager()  # Default manager
     real_objects = RealCrosswalkManager()  # Real bene manager
@@ -236,6 +240,68 @@ class ArchivedCrosswalk(models.Model):
         return acw
 
 
+class ExportJob(models.Model):
+    """
+    FHIR Bulk Data $export of a beneficiary's data for an application.
+
+    Jobs are created by the kick-off view and processed by the export
+    worker (apps/fhir/bluebutton/export.py), which pages the backend and
+    writes one NDJSON file per resource type. progress holds the per
+    resource type checkpoint the worker resumes from.
+    """
+
+    STATUS_QUEUED = "queued"
+    STATUS_RUNNING = "running"
+    STATUS_COMPLETED = "completed"
+    STATUS_FAILED = "failed"
+    STATUS_CANCELLED = "cancelled"
+    STATUS_CHOICES = (
+        (STATUS_QUEUED, "Queued"),
+        (STATUS_RUNNING, "Running"),
+        (STATUS_COMPLETED, "Completed"),
+        (STATUS_FAILED, "Failed"),
+        (STATUS_CANCELLED, "Cancelled"),
+    )
+    ACTIVE_STATUSES = (STATUS_QUEUED, STATUS_RUNNING)
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    application = models.ForeignKey(
+        settings.OAUTH2_PROVIDER_APPLICATION_MODEL,
+        on_delete=CASCADE,
+    )
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=CASCADE,
+    )
+    fhir_id = models.CharField(max_length=80)
+    api_version = models.PositiveSmallIntegerField(default=1)
+    # Comma separated resource types
+    resource_types = models.CharField(max_length=255)
+    since = models.DateTimeField(null=True, blank=True)
+    # BlueButton-* headers of the kick-off request, sent with every backend call
+    backend_headers = models.JSONField(default=dict)
+    request_url = models.TextField()
+    status = models.CharField(
+        max_length=16,
+        choices=STATUS_CHOICES,
+        default=STATUS_QUEUED,
+        db_index=True,
+    )
+    progress = models.JSONField(default=dict)
+    attempts = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True, default="")
+    transaction_time = models.DateTimeField(auto_now_add=True)
+    heartbeat = models.DateTimeField(null=True, blank=True)
+    completed_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return "%s %s (%s)" % (self.application, self.fhir_id, self.status)
+
+    @property
+    def resource_type_list(self):
+        return self.resource_types.split(",")
+
+
 class Fhir_Response(Response):
     """
     Build a more consistent Response object
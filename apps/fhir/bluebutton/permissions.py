@@ -4,6 +4,7 @@ from rest_framework import (permissions, exceptions)
 from django.contrib.auth import get_user_model
 from rest_framework.exceptions import PermissionDenied
 from .constants import ALLOWED_RESOURCE_TYPES
+from apps.capabilities.permissions import TokenHasProtectedCapability
 from django.conf import settings
 
 import apps.logging.request_logger as bb2logging
@@ -73,6 +74,16 @@ class SearchCrosswalkPermission(HasCrosswalk):
         return True
 
 
+class ExportCapabilityPermission(TokenHasProtectedCapability):
+    """
+    The token scopes must allow the search of every resource type of an $export.
+    """
+
+    def required_capabilities(self, request, view):
+        return [("GET", "/{}/fhir/{}".format('v2' if view.version == 2 else 'v1', resource_type))
+                for resource_type in view.export_types(request)]
+
+
 class ApplicationActivePermission(permissions.BasePermission):
 
     def has_permission(self, request, view):
@@ -0,0 +1,221 @@
+"""
+Incremental pass-through of backend FHIR responses.
+
+FhirStreamValidator scans the backend JSON body as it arrives and builds a
+small skeleton of each resource (resourceType, id and the patient /
+beneficiary references). Each skeleton is handed to a check callback as soon
+as the resource closes, so the patient ownership check runs without parsing
+the whole body into memory.
+
+Bytes are only released to the client once everything before them has been
+checked: for a Bundle that is after each entry closes, for a single resource
+it is at the end of the body.
+"""
+import json
+import re
+
+
+# JSON tokens: a complete string, a structural character or a bare scalar
+# (number, true, false, null). The byte patterns are safe on UTF-8 input since
+# multi-byte sequences never contain ASCII bytes.
+TOKEN_RE = re.compile(
+    rb'[ \t\n\r]*(?:("[^"\\]*(?:\\.[^"\\]*)*")|([{}\[\]:,])|([^ \t\n\r{}\[\]:,"]+))')
+TRAILING_WS_RE = re.compile(rb'[ \t\n\r]*')
+# Skips over strings and other content up to the next structural bracket,
+# used for subtrees that are not needed for the ownership check.
+SKIP_RE = re.compile(rb'(?:[^"{}\[\]]|"[^"\\]*(?:\\.[^"\\]*)*")*([{}\[\]])')
+
+# Nested objects of a resource whose scalar values are kept in the skeleton
+REFERENCE_KEYS = ('patient', 'beneficiary')
+
+
+class FhirStreamError(ValueError):
+    pass
+
+
+class _Frame(object):
+    __slots__ = ('is_obj', 'key', 'expect')
+
+    def __init__(self, is_obj):
+        self.is_obj = is_obj
+        # current key (object) or index (array)
+        self.key = None if is_obj else 0
+        # next token expected: 'key', ':', 'value' or ','
+        self.expect = 'key' if is_obj else 'value'
+
+
+class FhirStreamValidator(object):
+    """
+    Usage:
+        validator = FhirStreamValidator(check)
+        for chunk in upstream:
+            yield validator.feed(chunk)
+        yield validator.close()
+
+    check(resource_skeleton) is called for every entry resource of a Bundle
+    and for the root resource. It should raise to reject the body.
+    """
+
+    def __init__(self, check):
+        self.check = check
+        self.size = 0
+        self._buf = b''
+        self._pos = 0
+        self._stack = []
+        self._path = []
+        self._resources = {}
+        self._root = None
+        self._done = False
+        # nesting depth while skipping an uninteresting subtree
+        self._skip = 0
+
+    def feed(self, chunk):
+        """
+        Consume a chunk of the upstream body.
+        Returns the bytes that are safe to forward to the client.
+        """
+        self.size += len(chunk)
+        self._buf += chunk
+        return self._scan(final=False)
+
+    def close(self):
+        """
+        Signal the end of the upstream body.
+        Returns the remaining bytes, or raises FhirStreamError on a truncated body.
+        """
+        out = self._scan(final=True)
+        if not self._done or TRAILING_WS_RE.fullmatch(self._buf, self._pos) is None:
+            raise FhirStreamError("Incomplete or malformed backend response")
+        return out + self._release(len(self._buf))
+
+    def _release(self, offset):
+        out = self._buf[:offset]
+        self._buf = self._buf[offset:]
+        self._pos -= offset
+        return out
+
+    def _releasable(self):
+        # Everything scanned so far has been checked when we are between the
+        # root keys or between the entries of a Bundle.
+        if self._root is None or self._root.get('resourceType') != 'Bundle':
+            return False
+        if len(self._stack) == 1:
+            return self._stack[0].expect in ('key', ',')
+        if len(self._stack) == 2 and self._path == ['entry']:
+            return self._stack[1].expect in ('value', ',')
+        return False
+
+    def _scan(self, final):
+        safe = 0
+        buf = self._buf
+        while not self._done:
+            if self._skip:
+                m = SKIP_RE.match(buf, self._pos)
+                if m is None:
+                    break
+                self._pos = m.end()
+                self._skip += 1 if m.group(1) in (b'{', b'[') else -1
+                if not self._skip:
+                    if not self._stack:
+                        self._done = True
+                        continue
+                    self._stack[-1].expect = ','
+                    if self._releasable():
+                        safe = self._pos
+                continue
+            m = TOKEN_RE.match(buf, self._pos)
+            if m is None:
+                break
+            # A bare scalar running to the end of the buffer may be incomplete
+            if m.group(3) is not None and m.end() == len(buf) and not final:
+                break
+            self._pos = m.end()
+            self._token(m)
+            if self._releasable():
+                safe = self._pos
+        return self._release(safe) if safe else b''
+
+    def _value_path(self):
+        return tuple(self._path) + (self._stack[-1].key,) if self._stack else ()
+
+    def _token(self, m):
+        string, punct, scalar = m.groups()
+        frame = self._stack[-1] if self._stack else None
+
+        if punct in (b'{', b'['):
+            self._expect_value(frame)
+            path = self._value_path()
+            if not self._is_interesting(path, punct == b'{'):
+                self._skip = 1
+                return
+            if frame is not None:
+                self._path.append(frame.key)
+            self._stack.append(_Frame(punct == b'{'))
+            if punct == b'{' and self._is_resource_path(path):
+                self._resources[path] = {}
+                if path == ():
+                    self._root = self._resources[path]
+        elif punct in (b'}', b']'):
+            if frame is None or frame.is_obj != (punct == b'}') or frame.expect == ':' \
+                    or (frame.expect == 'value' and (frame.is_obj or frame.key != 0)):
+                raise FhirStreamError("Unexpected %r in backend response" % punct)
+            self._stack.pop()
+            path = tuple(self._path)
+            if self._stack:
+                self._path.pop()
+                self._stack[-1].expect = ','
+            else:
+                self._done = True
+            if path in self._resources:
+                self.check(self._resources.pop(path))
+        elif punct == b':':
+            if frame is None or not frame.is_obj or frame.expect != ':':
+                raise FhirStreamError("Unexpected ':' in backend response")
+            frame.expect = 'value'
+        elif punct == b',':
+            if frame is None or frame.expect != ',':
+                raise FhirStreamError("Unexpected ',' in backend response")
+            if frame.is_obj:
+                frame.expect = 'key'
+            else:
+                frame.key += 1
+                frame.expect = 'value'
+        elif string is not None and frame is not None and frame.is_obj and frame.expect == 'key':
+            frame.key = json.loads(string)
+            frame.expect = ':'
+        else:
+            self._expect_value(frame)
+            self._scalar(self._value_path(), string if string is not None else scalar)
+            if frame is not None:
+                frame.expect = ','
+            else:
+                self._done = True
+
+    def _expect_value(self, frame):
+        if frame is not None and frame.expect != 'value':
+            raise FhirStreamError("Unexpected value in backend response")
+        if frame is None and (self._done or self._root is not None):
+            raise FhirStreamError("Unexpected value in backend response")
+
+    def _is_interesting(self, path, is_obj):
+        # Containers that lead to a resource, or hold a reference of one
+        if not is_obj:
+            return path == ('entry',)
+        if self._is_resource_path(path) or (len(path) == 2 and path[0] == 'entry'):
+            return True
+        return len(path) > 0 and path[-1] in REFERENCE_KEYS and path[:-1] in self._resources
+
+    def _is_resource_path(self, path):
+        return path == () or (len(path) == 3 and path[0] == 'entry'
+                              and isinstance(path[1], int) and path[2] == 'resource')
+
+    def _scalar(self, path, raw):
+        if not path:
+            return
+        resource = self._resources.get(path[:-1])
+        if resource is not None:
+            resource[path[-1]] = json.loads(raw)
+        elif len(path) > 1 and path[-2] in REFERENCE_KEYS:
+            resource = self._resources.get(path[:-2])
+            if resource is not None:
+                resource.setdefault(path[-2], {})[path[-1]] = json.loads(raw)
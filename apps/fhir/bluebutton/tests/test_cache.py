@@ -0,0 +1,98 @@
+from unittest.mock import patch
+
+from django.core.cache import caches
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from apps.fhir.bluebutton.cache import ResponseCache
+
+
+@override_settings(FHIR_RESPONSE_CACHE_ENABLED=True,
+                   FHIR_RESPONSE_CACHE_MAX_BYTES=100,
+                   FHIR_RESPONSE_CACHE_TTLS={"Patient": 60, "Coverage": 60})
+class TestResponseCache(SimpleTestCase):
+
+    def setUp(self):
+        caches["tiered"].clear()
+        self.cache = ResponseCache()
+
+    def _key(self, fhir_id="-20140000008325", resource_type="Patient", params=None,
+             forwarded=("https", "sandbox.bluebutton.cms.gov")):
+        return self.cache.make_key(fhir_id, resource_type, 1,
+                                   "https://fhir.example.com/v1/fhir/{}/".format(resource_type),
+                                   params or {"_format": "json"}, forwarded)
+
+    def test_enabled_for(self):
+        self.assertTrue(self.cache.is_enabled_for("Patient"))
+        self.assertFalse(self.cache.is_enabled_for("ExplanationOfBenefit"))
+        with self.settings(FHIR_RESPONSE_CACHE_ENABLED=False):
+            self.assertFalse(self.cache.is_enabled_for("Patient"))
+
+    def test_key_normalizes_parameters(self):
+        self.assertEqual(self._key(params={"a": "1", "_lastUpdated": ["gt2020"]}),
+                         self._key(params={"_lastUpdated": ["gt2020"], "a": "1"}))
+
+    def test_key_by_forwarded_host(self):
+        # The Bundle links are rewritten with the host the request came through
+        self.assertNotEqual(self._key(), self._key(forwarded=("https", "api.bluebutton.cms.gov")))
+
+    def test_hit_and_miss(self):
+        key = self._key()
+        self.assertIsNone(self.cache.get(key))
+        self.cache.set(key, {"id": "-20140000008325"}, 10)
+        self.assertEqual(self.cache.get(key), {"id": "-20140000008325"})
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_expired(self):
+        key = self._key()
+        with patch("apps.fhir.bluebutton.cache.time.monotonic", return_value=0):
+            self.cache.set(key, {}, 10)
+        with patch("apps.fhir.bluebutton.cache.time.monotonic", return_value=61):
+            self.assertIsNone(self.cache.get(key))
+
+    def test_lru_eviction_by_size(self):
+        first, second, third = self._key("1"), self._key("2"), self._key("3")
+        self.cache.set(first, {}, 40)
+        self.cache.set(second, {}, 40)
+        self.cache.get(first)
+        self.cache.set(third, {}, 40)
+        self.assertIsNotNone(self.cache.get(first))
+        self.assertIsNone(self.cache.get(second))
+        self.assertIsNotNone(self.cache.get(third))
+
+    def test_invalidate_beneficiary(self):
+        patient, coverage, other = self._key("1"), self._key("1", "Coverage"), self._key("2")
+        for key in (patient, coverage, other):
+            self.cache.set(key, {}, 10)
+        self.cache.invalidate("1")
+        self.assertIsNone(self.cache.get(patient))
+        self.assertIsNone(self.cache.get(coverage))
+        self.assertIsNotNone(self.cache.get(other))
+
+    def test_invalidate_other_workers(self):
+        worker, other_worker = ResponseCache(), ResponseCache()
+        key = self._key("1")
+        other_worker.set(key, {}, 10)
+        worker.invalidate("1")
+        # The other worker's key for the beneficiary changed with the stamp
+        self.assertNotEqual(self._key("1"), key)
+        self.assertIsNone(other_worker.get(self._key("1")))
+
+
+@override_settings(FHIR_RESPONSE_CACHE_ENABLED=True,
+                   FHIR_RESPONSE_CACHE_MAX_BYTES=100,
+                   FHIR_RESPONSE_CACHE_TTLS={"Patient": 60})
+class TestResponseCacheInvalidation(TestCase):
+
+    def setUp(self):
+        caches["tiered"].clear()
+        self.cache = ResponseCache()
+
+    def _key(self):
+        return self.cache.make_key("1", "Patient", 1, "https://fhir.example.com/v1/fhir/Patient/", {})
+
+    def test_invalidate_on_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.cache.invalidate("1")
+            # Cached by a request before the revocation is committed
+            self.cache.set(self._key(), {}, 10)
+        self.assertIsNone(self.cache.get(self._key()))
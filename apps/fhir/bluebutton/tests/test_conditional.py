@@ -0,0 +1,96 @@
+import uuid
+
+from django.test.client import Client
+from django.urls import reverse
+from httmock import all_requests, HTTMock
+from unittest.mock import patch
+
+from apps.fhir.server.settings import fhir_settings
+from apps.test import BaseApiTest
+from apps.mymedicare_cb.tests.responses import patient_response
+
+
+PATIENT = {
+    "resourceType": "Patient",
+    "id": "-20140000008325",
+    "meta": {"lastUpdated": "2021-05-10T16:23:36.000+00:00"},
+}
+
+
+class ConditionalRequestTest(BaseApiTest):
+
+    def setUp(self):
+        self.read_capability = self._create_capability('Read', [])
+        self.write_capability = self._create_capability('Write', [])
+        self._create_capability('patient', [
+            ["GET", r"\/v1\/fhir\/Patient\/\-\d+"],
+            ["GET", "/v1/fhir/Patient"],
+        ])
+        self.client = Client()
+        self.access_token = self.create_token('John', 'Smith')
+
+    def _read(self, **headers):
+        return self.client.get(
+            reverse('bb_oauth_fhir_patient_read_or_update_or_delete',
+                    kwargs={'resource_id': '-20140000008325'}),
+            Authorization="Bearer %s" % self.access_token, **headers)
+
+    def _search(self, **headers):
+        return self.client.get(
+            reverse('bb_oauth_fhir_patient_search'),
+            Authorization="Bearer %s" % self.access_token, **headers)
+
+    def test_read_not_modified(self):
+        @all_requests
+        def catchall(url, req):
+            return {'status_code': 200, 'content': PATIENT}
+
+        with HTTMock(catchall):
+            response = self._read()
+            self.assertEqual(response.status_code, 200)
+            etag = response['ETag']
+            self.assertFalse(etag.startswith('W/'))
+            self.assertEqual(response['Last-Modified'], 'Mon, 10 May 2021 16:23:36 GMT')
+
+            response = self._read(HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response['ETag'], etag)
+
+            response = self._read(HTTP_IF_MODIFIED_SINCE='Mon, 10 May 2021 16:23:36 GMT')
+            self.assertEqual(response.status_code, 304)
+
+            response = self._read(HTTP_IF_NONE_MATCH='"stale"')
+            self.assertEqual(response.status_code, 200)
+
+    def test_backend_etag_passed_through(self):
+        @all_requests
+        def catchall(url, req):
+            return {'status_code': 200, 'content': PATIENT, 'headers': {'ETag': 'W/"3"'}}
+
+        with HTTMock(catchall):
+            response = self._read()
+            self.assertEqual(response['ETag'], 'W/"3"')
+            self.assertEqual(self._read(HTTP_IF_NONE_MATCH='W/"3"').status_code, 304)
+
+    def test_search_etag_ignores_bundle_id(self):
+        @all_requests
+        def catchall(url, req):
+            # BFD assigns a new id to every search bundle
+            return {'status_code': 200, 'content': {**patient_response, 'id': str(uuid.uuid4())}}
+
+        with HTTMock(catchall):
+            etag = self._search()['ETag']
+            self.assertTrue(etag.startswith('W/'))
+            self.assertEqual(self._search(HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+    @patch.object(fhir_settings, 'forward_conditional_headers', True, create=True)
+    def test_search_backend_not_modified(self):
+        @all_requests
+        def catchall(url, req):
+            self.assertEqual(req.headers['If-None-Match'], 'W/"7"')
+            return {'status_code': 304, 'headers': {'ETag': 'W/"7"'}}
+
+        with HTTMock(catchall):
+            response = self._search(HTTP_IF_NONE_MATCH='W/"7"')
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response['ETag'], 'W/"7"')
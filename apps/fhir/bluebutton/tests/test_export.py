@@ -0,0 +1,199 @@
+import json
+import os
+import shutil
+import stat
+import tempfile
+
+from datetime import timedelta
+from django.test.client import Client
+from django.utils import timezone
+from django.test.utils import override_settings
+from django.urls import reverse
+from httmock import all_requests, HTTMock
+from unittest.mock import patch
+from urllib.parse import parse_qs
+from waffle.testutils import override_switch
+
+from apps.test import BaseApiTest
+from apps.authorization.models import DataAccessGrant
+from apps.fhir.bluebutton.export import claim_job, file_path, job_dir, purge_expired_jobs, run_job
+from apps.fhir.bluebutton.models import ExportJob
+
+
+FHIR_ID = '-20140000008325'
+
+
+def eob_page(start_index, total):
+    return {
+        'resourceType': 'Bundle',
+        'total': total,
+        'entry': [{'resource': {'resourceType': 'ExplanationOfBenefit',
+                                'id': str(i),
+                                'patient': {'reference': 'Patient/' + FHIR_ID}}}
+                  for i in range(start_index, min(start_index + 50, total))],
+    }
+
+
+@override_switch('fhir_bulk_export', active=True)
+class ExportTest(BaseApiTest):
+
+    def setUp(self):
+        self.read_capability = self._create_capability('Read', [])
+        self.write_capability = self._create_capability('Write', [])
+        self.client = Client()
+        self.access_token = self.create_token('John', 'Smith')
+        self.storage_dir = tempfile.mkdtemp()
+        storage = override_settings(FHIR_EXPORT_STORAGE_DIR=self.storage_dir)
+        storage.enable()
+        self.addCleanup(storage.disable)
+        self.addCleanup(shutil.rmtree, self.storage_dir, True)
+
+    def _get(self, url, params=None, **extra):
+        return self.client.get(url, params, Authorization="Bearer %s" % self.access_token, **extra)
+
+    def _kick_off(self, **params):
+        return self._get(reverse('bb_oauth_fhir_patient_export'), params, HTTP_PREFER='respond-async')
+
+    def test_kick_off_requires_respond_async(self):
+        response = self._get(reverse('bb_oauth_fhir_patient_export'))
+        self.assertEqual(response.status_code, 400)
+
+    def test_kick_off_invalid_type(self):
+        self.assertEqual(self._kick_off(_type='Organization').status_code, 400)
+
+    @override_switch('fhir_bulk_export', active=False)
+    def test_export_disabled(self):
+        self.assertEqual(self._kick_off().status_code, 404)
+
+    def test_export(self):
+        response = self._kick_off(_type='ExplanationOfBenefit')
+        self.assertEqual(response.status_code, 202)
+        status_url = response['Content-Location']
+
+        # One export at a time
+        self.assertEqual(self._kick_off().status_code, 429)
+        self.assertEqual(self._get(status_url).status_code, 202)
+
+        @all_requests
+        def catchall(url, req):
+            start_index = int(parse_qs(url.query)['startIndex'][0])
+            self.assertIn('ExplanationOfBenefit', url.path)
+            self.assertEqual(req.headers['BlueButton-BeneficiaryId'], 'patientId:' + FHIR_ID)
+            return {'status_code': 200, 'content': eob_page(start_index, 120)}
+
+        with HTTMock(catchall):
+            run_job(claim_job())
+        self.assertIsNone(claim_job())
+
+        job = ExportJob.objects.get()
+        self.assertEqual(stat.S_IMODE(os.stat(job_dir(job)).st_mode), 0o700)
+        self.assertEqual(stat.S_IMODE(os.stat(file_path(job, 'ExplanationOfBenefit')).st_mode), 0o600)
+
+        response = self._get(status_url)
+        self.assertEqual(response.status_code, 200)
+        manifest = response.json()
+        self.assertTrue(manifest['requiresAccessToken'])
+        self.assertEqual(manifest['output'][0]['type'], 'ExplanationOfBenefit')
+        self.assertEqual(manifest['output'][0]['count'], 120)
+
+        response = self._get(manifest['output'][0]['url'], HTTP_ACCEPT='application/fhir+ndjson')
+        self.assertEqual(response.status_code, 200)
+        lines = b''.join(response.streaming_content).splitlines()
+        self.assertEqual([json.loads(line)['id'] for line in lines], [str(i) for i in range(120)])
+
+        response = self.client.delete(status_url, Authorization="Bearer %s" % self.access_token)
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(self._get(status_url).status_code, 404)
+        self.assertFalse(os.listdir(self.storage_dir))
+
+    def test_kick_off_locks_grant(self):
+        # Concurrent kick-offs wait for the grant's lock, then see the active job
+        grants = DataAccessGrant.objects
+        with patch.object(grants, 'select_for_update', wraps=grants.select_for_update) as lock:
+            self.assertEqual(self._kick_off().status_code, 202)
+            self.assertEqual(self._kick_off().status_code, 429)
+        self.assertEqual(lock.call_count, 2)
+        self.assertEqual(ExportJob.objects.count(), 1)
+
+    def test_export_resumes_after_failure(self):
+        self.assertEqual(self._kick_off(_type='ExplanationOfBenefit').status_code, 202)
+        calls = []
+
+        @all_requests
+        def failing(url, req):
+            start_index = int(parse_qs(url.query)['startIndex'][0])
+            calls.append(start_index)
+            if start_index == 50 and calls.count(50) == 1:
+                return {'status_code': 500, 'content': ''}
+            return {'status_code': 200, 'content': eob_page(start_index, 120)}
+
+        with HTTMock(failing):
+            run_job(claim_job())
+            job = ExportJob.objects.get()
+            self.assertEqual(job.status, ExportJob.STATUS_QUEUED)
+            self.assertEqual(job.attempts, 1)
+            self.assertEqual(job.progress['ExplanationOfBenefit']['count'], 50)
+
+            run_job(claim_job())
+
+        job = ExportJob.objects.get()
+        self.assertEqual(job.status, ExportJob.STATUS_COMPLETED)
+        # The first page is not fetched again
+        self.assertEqual(calls, [0, 50, 50, 100])
+
+        response = self._get(reverse('bb_oauth_fhir_export_file',
+                                     kwargs={'job_id': job.id, 'resource_type': 'ExplanationOfBenefit'}))
+        lines = b''.join(response.streaming_content).splitlines()
+        self.assertEqual(len(lines), 120)
+
+    def test_other_application_cannot_poll(self):
+        self.assertEqual(self._kick_off().status_code, 202)
+        job = ExportJob.objects.get()
+
+        self.access_token = self.create_token('Jane', 'Doe')
+        response = self._get(reverse('bb_oauth_fhir_export_status', kwargs={'job_id': job.id}))
+        self.assertEqual(response.status_code, 404)
+
+    def test_grant_removed_cancels_queued_job(self):
+        self.assertEqual(self._kick_off().status_code, 202)
+        DataAccessGrant.objects.all().delete()
+        self.assertEqual(ExportJob.objects.get().status, ExportJob.STATUS_CANCELLED)
+        self.assertIsNone(claim_job())
+
+    def test_grant_expired_stops_running_job(self):
+        self.assertEqual(self._kick_off(_type='ExplanationOfBenefit').status_code, 202)
+        calls = []
+
+        @all_requests
+        def expiring(url, req):
+            start_index = int(parse_qs(url.query)['startIndex'][0])
+            calls.append(start_index)
+            DataAccessGrant.objects.update(expiration_date=timezone.now())
+            return {'status_code': 200, 'content': eob_page(start_index, 120)}
+
+        with HTTMock(expiring):
+            run_job(claim_job())
+
+        self.assertEqual(calls, [0])
+        job = ExportJob.objects.get()
+        self.assertEqual(job.status, ExportJob.STATUS_CANCELLED)
+        self.assertFalse(os.listdir(self.storage_dir))
+
+    @override_settings(FHIR_EXPORT_RETENTION=3600)
+    def test_purge_expired_jobs(self):
+        self.assertEqual(self._kick_off(_type='Patient').status_code, 202)
+
+        @all_requests
+        def catchall(url, req):
+            return {'status_code': 200, 'content': {'resourceType': 'Bundle', 'total': 0, 'entry': []}}
+
+        with HTTMock(catchall):
+            run_job(claim_job())
+        job = ExportJob.objects.get()
+        self.assertTrue(os.path.exists(job_dir(job)))
+
+        self.assertEqual(purge_expired_jobs(), 0)
+        ExportJob.objects.update(completed_at=timezone.now() - timedelta(hours=2))
+        self.assertEqual(purge_expired_jobs(), 1)
+        self.assertFalse(ExportJob.objects.exists())
+        self.assertFalse(os.listdir(self.storage_dir))
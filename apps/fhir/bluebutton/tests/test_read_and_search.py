@@ -1,19 +1,34 @@
+import asyncio
 import json
 import apps.fhir.bluebutton.utils
 import apps.fhir.bluebutton.views.home
 
+from asgiref.sync import async_to_sync
+from functools import partial
 from django.conf import settings
-from django.test import TestCase, RequestFactory
+from django.test import TestCase, RequestFactory, override_settings
 from django.test.client import Client
 from django.urls import reverse
+from django.utils.asyncio import async_unsafe
 from httmock import all_requests, HTTMock, urlmatch
 from oauth2_provider.models import get_access_token_model
-from urllib.parse import unquote
+from urllib.parse import parse_qs, unquote
+from unittest import skipIf
 from unittest.mock import patch
 
 from apps.test import BaseApiTest
+from apps.dot_ext.activity import ApplicationActivityTracker
+from apps.dot_ext.token_cache import get_cached_token
+from apps.fhir.server.client import httpx
 from apps.mymedicare_cb.tests.responses import patient_response
-from apps.fhir.bluebutton.views.home import (conformance_filter)
+from apps.fhir.bluebutton.cache import ResponseCache, response_cache
+from apps.fhir.bluebutton.signals import post_fetch
+from apps.fhir.bluebutton.views.home import (capability_statement_cache,
+                                             conformance_filter,
+                                             fhir_conformance)
+from apps.fhir.bluebutton.views.read import AsyncReadViewPatient
+from apps.fhir.bluebutton.views.search import AsyncSearchViewExplanationOfBenefit
+from apps.logging.timing import PhaseTimer
 # Get the pre-defined Conformance statement
 from .data_conformance import CONFORMANCE
 
@@ -69,11 +84,11 @@ class ConformanceReadRequestTest(TestCase):
         self.factory = RequestFactory()
         self.client = Client()
 
-    @patch('apps.fhir.bluebutton.utils.requests')
+    @patch('apps.fhir.bluebutton.utils.backend_client')
     def test_fhir_bluebutton_read_conformance_testcase(self, mock_requests):
         """ Checking Conformance
 
-            The @patch replaces the call to requests with mock_requests
+            The @patch replaces the shared backend client with mock_requests
 
         """
 
@@ -84,7 +99,7 @@ class ConformanceReadRequestTest(TestCase):
         mock_requests.get.return_value.status_code = 200
         mock_requests.get.return_value.content = CONFORMANCE
 
-        # Make the call to request_call which uses requests.get
+        # Make the call to request_call which uses backend_client.get
         # patch will intercept the call to requests.get and
         # return the pre-defined values
         result = apps.fhir.bluebutton.utils.request_call(request,
@@ -108,6 +123,45 @@ class ConformanceReadRequestTest(TestCase):
         self.assertEqual(filter_works, True)
 
 
+@override_settings(FHIR_CONFORMANCE_REFRESH_INTERVAL=300)
+@patch('apps.fhir.bluebutton.views.home.CapabilityStatementCache._start_refresher')
+@patch('apps.fhir.bluebutton.views.home.backend_client')
+class CachedConformanceTest(TestCase):
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        capability_statement_cache.clear()
+
+    def tearDown(self):
+        capability_statement_cache.clear()
+
+    def test_statement_served_from_cache(self, mock_client, mock_start):
+        mock_client.get.return_value.status_code = 200
+        mock_client.get.return_value.text = CONFORMANCE
+
+        response = fhir_conformance(self.factory.get('/v1/fhir/metadata'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['rest'][0]['security']['cors'], True)
+        self.assertIn('max-age=300', response['Cache-Control'])
+        etag = response['ETag']
+
+        response = fhir_conformance(self.factory.get('/v1/fhir/metadata', HTTP_IF_NONE_MATCH=etag))
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(mock_client.get.call_count, 1)
+
+    def test_failed_refresh_keeps_last_copy(self, mock_client, mock_start):
+        mock_client.get.return_value.status_code = 200
+        mock_client.get.return_value.text = CONFORMANCE
+        content = fhir_conformance(self.factory.get('/v1/fhir/metadata')).content
+
+        mock_client.get.return_value.status_code = 503
+        self.assertIsNone(capability_statement_cache.refresh(False))
+
+        response = fhir_conformance(self.factory.get('/v1/fhir/metadata'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, content)
+
+
 class ThrottleReadRequestTest(BaseApiTest):
 
     def setUp(self):
@@ -649,6 +703,45 @@ class BackendConnectionTest(BaseApiTest):
 
             self.assertEqual(response.status_code, 200)
 
+    def test_search_eob_all_pages(self):
+        first_access_token = self.create_token('John', 'Smith')
+        start_indexes = []
+
+        @all_requests
+        def catchall(url, req):
+            query = parse_qs(url.query)
+            start_index = int(query['startIndex'][0])
+            start_indexes.append(start_index)
+            self.assertEqual(query['_count'], ['50'])
+            self.assertNotIn('_pages', query)
+            return {
+                'status_code': 200,
+                'content': {
+                    'resourceType': 'Bundle',
+                    'total': 120,
+                    'entry': [{'resource': {'resourceType': 'ExplanationOfBenefit', 'id': str(i)}}
+                              for i in range(start_index, min(start_index + 50, 120))],
+                },
+            }
+
+        with HTTMock(catchall):
+            response = self.client.get(reverse('bb_oauth_fhir_eob_search'),
+                                       {'_pages': 'all'},
+                                       Authorization="Bearer %s" % (first_access_token))
+            self.assertEqual(response.status_code, 200)
+            bundle = json.loads(b''.join(response.streaming_content))
+
+            response = self.client.get(reverse('bb_oauth_fhir_eob_search'),
+                                       {'_pages': 'all', '_outputFormat': 'ndjson'},
+                                       Authorization="Bearer %s" % (first_access_token))
+            self.assertEqual(response['Content-Type'], 'application/fhir+ndjson')
+            lines = b''.join(response.streaming_content).splitlines()
+
+        self.assertEqual(bundle['total'], 120)
+        self.assertEqual([e['resource']['id'] for e in bundle['entry']], [str(i) for i in range(120)])
+        self.assertEqual([json.loads(line)['id'] for line in lines], [str(i) for i in range(120)])
+        self.assertEqual(sorted(start_indexes), [0, 0, 50, 50, 100, 100])
+
     def test_read_coverage_request(self):
         self._read_coverage_request(False)
 
@@ -761,6 +854,61 @@ class BackendConnectionTest(BaseApiTest):
         # Check that application last_active was updated
         self.assertNotEqual(application.last_active, prev_last_active)
 
+    @override_settings(APPLICATION_ACTIVITY_FLUSH_INTERVAL=60)
+    @patch('apps.fhir.bluebutton.authentication.activity_tracker', new_callable=ApplicationActivityTracker)
+    def test_application_activity_write_behind(self, tracker):
+        first_access_token = self.create_token('John', 'Smith')
+        application = AccessToken.objects.get(token=first_access_token).application
+
+        @all_requests
+        def catchall(url, req):
+            return {
+                'status_code': 200,
+                'content': {"resourceType": "Patient", "id": "-20140000008325"},
+            }
+
+        with HTTMock(catchall):
+            for _ in range(2):
+                response = self.client.get(
+                    reverse('bb_oauth_fhir_patient_read_or_update_or_delete',
+                            kwargs={'resource_id': '-20140000008325'}),
+                    Authorization="Bearer %s" % (first_access_token))
+                self.assertEqual(response.status_code, 200)
+
+        # Buffered until the flush interval, one write for both calls
+        application.refresh_from_db()
+        self.assertIsNone(application.first_active)
+        self.assertEqual(tracker.flush(), 1)
+        application.refresh_from_db()
+        self.assertIsNotNone(application.first_active)
+        self.assertGreater(application.last_active, application.first_active)
+
+    @override_settings(ACCESS_TOKEN_CACHE_TTL=300)
+    def test_revoked_token_while_cached(self):
+        first_access_token = self.create_token('John', 'Smith')
+        url = reverse('bb_oauth_fhir_patient_read_or_update_or_delete',
+                      kwargs={'resource_id': '-20140000008325'})
+
+        @all_requests
+        def catchall(url, req):
+            return {
+                'status_code': 200,
+                'content': {"resourceType": "Patient", "id": "-20140000008325"},
+            }
+
+        with HTTMock(catchall):
+            # Authenticated from the database, then from the token cache
+            response = self.client.get(url, Authorization="Bearer %s" % (first_access_token))
+            self.assertEqual(response.status_code, 200)
+            self.assertIsNotNone(get_cached_token(first_access_token))
+            response = self.client.get(url, Authorization="Bearer %s" % (first_access_token))
+            self.assertEqual(response.status_code, 200)
+
+            with self.captureOnCommitCallbacks(execute=True):
+                AccessToken.objects.get(token=first_access_token).revoke()
+            response = self.client.get(url, Authorization="Bearer %s" % (first_access_token))
+            self.assertEqual(response.status_code, 401)
+
     def test_permission_deny_fhir_request_on_disabled_app_org(self):
         self._permission_deny_fhir_request_on_disabled_app_org(False)
 
@@ -838,3 +986,133 @@ class BackendConnectionTest(BaseApiTest):
         # set app user back to active - not to affect subsequent tests
         application.active = True
         application.save()
+
+
+class AsyncBackendConnectionTest(BaseApiTest):
+
+    def setUp(self):
+        self.read_capability = self._create_capability('Read', [])
+        self.write_capability = self._create_capability('Write', [])
+        self._create_capability('patient', [
+            ["GET", r"\/v1\/fhir\/Patient\/\-\d+"],
+            ["GET", "/v1/fhir/Patient"],
+        ])
+        self.factory = RequestFactory()
+
+    # Without httpx the async views fall back to the pooled requests session
+    @patch('apps.fhir.server.client.httpx', None)
+    def test_async_read_request(self):
+        first_access_token = self.create_token('John', 'Smith')
+        expected_request = get_expected_read_request('v1')
+        fetched = []
+
+        @all_requests
+        def catchall(url, req):
+            self.assertEqual(expected_request['url'], unquote(req.url))
+            self.assertDictContainsSubset(expected_request['headers'], req.headers)
+            return {
+                'status_code': 200,
+                'content': {"resourceType": "Patient", "id": "-20140000008325"},
+            }
+
+        def on_post_fetch(sender, response=None, **kwargs):
+            fetched.append(response.status_code)
+
+        post_fetch.connect(on_post_fetch)
+        view = AsyncReadViewPatient.as_view(version=1)
+        self.assertTrue(asyncio.iscoroutinefunction(view))
+        request = self.factory.get('/v1/fhir/Patient/-20140000008325',
+                                   HTTP_AUTHORIZATION="Bearer %s" % (first_access_token))
+        request._phase_timer = PhaseTimer()
+        with HTTMock(catchall):
+            response = async_to_sync(view)(request, resource_id='-20140000008325')
+            response.render()
+        post_fetch.disconnect(on_post_fetch)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['id'], "-20140000008325")
+        self.assertEqual(fetched, [200])
+        self.assertIn("logging", request._phase_timer.phases)
+
+    @skipIf(httpx is None, "httpx is not installed")
+    def test_async_read_request_httpx(self):
+        access_token = self.create_token('John', 'Smith')
+        expected_request = get_expected_read_request('v1')
+        requested = []
+
+        def handler(req):
+            requested.append(req)
+            return httpx.Response(200, json={"resourceType": "Patient", "id": "-20140000008325"})
+
+        view = AsyncReadViewPatient.as_view(version=1)
+        request = self.factory.get('/v1/fhir/Patient/-20140000008325',
+                                   HTTP_AUTHORIZATION="Bearer %s" % (access_token))
+        with patch('apps.fhir.server.client.httpx.AsyncClient',
+                   partial(httpx.AsyncClient, transport=httpx.MockTransport(handler))):
+            response = async_to_sync(view)(request, resource_id='-20140000008325')
+            response.render()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['id'], "-20140000008325")
+        self.assertEqual(expected_request['url'], unquote(str(requested[0].url)))
+
+    # The stamps of the response cache are read from the shared cache, a database under ASGI
+    @override_settings(FHIR_RESPONSE_CACHE_ENABLED=True, FHIR_RESPONSE_CACHE_TTLS={"Patient": 300})
+    @patch('apps.fhir.server.client.httpx', None)
+    @patch.object(ResponseCache, 'stamp', async_unsafe(ResponseCache.stamp))
+    def test_async_read_cached(self):
+        access_token = self.create_token('John', 'Smith')
+        response_cache.clear()
+        self.addCleanup(response_cache.clear)
+        calls = []
+
+        @all_requests
+        def catchall(url, req):
+            calls.append(url)
+            return {
+                'status_code': 200,
+                'content': {"resourceType": "Patient", "id": "-20140000008325"},
+            }
+
+        view = AsyncReadViewPatient.as_view(version=1)
+        with HTTMock(catchall):
+            for _ in range(2):
+                request = self.factory.get('/v1/fhir/Patient/-20140000008325',
+                                           HTTP_AUTHORIZATION="Bearer %s" % (access_token))
+                response = async_to_sync(view)(request, resource_id='-20140000008325')
+                response.render()
+                self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(calls), 1)
+
+    @patch('apps.fhir.server.client.httpx', None)
+    def test_async_search_eob_all_pages(self):
+        self._create_capability('eob', [
+            ["GET", "/v1/fhir/ExplanationOfBenefit"],
+        ])
+        access_token = self.create_token('John', 'Smith')
+        start_indexes = []
+
+        @all_requests
+        def catchall(url, req):
+            start_index = int(parse_qs(url.query)['startIndex'][0])
+            start_indexes.append(start_index)
+            return {
+                'status_code': 200,
+                'content': {
+                    'resourceType': 'Bundle',
+                    'total': 120,
+                    'entry': [{'resource': {'resourceType': 'ExplanationOfBenefit', 'id': str(i)}}
+                              for i in range(start_index, min(start_index + 50, 120))],
+                },
+            }
+
+        view = AsyncSearchViewExplanationOfBenefit.as_view(version=1)
+        request = self.factory.get('/v1/fhir/ExplanationOfBenefit', {'_pages': 'all'},
+                                   HTTP_AUTHORIZATION="Bearer %s" % (access_token))
+        with HTTMock(catchall):
+            response = async_to_sync(view)(request)
+        # Fetched before the response is handed to the event loop
+        self.assertEqual(sorted(start_indexes), [0, 50, 100])
+        self.assertEqual(response.status_code, 200)
+        bundle = json.loads(b''.join(response.streaming_content))
+        self.assertEqual([e['resource']['id'] for e in bundle['entry']], [str(i) for i in range(120)])
@@ -0,0 +1,74 @@
+import json
+
+from django.test import SimpleTestCase
+from rest_framework import exceptions
+
+from apps.authorization.permissions import is_resource_for_patient
+from apps.fhir.bluebutton.streaming import FhirStreamError, FhirStreamValidator
+
+
+def eob(patient_id):
+    return {
+        "resourceType": "ExplanationOfBenefit",
+        "id": "carrier-1",
+        "patient": {"reference": "Patient/{}".format(patient_id), "display": "a \"}] b"},
+        "item": [{"sequence": 1, "adjudication": [{"amount": {"value": 1.5}}]}],
+    }
+
+
+def bundle(*patient_ids):
+    return {
+        "resourceType": "Bundle",
+        "total": len(patient_ids),
+        "link": [{"relation": "self", "url": "https://example.com/v1/fhir/ExplanationOfBenefit"}],
+        "entry": [{"resource": eob(patient_id)} for patient_id in patient_ids],
+    }
+
+
+class TestFhirStreamValidator(SimpleTestCase):
+
+    def _stream(self, body, chunk_size=7, patient_id="-20140000008325"):
+        validator = FhirStreamValidator(lambda obj: is_resource_for_patient(obj, patient_id))
+        out = b''
+        for i in range(0, len(body), chunk_size):
+            out += validator.feed(body[i:i + chunk_size])
+        return out + validator.close()
+
+    def test_bundle_passes_through_unchanged(self):
+        body = json.dumps(bundle("-20140000008325", "-20140000008325"), indent=2).encode("utf-8")
+        self.assertEqual(self._stream(body), body)
+
+    def test_single_resource_passes_through_unchanged(self):
+        body = json.dumps(eob("-20140000008325")).encode("utf-8")
+        self.assertEqual(self._stream(body), body)
+
+    def test_bundle_entries_released_after_check(self):
+        body = json.dumps(bundle("-20140000008325", "-20140000008325")).encode("utf-8")
+        validator = FhirStreamValidator(lambda obj: None)
+        first_entry_end = body.index(b'}]}}') + 4
+        out = validator.feed(body[:first_entry_end - 1])
+        self.assertLessEqual(len(out), body.index(b'"entry"') + 10)
+        out += validator.feed(body[first_entry_end - 1:first_entry_end])
+        self.assertEqual(out, body[:first_entry_end])
+
+    def test_mismatched_entry_not_released(self):
+        body = json.dumps(bundle("-20140000008325", "-99999")).encode("utf-8")
+        validator = FhirStreamValidator(lambda obj: is_resource_for_patient(obj, "-20140000008325"))
+        out = b''
+        with self.assertRaises(exceptions.NotFound):
+            for i in range(0, len(body), 5):
+                out += validator.feed(body[i:i + 5])
+        self.assertNotIn(b'-99999', out)
+
+    def test_mismatched_single_resource_not_released(self):
+        body = json.dumps(eob("-99999")).encode("utf-8")
+        validator = FhirStreamValidator(lambda obj: is_resource_for_patient(obj, "-20140000008325"))
+        with self.assertRaises(exceptions.NotFound):
+            validator.feed(body)
+
+    def test_truncated_body(self):
+        body = json.dumps(bundle("-20140000008325")).encode("utf-8")
+        validator = FhirStreamValidator(lambda obj: None)
+        validator.feed(body[:-3])
+        with self.assertRaises(FhirStreamError):
+            validator.close()
@@ -3,8 +3,11 @@ import uuid
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.test import TestCase, RequestFactory
+from oauth2_provider.models import AccessToken
+from rest_framework.request import Request
 from apps.accounts.models import UserProfile
 from apps.test import BaseApiTest
+from apps.fhir.bluebutton.authentication import OAuth2ResourceOwner
 from apps.fhir.bluebutton.models import Crosswalk
 
 from apps.fhir.bluebutton.utils import (
@@ -17,6 +20,7 @@ from apps.fhir.bluebutton.utils import (
     crosswalk_patient_id,
     get_resourcerouter,
     build_oauth_resource,
+    generate_info_headers,
 )
 
 ENCODED = settings.ENCODING
@@ -316,3 +320,32 @@ class Security_Metadata_test(BaseApiTest):
         # print(result[16:33])
 
         self.assertEqual(result[16:33], expected)
+
+
+class AuthContextTest(BaseApiTest):
+
+    def setUp(self):
+        self.read_capability = self._create_capability('Read', [])
+        self.write_capability = self._create_capability('Write', [])
+
+    def test_auth_context(self):
+        token = self.create_token('John', 'Smith')
+        at = AccessToken.objects.get(token=token)
+        request = Request(RequestFactory().get('/v1/fhir/Patient/', HTTP_AUTHORIZATION='Bearer ' + token))
+
+        user, access_token = OAuth2ResourceOwner().authenticate(request)
+        auth_context = request._request.auth_context
+        self.assertEqual(access_token, at)
+        self.assertEqual(user, at.user)
+        self.assertEqual(auth_context.application, at.application)
+        self.assertEqual(auth_context.developer, at.application.user)
+        self.assertEqual(auth_context.crosswalk, at.user.crosswalk)
+        self.assertEqual(request.crosswalk, at.user.crosswalk)
+
+        # Headers are built from the auth context without a query
+        request.resource_owner = user
+        with self.assertNumQueries(0):
+            headers = generate_info_headers(request)
+        self.assertEqual(headers['BlueButton-BeneficiaryId'], 'patientId:' + at.user.crosswalk.fhir_id)
+        self.assertEqual(headers['BlueButton-ApplicationId'], str(at.application.id))
+        self.assertEqual(headers['BlueButton-DeveloperId'], str(at.application.user.id))
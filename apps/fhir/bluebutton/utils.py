@@ -13,6 +13,7 @@ from pytz import timezone
 
 from django.conf import settings
 from django.contrib import messages
+from apps.fhir.server.client import backend_client
 from apps.fhir.server.settings import fhir_settings
 
 from oauth2_provider.models import AccessToken
@@ -34,6 +35,11 @@ def get_user_from_request(request):
     return user
 
 
+def get_auth_context(request):
+    """Returns the AuthContext of an OAuth2 API request or None"""
+    return getattr(request, 'auth_context', None)
+
+
 def get_ip_from_request(request):
 
     """Returns the IP of the request, accounting for the possibility of being
@@ -143,7 +149,8 @@ def generate_info_headers(request):
 
     # Return resource_owner or user
     user = get_user_from_request(request)
-    crosswalk = get_crosswalk(user)
+    auth_context = get_auth_context(request)
+    crosswalk = auth_context.crosswalk if auth_context else get_crosswalk(user)
     if crosswalk:
         # we need to send the HicnHash or the fhir_id
         # TODO: Can the hicnHash case ever be reached? Should refactor this!
@@ -160,8 +167,12 @@ def generate_info_headers(request):
         # result['BlueButton-User'] = str(user)
         result['BlueButton-Application'] = ""
         result['BlueButton-ApplicationId'] = ""
-        if AccessToken.objects.filter(token=get_access_token_from_request(request)).exists():
-            at = AccessToken.objects.get(token=get_access_token_from_request(request))
+        if auth_context:
+            at = auth_context.access_token
+        else:
+            at = AccessToken.objects.select_related('application__user').filter(
+                token=get_access_token_from_request(request)).first()
+        if at is not None:
             result['BlueButton-Application'] = str(at.application.name)
             result['BlueButton-ApplicationId'] = str(at.application.id)
             result['BlueButton-DeveloperId'] = str(at.application.user.id)
@@ -207,33 +218,16 @@ def request_call(request, call_url, crosswalk=None, timeout=None, get_parameters
     """  call to request or redirect on fail
     call_url = target server URL and search parameters to be sent
     crosswalk = Crosswalk record. The crosswalk is keyed off Request.user
-    timeout allows a timeout in seconds to be set.
+    timeout allows a timeout in seconds to be set,
+       defaults to the FHIR_SERVER WAIT_TIME setting.
 
-    FhirServer is joined to Crosswalk.
-    FhirServerAuth and FhirServerVerify receive crosswalk and lookup
-       values in the linked fhir_server model.
+    The call goes through the shared backend_client connection pool,
+       which holds the client cert and verify settings.
 
     """
 
     logger_perf = bb2logging.getLogger(bb2logging.PERFORMANCE_LOGGER, request)
 
-    # Updated to receive crosswalk (Crosswalk entry for user)
-    # call FhirServer_Auth(crosswalk) to get authentication
-    auth_state = FhirServerAuth(crosswalk)
-
-    verify_state = FhirServerVerify(crosswalk)
-    if auth_state['client_auth']:
-        # cert puts cert and key file together
-        # (cert_file_path, key_file_path)
-        # Cert_file_path and key_file_ath are fully defined paths to
-        # files on the appserver.
-        logger.debug('Cert:%s , Key:%s' % (auth_state['cert_file'],
-                                           auth_state['key_file']))
-
-        cert = (auth_state['cert_file'], auth_state['key_file'])
-    else:
-        cert = ()
-
     header_info = generate_info_headers(request)
 
     header_info = set_default_header(request, header_info)
@@ -246,19 +240,11 @@ def request_call(request, call_url, crosswalk=None, timeout=None, get_parameters
     logger_perf.info(header_detail)
 
     try:
-        if timeout:
-            r = requests.get(call_url,
-                             cert=cert,
-                             params=get_parameters,
-                             timeout=timeout,
-                             headers=header_info,
-                             verify=verify_state)
-        else:
-            r = requests.get(call_url,
-                             cert=cert,
-                             params=get_parameters,
-                             headers=header_info,
-                             verify=verify_state)
+        # Cert and verify settings come from the shared backend client
+        r = backend_client.get(call_url,
+                               params=get_parameters,
+                               timeout=timeout,
+                               headers=header_info)
 
         logger.debug("Request.get:%s" % call_url)
         logger.debug("Status of Request:%s" % r.status_code)
@@ -668,15 +654,12 @@ def get_patient_by_id(id, request):
     a helper adapted to just get patient given an id out of band of auth flow
     or noraml data flow, use by tools such as BB2-Tools admin viewers
     '''
-    auth_settings = FhirServerAuth(None)
-    certs = (auth_settings['cert_file'], auth_settings['key_file'])
     headers = generate_info_headers(request)
     headers['BlueButton-Application'] = "BB2-Tools"
     headers['includeIdentifiers'] = "true"
     url = "{}Patient/{}?_format={}".format(get_resourcerouter().fhir_url, id, settings.FHIR_PARAM_FORMAT)
-    s = requests.Session()
     req = requests.Request('GET', url, headers=headers)
     prepped = req.prepare()
-    response = s.send(prepped, cert=certs, verify=False)
+    response = backend_client.send(prepped)
     response.raise_for_status()
     return response.json()
@@ -1,12 +1,41 @@
+from django.conf import settings
 from django.conf.urls import url
 from django.contrib import admin
 
-from apps.fhir.bluebutton.views.read import ReadViewCoverage, ReadViewExplanationOfBenefit, ReadViewPatient
-from apps.fhir.bluebutton.views.search import SearchViewCoverage, SearchViewExplanationOfBenefit, SearchViewPatient
+from apps.fhir.bluebutton.views.export import ExportFileView, ExportKickOffView, ExportStatusView
+
+if settings.FHIR_ASYNC_VIEWS:
+    # ASGI deployments: upstream BFD calls do not pin a worker thread
+    from apps.fhir.bluebutton.views.read import (
+        AsyncReadViewCoverage as ReadViewCoverage,
+        AsyncReadViewExplanationOfBenefit as ReadViewExplanationOfBenefit,
+        AsyncReadViewPatient as ReadViewPatient,
+    )
+    from apps.fhir.bluebutton.views.search import (
+        AsyncSearchViewCoverage as SearchViewCoverage,
+        AsyncSearchViewExplanationOfBenefit as SearchViewExplanationOfBenefit,
+        AsyncSearchViewPatient as SearchViewPatient,
+    )
+else:
+    from apps.fhir.bluebutton.views.read import ReadViewCoverage, ReadViewExplanationOfBenefit, ReadViewPatient
+    from apps.fhir.bluebutton.views.search import SearchViewCoverage, SearchViewExplanationOfBenefit, SearchViewPatient
 
 admin.autodiscover()
 
 urlpatterns = [
+    # Bulk Data $export, ahead of the read views which would match these paths
+    url(r'^Patient/\$export$',
+        ExportKickOffView.as_view(version=2),
+        name='bb_oauth_fhir_patient_export_v2'),
+
+    url(r'^\$export-poll-status/(?P<job_id>[^/]+)$',
+        ExportStatusView.as_view(version=2),
+        name='bb_oauth_fhir_export_status_v2'),
+
+    url(r'^\$export-file/(?P<job_id>[^/]+)/(?P<resource_type>[A-Za-z]+)\.ndjson$',
+        ExportFileView.as_view(version=2),
+        name='bb_oauth_fhir_export_file_v2'),
+
     # Patient ReadView
     url(r'Patient/(?P<resource_id>[^/]+)',
         ReadViewPatient.as_view(version=2),
@@ -0,0 +1,195 @@
+import logging
+import os
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.http import FileResponse
+from django.urls import reverse
+from django.utils.dateparse import parse_datetime
+from rest_framework import (exceptions, permissions, status)
+from rest_framework.response import Response
+from rest_framework.views import APIView
+from urllib.parse import quote
+from waffle import switch_is_active
+
+import apps.logging.request_logger as bb2logging
+
+from apps.authorization.models import DataAccessGrant
+from apps.authorization.permissions import DataAccessGrantPermission
+from apps.dot_ext.throttling import ApplicationRateThrottle, TokenRateThrottle
+from apps.fhir.renderers import FHIRRenderer, JSONRenderer, NDJSONRenderer
+from apps.fhir.server import connection as backend_connection
+
+from ..authentication import OAuth2ResourceOwner
+from ..export import EXPORT_RESOURCE_TYPES, delete_files, file_path
+from ..models import ExportJob
+from ..permissions import (ApplicationActivePermission, ExportCapabilityPermission, HasCrosswalk)
+
+logger = logging.getLogger(bb2logging.HHS_SERVER_LOGNAME_FMT.format(__name__))
+
+EXPORT_OUTPUT_FORMATS = ('application/fhir+ndjson', 'application/ndjson', 'ndjson')
+
+
+class ExportView(APIView):
+    """
+    Base class of the FHIR Bulk Data $export views, enabled by the
+    fhir_bulk_export switch. Jobs are processed by the export worker
+    (apps/fhir/bluebutton/export.py).
+    """
+    version = None
+    renderer_classes = [JSONRenderer, FHIRRenderer]
+    throttle_classes = [TokenRateThrottle, ApplicationRateThrottle]
+    authentication_classes = [OAuth2ResourceOwner]
+    permission_classes = [
+        permissions.IsAuthenticated,
+        ApplicationActivePermission,
+        HasCrosswalk,
+        DataAccessGrantPermission]
+
+    def __init__(self, version=1):
+        self.version = version
+        super().__init__()
+
+    def initial(self, request, *args, **kwargs):
+        if not switch_is_active('fhir_bulk_export'):
+            raise exceptions.NotFound()
+        super().initial(request, *args, **kwargs)
+
+    def url_name(self, name):
+        return name + '_v2' if self.version == 2 else name
+
+    def get_job(self, request, job_id):
+        try:
+            return ExportJob.objects.get(id=job_id,
+                                         application=request.auth.application,
+                                         user=request.user)
+        except (ExportJob.DoesNotExist, ValidationError):
+            raise exceptions.NotFound()
+
+
+class ExportKickOffView(ExportView):
+    # Patient/$export of the token's beneficiary
+
+    permission_classes = ExportView.permission_classes + [ExportCapabilityPermission]
+
+    def export_types(self, request):
+        types = request.query_params.get('_type')
+        if not types:
+            return list(EXPORT_RESOURCE_TYPES)
+        types = [t.strip() for t in types.split(',') if t.strip()]
+        for resource_type in types:
+            if resource_type not in EXPORT_RESOURCE_TYPES:
+                raise exceptions.ParseError(detail="the _type parameter value is not valid")
+        return types
+
+    def get(self, request, *args, **kwargs):
+        if 'respond-async' not in request.META.get('HTTP_PREFER', ''):
+            raise exceptions.ParseError(detail="the Prefer: respond-async header is required")
+
+        if request.query_params.get('_outputFormat', EXPORT_OUTPUT_FORMATS[0]) not in EXPORT_OUTPUT_FORMATS:
+            raise exceptions.ParseError(detail="the _outputFormat parameter value is not valid")
+
+        since = request.query_params.get('_since')
+        if since is not None:
+            try:
+                since = parse_datetime(since)
+            except ValueError:
+                since = None
+            if since is None or since.tzinfo is None:
+                raise exceptions.ParseError(detail="the _since parameter value is not valid")
+
+        resource_types = self.export_types(request)
+
+        headers = backend_connection.headers(request)
+        headers.pop('BlueButton-BackendCall', None)
+        # BB2-1544 request header url encode if header value (app name) contains char (>256)
+        if headers.get("BlueButton-Application") is not None:
+            try:
+                headers.get("BlueButton-Application").encode("latin1")
+            except UnicodeEncodeError:
+                headers["BlueButton-Application"] = quote(headers.get("BlueButton-Application"))
+
+        with transaction.atomic():
+            # The grant's row lock serializes the kick-offs of the application and beneficiary
+            list(DataAccessGrant.objects.select_for_update().filter(application=request.auth.application,
+                                                                    beneficiary=request.user))
+            if ExportJob.objects.filter(application=request.auth.application,
+                                        user=request.user,
+                                        status__in=ExportJob.ACTIVE_STATUSES).exists():
+                raise exceptions.Throttled(detail="An export is already in progress")
+
+            job = ExportJob.objects.create(application=request.auth.application,
+                                           user=request.user,
+                                           fhir_id=request.crosswalk.fhir_id,
+                                           api_version=self.version,
+                                           resource_types=",".join(resource_types),
+                                           since=since,
+                                           backend_headers=headers,
+                                           request_url=request.build_absolute_uri())
+
+        status_url = reverse(self.url_name('bb_oauth_fhir_export_status'), kwargs={'job_id': job.id})
+        return Response(status=status.HTTP_202_ACCEPTED,
+                        headers={'Content-Location': request.build_absolute_uri(status_url)})
+
+
+class ExportStatusView(ExportView):
+
+    def get(self, request, job_id, *args, **kwargs):
+        job = self.get_job(request, job_id)
+
+        if job.status in ExportJob.ACTIVE_STATUSES:
+            exported = sum(state['count'] for state in job.progress.values())
+            return Response(status=status.HTTP_202_ACCEPTED,
+                            headers={'X-Progress': "%s, %s resources exported" % (job.status, exported),
+                                     'Retry-After': str(settings.FHIR_EXPORT_POLL_INTERVAL)})
+
+        if job.status == ExportJob.STATUS_FAILED:
+            return Response({
+                "resourceType": "OperationOutcome",
+                "issue": [{
+                    "severity": "error",
+                    "code": "exception",
+                    "diagnostics": "The export failed, please start a new export",
+                }],
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        if job.status != ExportJob.STATUS_COMPLETED:
+            raise exceptions.NotFound()
+
+        return Response({
+            "transactionTime": job.transaction_time.isoformat(),
+            "request": job.request_url,
+            "requiresAccessToken": True,
+            "output": [{
+                "type": resource_type,
+                "url": request.build_absolute_uri(reverse(self.url_name('bb_oauth_fhir_export_file'),
+                                                          kwargs={'job_id': job.id,
+                                                                  'resource_type': resource_type})),
+                "count": job.progress[resource_type]['count'],
+            } for resource_type in job.resource_type_list],
+            "error": [],
+        })
+
+    def delete(self, request, job_id, *args, **kwargs):
+        job = self.get_job(request, job_id)
+        # A running worker stops at its next checkpoint
+        ExportJob.objects.filter(id=job.id).update(status=ExportJob.STATUS_CANCELLED)
+        delete_files(job)
+        return Response(status=status.HTTP_202_ACCEPTED)
+
+
+class ExportFileView(ExportView):
+    renderer_classes = [NDJSONRenderer, JSONRenderer, FHIRRenderer]
+
+    def get(self, request, job_id, resource_type, *args, **kwargs):
+        job = self.get_job(request, job_id)
+
+        if job.status != ExportJob.STATUS_COMPLETED or resource_type not in job.resource_type_list:
+            raise exceptions.NotFound()
+
+        path = file_path(job, resource_type)
+        if not os.path.exists(path):
+            raise exceptions.NotFound()
+
+        return FileResponse(open(path, 'rb'), content_type=NDJSONRenderer.media_type)
@@ -1,41 +1,61 @@
+import functools
+import datetime
+import itertools
 import voluptuous
 import logging
 
 import apps.logging.request_logger as bb2logging
 
-from requests import Session, Request
+from asgiref.sync import sync_to_async
+from django.http import StreamingHttpResponse
+from requests import Request
 from rest_framework import (exceptions, permissions)
 from rest_framework.parsers import JSONParser
-from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from urllib.parse import quote
+from waffle import switch_is_active
 
 from apps.authorization.permissions import DataAccessGrantPermission
-from apps.dot_ext.throttling import TokenRateThrottle
+from apps.dot_ext.throttling import ApplicationRateThrottle, TokenRateThrottle
 from apps.fhir.parsers import FHIRParser
-from apps.fhir.renderers import FHIRRenderer
+from apps.fhir.renderers import FHIRRenderer, JSONRenderer
 from apps.fhir.server import connection as backend_connection
+from apps.fhir.server.client import backend_client, async_backend_client
+from apps.fhir.server.retry import backend_retry
+from apps.fhir.server.singleflight import backend_single_flight
+from apps.fhir.server.settings import fhir_settings
+from apps.logging.timing import get_phase_timer, phase
 
 from ..authentication import OAuth2ResourceOwner
-from ..exceptions import process_error_response
+from ..cache import response_cache
+from ..conditional import (backend_validators, conditional_headers, conditional_response,
+                           not_modified_response, response_validators)
+from ..exceptions import process_error_response, UpstreamServerException
+from ..loggers import log_response_cache
 from ..permissions import (HasCrosswalk, ResourcePermission, ApplicationActivePermission)
 from ..signals import (
     pre_fetch,
     post_fetch
 )
+from ..streaming import FhirStreamError, FhirStreamValidator
 from ..utils import (build_fhir_response,
-                     FhirServerVerify,
                      get_resourcerouter)
 
 logger = logging.getLogger(bb2logging.HHS_SERVER_LOGNAME_FMT.format(__name__))
 
+# Size of the chunks read from the backend in streaming mode
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Backend request headers that are part of the single-flight key
+SINGLE_FLIGHT_HEADERS = ('X-Forwarded-Proto', 'X-Forwarded-Host', 'If-None-Match', 'If-Modified-Since')
+
 
 class FhirDataView(APIView):
     version = None
     parser_classes = [JSONParser, FHIRParser]
     renderer_classes = [JSONRenderer, FHIRRenderer]
-    throttle_classes = [TokenRateThrottle]
+    throttle_classes = [TokenRateThrottle, ApplicationRateThrottle]
     authentication_classes = [OAuth2ResourceOwner]
     # BB2-149 note, check authenticated first, then app active etc.
     permission_classes = [
@@ -45,6 +65,11 @@ class FhirDataView(APIView):
         ResourcePermission,
         DataAccessGrantPermission]
 
+    # Forward the client's If-None-Match / If-Modified-Since to the backend when
+    # the FHIR_SERVER FORWARD_CONDITIONAL_HEADERS setting is on. Off for reads,
+    # where a bodiless 304 would skip the patient ownership check.
+    forward_conditional_headers = False
+
     def __init__(self, version=1):
         self.version = version
         super().__init__()
@@ -92,13 +117,37 @@ class FhirDataView(APIView):
 
         super(FhirDataView, self).initial(request, *args, **kwargs)
 
+    def perform_authentication(self, request):
+        with phase(request, "auth"):
+            super().perform_authentication(request)
+
+    def check_permissions(self, request):
+        with phase(request, "permission"):
+            super().check_permissions(request)
+
+    def check_throttles(self, request):
+        with phase(request, "throttle"):
+            super().check_throttles(request)
+
     def get(self, request, resource_type, *args, **kwargs):
 
-        out_data = self.fetch_data(request, resource_type, *args, **kwargs)
+        # Cached resource types are small, they are served from fetch_data
+        if switch_is_active('fhir_stream_passthrough') and not response_cache.is_enabled_for(resource_type):
+            return self.stream_data(request, resource_type, *args, **kwargs)
 
-        return Response(out_data)
+        out_data, validators = self.fetch_data(request, resource_type, *args, **kwargs)
 
-    def fetch_data(self, request, resource_type, *args, **kwargs):
+        if out_data is None:
+            return not_modified_response(validators)
+
+        return conditional_response(request, validators, Response(out_data))
+
+    def build_backend_call(self, request, resource_type, *args, **kwargs):
+        """
+        Build the target url and query parameters for the
+        call to the backend FHIR server.
+        Returns a (resource_router, target_url, get_parameters) tuple.
+        """
         resource_router = get_resourcerouter(request.crosswalk)
 
         target_url = self.build_url(resource_router,
@@ -115,32 +164,174 @@ class FhirDataView(APIView):
         logger.debug('Here is the URL to send, %s now add '
                      'GET parameters %s' % (target_url, get_parameters))
 
+        return resource_router, target_url, get_parameters
+
+    def build_cached_backend_call(self, request, resource_type, *args, **kwargs):
+        """
+        build_backend_call() and the response cache lookup, returns
+        (resource_router, target_url, get_parameters, cache_key, cached),
+        cache_key is None when resource_type is not cached. The lookup reads
+        the stamps of the shared cache, so it runs in a worker thread under ASGI.
+        """
+        resource_router, target_url, get_parameters = self.build_backend_call(
+            request, resource_type, *args, **kwargs)
+
+        cache_key = cached = None
+        if response_cache.is_enabled_for(resource_type):
+            # The backend rewrites the Bundle links with the forwarded scheme and host
+            cache_key = response_cache.make_key(request.crosswalk.fhir_id, resource_type,
+                                                self.version, target_url, get_parameters,
+                                                (request.scheme, request.get_host()))
+            cached = response_cache.get(cache_key)
+            log_response_cache(request, cache_key, cached is not None, response_cache)
+
+        return resource_router, target_url, get_parameters, cache_key, cached
+
+    def build_backend_headers(self, request, target_url):
+        headers = backend_connection.headers(request, url=target_url)
+
+        # BB2-1544 request header url encode if header value (app name) contains char (>256)
+        if headers.get("BlueButton-Application") is not None:
+            try:
+                headers.get("BlueButton-Application").encode("latin1")
+            except UnicodeEncodeError:
+                headers["BlueButton-Application"] = quote(headers.get("BlueButton-Application"))
+
+        if self.forward_conditional_headers and fhir_settings.forward_conditional_headers:
+            headers.update(conditional_headers(request))
+
+        return headers
+
+    def single_flight_key(self, request, url, headers):
+        # Headers that change the backend response, the others only identify the caller
+        return (request.crosswalk.fhir_id, url) + tuple(headers.get(h) for h in SINGLE_FLIGHT_HEADERS)
+
+    def fetch_data(self, request, resource_type, *args, **kwargs):
+        """
+        Returns (out_data, validators), out_data is None when the backend
+        answered 304 to the forwarded conditional headers.
+        """
+        resource_router, target_url, get_parameters, cache_key, cached = self.build_cached_backend_call(
+            request, resource_type, *args, **kwargs)
+        if cached is not None:
+            return cached
+
+        headers = self.build_backend_headers(request, target_url)
+
         # Now make the call to the backend API
         req = Request('GET',
                       target_url,
                       data=get_parameters,
                       params=get_parameters,
-                      headers=backend_connection.headers(request, url=target_url))
-        s = Session()
+                      headers=headers)
 
-        # BB2-1544 request header url encode if header value (app name) contains char (>256)
-        if req.headers.get("BlueButton-Application") is not None:
-            try:
-                req.headers.get("BlueButton-Application").encode("latin1")
-            except UnicodeEncodeError:
-                req.headers["BlueButton-Application"] = quote(req.headers.get("BlueButton-Application"))
+        prepped = backend_client.prepare_request(req)
+        # Send signal
+        with phase(request, "logging"):
+            pre_fetch.send_robust(FhirDataView, request=req, auth_request=request,
+                                  api_ver='v2' if self.version == 2 else 'v1')
+        with phase(request, "bfd"):
+            r = backend_single_flight.send(
+                self.single_flight_key(request, prepped.url, headers), prepped,
+                lambda: backend_retry.send(prepped, backend_client.send, timeout=resource_router.wait_time),
+                timeout=resource_router.wait_time)
+        self.add_backend_phases(request, r)
+        # Send signal
+        with phase(request, "logging"):
+            post_fetch.send_robust(FhirDataView, request=prepped, auth_request=request,
+                                   response=r, api_ver='v2' if self.version == 2 else 'v1')
+
+        if r.status_code == 304:
+            return None, backend_validators(r)
+
+        out_data = self.process_backend_response(request, target_url, r)
+        validators = response_validators(r, out_data, request.accepted_renderer.media_type)
 
-        prepped = s.prepare_request(req)
+        if cache_key is not None:
+            response_cache.set(cache_key, (out_data, validators), len(r.content))
+
+        return out_data, validators
+
+    def add_backend_phases(self, request, r):
+        # Time to the backend response headers (connect included), then reading the body
+        timer = get_phase_timer(request)
+        if timer is None or not isinstance(getattr(r, 'elapsed', None), datetime.timedelta):
+            return
+        ttfb = r.elapsed.total_seconds()
+        timer.add("bfd_ttfb", ttfb)
+        timer.add("bfd_transfer", max(0.0, timer.phases.get("bfd", 0.0) - ttfb))
+
+    def stream_data(self, request, resource_type, *args, **kwargs):
+        """
+        Forward the backend body to the client as it arrives instead of
+        parsing and re-rendering it. Patient ownership of each resource is
+        checked on the way (see apps.fhir.bluebutton.streaming), and bytes are
+        only sent once the resources before them have passed the check.
+        """
+        resource_router, target_url, get_parameters = self.build_backend_call(
+            request, resource_type, *args, **kwargs)
+        headers = self.build_backend_headers(request, target_url)
+
+        req = Request('GET',
+                      target_url,
+                      data=get_parameters,
+                      params=get_parameters,
+                      headers=headers)
+
+        prepped = backend_client.prepare_request(req)
         # Send signal
         pre_fetch.send_robust(FhirDataView, request=req, auth_request=request, api_ver='v2' if self.version == 2 else 'v1')
-        r = s.send(
-            prepped,
-            cert=backend_connection.certs(crosswalk=request.crosswalk),
-            timeout=resource_router.wait_time,
-            verify=FhirServerVerify(crosswalk=request.crosswalk))
-        # Send signal
-        post_fetch.send_robust(FhirDataView, request=prepped, auth_request=request,
-                               response=r, api_ver='v2' if self.version == 2 else 'v1')
+        r = backend_client.send(prepped, timeout=resource_router.wait_time, stream=True)
+
+        if r.status_code >= 300:
+            # Error bodies are small, use the regular path to map them
+            post_fetch.send_robust(FhirDataView, request=prepped, auth_request=request,
+                                   response=r, api_ver='v2' if self.version == 2 else 'v1')
+            if r.status_code == 304:
+                return not_modified_response(backend_validators(r))
+            return Response(self.process_backend_response(request, target_url, r))
+
+        # Only the backend validators are known before the body is sent
+        response = conditional_response(request, backend_validators(r),
+                                        StreamingHttpResponse(content_type=request.accepted_renderer.media_type))
+        if response.status_code == 304:
+            r.close()
+            post_fetch.send_robust(FhirDataView, request=prepped, auth_request=request,
+                                   response=r, api_ver='v2' if self.version == 2 else 'v1')
+            return response
+
+        validator = FhirStreamValidator(lambda obj: self.check_object_permissions(request, obj))
+        chunks = self.iter_backend_stream(request, prepped, r, validator)
+
+        # Read up to the first checked bytes, so a rejected single resource
+        # still gets a regular error response.
+        first = next(chunks, b'')
+
+        response.streaming_content = itertools.chain([first], chunks)
+        return response
+
+    def iter_backend_stream(self, request, prepped, r, validator):
+        try:
+            for chunk in r.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+                out = validator.feed(chunk)
+                if out:
+                    yield out
+            yield validator.close()
+        except FhirStreamError as e:
+            logger.error("Aborted streaming backend response: %s" % e)
+            raise UpstreamServerException('An error occurred contacting the upstream server')
+        except exceptions.APIException as e:
+            # Resource not owned by the beneficiary, stop before sending it
+            logger.error("Aborted streaming backend response: %s" % e)
+            raise
+        finally:
+            r.close()
+            r.streamed_size = validator.size
+            # Send signal
+            post_fetch.send_robust(FhirDataView, request=prepped, auth_request=request,
+                                   response=r, api_ver='v2' if self.version == 2 else 'v1')
+
+    def process_backend_response(self, request, target_url, r):
         response = build_fhir_response(request._request, target_url, request.crosswalk, r=r, e=None)
 
         # BB2-128
@@ -151,8 +342,100 @@ class FhirDataView(APIView):
 
         self.validate_response(response)
 
-        out_data = r.json()
+        with phase(request, "parse"):
+            out_data = r.json()
 
-        self.check_object_permissions(request, out_data)
+        with phase(request, "object_permission"):
+            self.check_object_permissions(request, out_data)
 
         return out_data
+
+
+class AsyncFhirDataViewMixin:
+    """
+    Serves a FhirDataView as a native async view under ASGI.
+
+    Authentication, permission, throttle and header lookups are database
+    bound and run in a worker thread. The upstream BFD call is awaited on
+    the event loop, so no thread is held while BFD answers.
+
+    Django still runs each sync only middleware (e.g.
+    axes.middleware.AxesMiddleware) in a thread for every request, so
+    FHIR_ASYNC_VIEWS is off by default.
+    Mix in ahead of the concrete view, e.g.
+        class AsyncReadViewPatient(AsyncFhirDataViewMixin, ReadViewPatient)
+    """
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        view = super().as_view(**initkwargs)
+
+        # Django only awaits views that are coroutine functions
+        async def async_view(request, *args, **kwargs):
+            return await view(request, *args, **kwargs)
+
+        functools.update_wrapper(async_view, view)
+        return async_view
+
+    async def dispatch(self, request, *args, **kwargs):
+        self.args = args
+        self.kwargs = kwargs
+        request = self.initialize_request(request, *args, **kwargs)
+        self.request = request
+        self.headers = self.default_response_headers
+
+        try:
+            await sync_to_async(self.initial)(request, *args, **kwargs)
+
+            if request.method.lower() == 'get':
+                response = await self.async_get(request, *args, **kwargs)
+            else:
+                response = self.http_method_not_allowed(request, *args, **kwargs)
+        except Exception as exc:
+            response = self.handle_exception(exc)
+
+        self.response = self.finalize_response(request, response, *args, **kwargs)
+        return self.response
+
+    async def async_get(self, request, *args, **kwargs):
+        out_data, validators = await self.async_fetch_data(request, self.resource_type, *args, **kwargs)
+
+        if out_data is None:
+            return not_modified_response(validators)
+
+        return conditional_response(request, validators, Response(out_data))
+
+    async def async_fetch_data(self, request, resource_type, *args, **kwargs):
+        resource_router, target_url, get_parameters, cache_key, cached = await sync_to_async(
+            self.build_cached_backend_call)(request, resource_type, *args, **kwargs)
+        if cached is not None:
+            return cached
+
+        headers = await sync_to_async(self.build_backend_headers)(request, target_url)
+
+        req = async_backend_client.build_request(target_url, params=get_parameters, headers=headers)
+        # Send signal
+        with phase(request, "logging"):
+            pre_fetch.send_robust(FhirDataView, request=req, auth_request=request,
+                                  api_ver='v2' if self.version == 2 else 'v1')
+        with phase(request, "bfd"):
+            r = await backend_single_flight.send_async(
+                self.single_flight_key(request, str(req.url), headers), req,
+                lambda: backend_retry.send_async(req, async_backend_client.send, timeout=resource_router.wait_time),
+                timeout=resource_router.wait_time)
+        self.add_backend_phases(request, r)
+        # Send signal
+        with phase(request, "logging"):
+            post_fetch.send_robust(FhirDataView, request=req, auth_request=request,
+                                   response=r, api_ver='v2' if self.version == 2 else 'v1')
+
+        if r.status_code == 304:
+            return None, backend_validators(r)
+
+        out_data = await sync_to_async(self.process_backend_response)(request, target_url, r)
+        validators = response_validators(r, out_data, request.accepted_renderer.media_type)
+
+        if cache_key is not None:
+            await sync_to_async(response_cache.set)(cache_key, (out_data, validators), len(r.content))
+
+        return out_data, validators
@@ -1,10 +1,17 @@
+import copy
+import hashlib
 import json
 import logging
+import os
+import threading
+import time
 
 from collections import OrderedDict
 from urllib.parse import urlencode
+from django.conf import settings
 from django.http import JsonResponse
 from django.shortcuts import HttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
 from urllib.parse import urlparse
 # from oauth2_provider.compat import urlparse
 from apps.fhir.bluebutton import constants
@@ -13,6 +20,8 @@ from apps.fhir.bluebutton.utils import (request_call,
                                         get_resourcerouter,
                                         get_response_text,
                                         build_oauth_resource)
+from apps.fhir.server.client import backend_client
+from apps.wellknown.views import base_issuer
 
 import apps.logging.request_logger as bb2logging
 
@@ -28,30 +37,22 @@ def fhir_conformance(request, via_oauth=False, v2=False, *args):
 
     BaseStu3 = "CapabilityStatement"
 
+    The filtered statement is served from capability_statement_cache when
+    FHIR_CONFORMANCE_REFRESH_INTERVAL is set, so BFD is only called on
+    the first hit and by the background refresh.
+
     :param request:
     :param via_oauth:
     :param args:
     :param kwargs:
     :return:
     """
-    crosswalk = None
-    resource_router = get_resourcerouter()
-    parsed_url = urlparse(resource_router.fhir_url)
-    call_to = None
-    if parsed_url.path is not None:
-        call_to = '{}://{}/{}/fhir/metadata'.format(parsed_url.scheme, parsed_url.netloc, 'v2' if v2 else 'v1')
-    else:
-        # url with no path
-        call_to = '{}/{}/fhir/metadata'.format(resource_router.fhir_url, 'v2' if v2 else 'v1')
-
-    pass_params = {'_format': 'json'}
-
-    encoded_params = urlencode(pass_params)
-    pass_params = prepend_q(encoded_params)
+    if capability_statement_cache.interval():
+        document = capability_statement_cache.get(request, v2)
+        if document is not None:
+            return capability_statement_response(request, document)
 
-    r = request_call(request, call_to + pass_params, crosswalk)
-
-    text_out = ''
+    r = request_call(request, metadata_url(v2) + prepend_q(urlencode({'_format': 'json'})), None)
 
     if r.status_code >= 300:
         logger.debug("We have an error code to deal with: %s" % r.status_code)
@@ -59,11 +60,32 @@ def fhir_conformance(request, via_oauth=False, v2=False, *args):
                             status=r.status_code,
                             content_type='application/json')
 
+    od = build_capability_statement(request, filter_capability_statement(r), v2)
+
+    return JsonResponse(od)
+
+
+def metadata_url(v2=False):
+    resource_router = get_resourcerouter()
+    parsed_url = urlparse(resource_router.fhir_url)
+    if parsed_url.path is not None:
+        return '{}://{}/{}/fhir/metadata'.format(parsed_url.scheme, parsed_url.netloc, 'v2' if v2 else 'v1')
+    else:
+        # url with no path
+        return '{}/{}/fhir/metadata'.format(resource_router.fhir_url, 'v2' if v2 else 'v1')
+
+
+def filter_capability_statement(r):
+    """ Parse and filter the backend statement, the part shared by all issuers """
     text_in = get_response_text(fhir_response=r)
 
     text_out = json.loads(text_in, object_pairs_hook=OrderedDict)
 
-    od = conformance_filter(text_out)
+    return conformance_filter(text_out)
+
+
+def build_capability_statement(request, statement, v2=False):
+    od = copy.deepcopy(statement)
 
     # Append Security to ConformanceStatement
     security_endpoint = build_oauth_resource(request, v2, format_type="json")
@@ -71,7 +93,108 @@ def fhir_conformance(request, via_oauth=False, v2=False, *args):
     # Fix format values
     od['format'] = ['application/json', 'application/fhir+json']
 
-    return JsonResponse(od)
+    return od
+
+
+def capability_statement_response(request, document):
+    content, etag = document
+    response = HttpResponse(content, content_type='application/json')
+    response['ETag'] = etag
+    patch_cache_control(response, public=True, max_age=capability_statement_cache.interval())
+    return get_conditional_response(request, etag=etag, response=response)
+
+
+class CapabilityStatementCache(object):
+    """
+    Filtered v1 / v2 CapabilityStatements of the backend.
+
+    The backend statement only changes when BFD deploys. It is fetched on the
+    first hit and then refreshed every FHIR_CONFORMANCE_REFRESH_INTERVAL
+    seconds by a daemon thread. A failed refresh keeps the last good copy.
+    The serialized statement with its security block is built once per
+    issuer host and statement.
+    """
+
+    def __init__(self):
+        self._statements = {}
+        self._documents = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def interval(self):
+        return getattr(settings, 'FHIR_CONFORMANCE_REFRESH_INTERVAL', 0)
+
+    def get(self, request, v2=False):
+        """
+        Returns the (content, etag) of the statement for the request issuer,
+        or None when no statement could be fetched from the backend yet.
+        """
+        self._start_refresher()
+        key = (v2, base_issuer(request))
+        document = self._documents.get(key)
+        if document is not None:
+            return document
+
+        statement = self._statements.get(v2)
+        if statement is None:
+            statement = self.refresh(v2)
+            if statement is None:
+                return None
+
+        content = json.dumps(build_capability_statement(request, statement, v2)).encode('utf-8')
+        document = (content, '"%s"' % hashlib.sha256(content).hexdigest())
+        with self._lock:
+            if self._statements.get(v2) is statement:
+                self._documents[key] = document
+        return document
+
+    def refresh(self, v2=False):
+        """
+        Fetch and filter the backend statement.
+        Returns the new statement, or None when the backend call failed.
+        """
+        try:
+            r = backend_client.get(metadata_url(v2), params={'_format': 'json'})
+            if r.status_code >= 300:
+                raise ValueError("status %s" % r.status_code)
+            statement = filter_capability_statement(r)
+            if not statement:
+                raise ValueError("no rest section")
+        except Exception as e:
+            logger.error("Could not refresh the %s backend CapabilityStatement: %s" % ('v2' if v2 else 'v1', e))
+            return None
+
+        with self._lock:
+            if statement != self._statements.get(v2):
+                self._statements[v2] = statement
+                for key in [key for key in self._documents if key[0] == v2]:
+                    del self._documents[key]
+            return self._statements[v2]
+
+    def clear(self):
+        with self._lock:
+            self._statements.clear()
+            self._documents.clear()
+
+    def _start_refresher(self):
+        # One refresher per process, started after a prefork server has forked
+        with self._lock:
+            if self._pid == os.getpid() or not self.interval():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._refresh_loop,
+                                            name="capability-statement-refresh", daemon=True)
+            self._thread.start()
+
+    def _refresh_loop(self):
+        while True:
+            time.sleep(self.interval() or 60)
+            for v2 in list(self._statements):
+                self.refresh(v2)
+
+
+capability_statement_cache = CapabilityStatementCache()
 
 
 def conformance_filter(text_block):
@@ -3,7 +3,7 @@ from rest_framework import permissions
 from apps.authorization.permissions import DataAccessGrantPermission
 from apps.capabilities.permissions import TokenHasProtectedCapability
 from ..permissions import (ReadCrosswalkPermission, ResourcePermission, ApplicationActivePermission)
-from apps.fhir.bluebutton.views.generic import FhirDataView
+from apps.fhir.bluebutton.views.generic import AsyncFhirDataViewMixin, FhirDataView
 
 
 #####################################################################
@@ -66,3 +66,17 @@ class ReadViewExplanationOfBenefit(ReadView):
     def __init__(self, version=1):
         super().__init__(version)
         self.resource_type = "ExplanationOfBenefit"
+
+
+# Async variants, served when FHIR_ASYNC_VIEWS is enabled under ASGI
+
+class AsyncReadViewPatient(AsyncFhirDataViewMixin, ReadViewPatient):
+    pass
+
+
+class AsyncReadViewCoverage(AsyncFhirDataViewMixin, ReadViewCoverage):
+    pass
+
+
+class AsyncReadViewExplanationOfBenefit(AsyncFhirDataViewMixin, ReadViewExplanationOfBenefit):
+    pass
@@ -1,3 +1,8 @@
+import collections
+import json
+import logging
+
+from concurrent.futures import ThreadPoolExecutor
 from voluptuous import (
     Required,
     All,
@@ -7,13 +12,31 @@ from voluptuous import (
     Schema,
     REMOVE_EXTRA,
 )
-from rest_framework import (permissions)
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from requests import Request
+from rest_framework import (exceptions, permissions)
+
+import apps.logging.request_logger as bb2logging
 
 from apps.fhir.bluebutton.constants import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
-from apps.fhir.bluebutton.views.generic import FhirDataView
+from apps.fhir.bluebutton.views.generic import AsyncFhirDataViewMixin, FhirDataView
+from apps.fhir.server.client import backend_client
 from apps.authorization.permissions import DataAccessGrantPermission
 from apps.capabilities.permissions import TokenHasProtectedCapability
+from ..exceptions import UpstreamServerException
 from ..permissions import (SearchCrosswalkPermission, ResourcePermission, ApplicationActivePermission)
+from ..signals import (
+    pre_fetch,
+    post_fetch
+)
+
+logger = logging.getLogger(bb2logging.HHS_SERVER_LOGNAME_FMT.format(__name__))
+
+# _outputFormat values of the _pages=all mode
+BUNDLE_OUTPUT_FORMATS = ('json', 'application/json', 'application/fhir+json')
+NDJSON_OUTPUT_FORMATS = ('ndjson', 'application/ndjson', 'application/fhir+ndjson')
 
 
 class SearchView(FhirDataView):
@@ -29,6 +52,12 @@ class SearchView(FhirDataView):
         TokenHasProtectedCapability,
     ]
 
+    # Searches are scoped to the beneficiary by the backend query itself
+    forward_conditional_headers = True
+
+    # Serve _pages=all requests, see get_all_pages
+    allow_all_pages = False
+
     # Regex to match a valid _lastUpdated value that can begin with lt, le, gt and ge operators
     REGEX_LASTUPDATED_VALUE = r'^((lt)|(le)|(gt)|(ge)).+'
 
@@ -50,8 +79,106 @@ class SearchView(FhirDataView):
         return super().initial(request, self.resource_type, *args, **kwargs)
 
     def get(self, request, *args, **kwargs):
+        if self.all_pages_requested(request):
+            return self.get_all_pages(request, self.resource_type, *args, **kwargs)
         return super().get(request, self.resource_type, *args, **kwargs)
 
+    def all_pages_requested(self, request):
+        return self.allow_all_pages and request.query_params.get('_pages') == 'all'
+
+    def get_all_pages(self, request, resource_type, *args, **kwargs):
+        """
+        Serve every page of the search in one response (_pages=all).
+
+        The first backend page gives the total, the remaining pages are
+        fetched concurrently, at most FHIR_ALL_PAGES_CONCURRENCY at a time,
+        and their entries streamed back in order. The output is a single
+        searchset Bundle, or one resource per line with _outputFormat=ndjson.
+        """
+        output_format = request.query_params.get('_outputFormat', 'application/fhir+json')
+        if output_format not in BUNDLE_OUTPUT_FORMATS + NDJSON_OUTPUT_FORMATS:
+            raise exceptions.ParseError(detail="the _outputFormat parameter value is not valid")
+
+        resource_router, target_url, get_parameters = self.build_backend_call(
+            request, resource_type, *args, **kwargs)
+        headers = self.build_backend_headers(request, target_url)
+        page_size = MAX_PAGE_SIZE
+
+        def page_request(start_index):
+            params = {**get_parameters, 'startIndex': start_index, '_count': page_size}
+            req = Request('GET', target_url, data=params, params=params, headers=headers)
+            prepped = backend_client.prepare_request(req)
+            # Send signal
+            pre_fetch.send_robust(FhirDataView, request=req, auth_request=request,
+                                  api_ver='v2' if self.version == 2 else 'v1')
+            return prepped
+
+        def page_data(prepped, r):
+            # Send signal
+            post_fetch.send_robust(FhirDataView, request=prepped, auth_request=request,
+                                   response=r, api_ver='v2' if self.version == 2 else 'v1')
+            return self.process_backend_response(request, target_url, r)
+
+        # Errors on the first page get a regular error response
+        prepped = page_request(0)
+        first_page = page_data(prepped, backend_client.send(prepped, timeout=resource_router.wait_time))
+        total = first_page.get('total', len(first_page.get('entry', [])))
+
+        def pages():
+            yield first_page
+            concurrency = getattr(settings, 'FHIR_ALL_PAGES_CONCURRENCY', 4)
+            start_indexes = iter(range(page_size, total, page_size))
+            pending = collections.deque()
+            executor = ThreadPoolExecutor(max_workers=concurrency)
+            try:
+                # Keep a bounded window of pages in flight, yielded in order
+                for start_index in start_indexes:
+                    prepped = page_request(start_index)
+                    pending.append((prepped, executor.submit(
+                        backend_client.send, prepped, timeout=resource_router.wait_time)))
+                    if len(pending) >= concurrency:
+                        prepped, future = pending.popleft()
+                        yield page_data(prepped, future.result())
+                while pending:
+                    prepped, future = pending.popleft()
+                    yield page_data(prepped, future.result())
+            except exceptions.APIException as e:
+                # Page not owned by the beneficiary or backend error
+                logger.error("Aborted all pages response: %s" % e)
+                raise
+            except Exception as e:
+                logger.error("Aborted all pages response: %s" % e)
+                raise UpstreamServerException('An error occurred contacting the upstream server')
+            finally:
+                # Client went away or a page failed, drop the pages not started yet
+                for prepped, future in pending:
+                    future.cancel()
+                executor.shutdown(wait=False)
+
+        if output_format in NDJSON_OUTPUT_FORMATS:
+            return StreamingHttpResponse(self.iter_ndjson(pages()), content_type='application/fhir+ndjson')
+        return StreamingHttpResponse(self.iter_bundle(pages(), total),
+                                     content_type=request.accepted_renderer.media_type)
+
+    def iter_ndjson(self, pages):
+        for page in pages:
+            yield b''.join(json.dumps(entry['resource']).encode('utf-8') + b'\n'
+                           for entry in page.get('entry', []))
+
+    def iter_bundle(self, pages, total):
+        header = json.dumps(collections.OrderedDict([
+            ('resourceType', 'Bundle'),
+            ('type', 'searchset'),
+            ('total', total),
+        ]))
+        yield (header[:-1] + ', "entry": [').encode('utf-8')
+        separator = b''
+        for page in pages:
+            for entry in page.get('entry', []):
+                yield separator + json.dumps(entry).encode('utf-8')
+                separator = b', '
+        yield b']}'
+
     def build_url(self, resource_router, resource_type, *args, **kwargs):
         if resource_router.fhir_url.endswith('v1/fhir/'):
             # only if called by tests
@@ -123,6 +250,8 @@ class SearchViewExplanationOfBenefit(SearchView):
                     'service-date': [Match(REGEX_SERVICE_DATE_VALUE, msg="the service-date operator is not valid")]
                     }
 
+    allow_all_pages = True
+
     def __init__(self, version=1):
         super().__init__(version)
         self.resource_type = "ExplanationOfBenefit"
@@ -146,3 +275,28 @@ class SearchViewExplanationOfBenefit(SearchView):
             getattr(self, "QUERY_SCHEMA", {}),
             extra=REMOVE_EXTRA)
         return schema(params)
+
+
+# Async variants, served when FHIR_ASYNC_VIEWS is enabled under ASGI
+
+class AsyncSearchViewPatient(AsyncFhirDataViewMixin, SearchViewPatient):
+    pass
+
+
+class AsyncSearchViewCoverage(AsyncFhirDataViewMixin, SearchViewCoverage):
+    pass
+
+
+class AsyncSearchViewExplanationOfBenefit(AsyncFhirDataViewMixin, SearchViewExplanationOfBenefit):
+
+    async def async_get(self, request, *args, **kwargs):
+        if self.all_pages_requested(request):
+            response = await sync_to_async(self.get)(request, *args, **kwargs)
+            if response.streaming:
+                # The ASGI handler iterates streaming content on the event
+                # loop, the pages are fetched and rendered in a thread first.
+                # The whole result is held in memory, large exports belong
+                # to $export.
+                response.streaming_content = await sync_to_async(list)(response.streaming_content)
+            return response
+        return await super().async_get(request, *args, **kwargs)
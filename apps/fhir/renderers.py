@@ -1,5 +1,34 @@
-from rest_framework.renderers import JSONRenderer
+from rest_framework import renderers
+
+from apps.core.json_encoding import orjson_dumps
+from apps.logging.timing import phase
+
+
+class JSONRenderer(renderers.JSONRenderer):
+    """
+    DRF's JSONRenderer, encoding compact output with orjson when enabled,
+    see apps.core.json_encoding.
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        with phase((renderer_context or {}).get('request'), 'render'):
+            return self._render(data, accepted_media_type, renderer_context)
+
+    def _render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is not None and self.compact and not self.ensure_ascii \
+           and self.get_indent(accepted_media_type, renderer_context or {}) is None:
+            ret = orjson_dumps(data, cls=self.encoder_class)
+            if ret is not None:
+                # Escaped as by DRF, for JSONP and javascript embedding
+                return ret.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
+        return super().render(data, accepted_media_type, renderer_context)
 
 
 class FHIRRenderer(JSONRenderer):
     media_type = 'application/fhir+json'
+
+
+class NDJSONRenderer(JSONRenderer):
+    # Bulk data files are served as is, error responses are rendered as JSON
+    media_type = 'application/fhir+ndjson'
+    format = 'ndjson'
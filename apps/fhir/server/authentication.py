@@ -1,5 +1,8 @@
+import os
 import requests
+import threading
 
+from concurrent.futures import ThreadPoolExecutor
 from django.conf import settings
 from rest_framework import exceptions
 from urllib.parse import quote
@@ -15,7 +18,22 @@ from apps.fhir.bluebutton.utils import (generate_info_headers,
 from ..bluebutton.exceptions import UpstreamServerException
 from ..bluebutton.utils import (FhirServerAuth,
                                 get_resourcerouter)
+from .client import backend_client
 from .loggers import log_match_fhir_id
+from .settings import fhir_settings
+
+# Searches sent in the background by match_fhir_id()
+_search_executor = None
+_search_executor_pid = None
+_search_executor_lock = threading.Lock()
+
+
+def mbi_hash_identifier(mbi_hash):
+    return settings.FHIR_SEARCH_PARAM_IDENTIFIER_MBI_HASH + "%7C" + mbi_hash
+
+
+def hicn_hash_identifier(hicn_hash):
+    return settings.FHIR_SEARCH_PARAM_IDENTIFIER_HICN_HASH + "%7C" + hicn_hash
 
 
 def search_fhir_id_by_identifier_mbi_hash(mbi_hash, request=None):
@@ -23,10 +41,7 @@ def search_fhir_id_by_identifier_mbi_hash(mbi_hash, request=None):
         Search the backend FHIR server's patient resource
         using the mbi_hash identifier.
     """
-    search_identifier = settings.FHIR_SEARCH_PARAM_IDENTIFIER_MBI_HASH \
-        + "%7C" + mbi_hash
-
-    return search_fhir_id_by_identifier(search_identifier, request)
+    return search_fhir_id_by_identifier(mbi_hash_identifier(mbi_hash), request)
 
 
 def search_fhir_id_by_identifier_hicn_hash(hicn_hash, request=None):
@@ -34,26 +49,14 @@ def search_fhir_id_by_identifier_hicn_hash(hicn_hash, request=None):
         Search the backend FHIR server's patient resource
         using the hicn_hash identifier.
     """
-    search_identifier = settings.FHIR_SEARCH_PARAM_IDENTIFIER_HICN_HASH \
-        + "%7C" + hicn_hash
+    return search_fhir_id_by_identifier(hicn_hash_identifier(hicn_hash), request)
 
-    return search_fhir_id_by_identifier(search_identifier, request)
 
-
-def search_fhir_id_by_identifier(search_identifier, request=None):
+def build_identifier_search(search_identifier, request=None):
     """
-        Search the backend FHIR server's patient resource
-        using the specified identifier.
-
-        Return:  fhir_id = matched ID (or None for no match).
-
-        Raises exception:
-            UpstreamServerException: For backend response issues.
+        Returns the backend patient search request
+        for the specified identifier, and its API version.
     """
-    # Get certs from FHIR server settings
-    auth_settings = FhirServerAuth(None)
-    certs = (auth_settings['cert_file'], auth_settings['key_file'])
-
     # Add headers for FHIR backend logging, including auth_flow_dict
     if request:
         # Get auth flow session values.
@@ -81,13 +84,63 @@ def search_fhir_id_by_identifier(search_identifier, request=None):
         + "/{}/fhir/Patient/?identifier=".format(ver) + search_identifier \
         + "&_format=" + settings.FHIR_PARAM_FORMAT
 
-    s = requests.Session()
+    return requests.Request('GET', url, headers=headers), ver
+
+
+def search_fhir_id_by_identifier(search_identifier, request=None):
+    """
+        Search the backend FHIR server's patient resource
+        using the specified identifier.
+
+        Return:  fhir_id = matched ID (or None for no match).
 
-    req = requests.Request('GET', url, headers=headers)
+        Raises exception:
+            UpstreamServerException: For backend response issues.
+    """
+    req, ver = build_identifier_search(search_identifier, request)
     prepped = req.prepare()
     pre_fetch.send_robust(FhirServerAuth, request=req, auth_request=request, api_ver=ver)
-    response = s.send(prepped, cert=certs, verify=False)
+    response = backend_client.send(prepped)
     post_fetch.send_robust(FhirServerAuth, request=req, auth_request=request, response=response, api_ver=ver)
+    return fhir_id_from_search_response(response)
+
+
+def start_search_fhir_id_by_identifier(search_identifier, request=None):
+    """
+        Sends the search of search_fhir_id_by_identifier() in the background.
+
+        Return:  a function returning its result, once the backend responded.
+    """
+    req, ver = build_identifier_search(search_identifier, request)
+    prepped = req.prepare()
+    pre_fetch.send_robust(FhirServerAuth, request=req, auth_request=request, api_ver=ver)
+
+    def send():
+        response = backend_client.send(prepped)
+        post_fetch.send_robust(FhirServerAuth, request=req, auth_request=request, response=response, api_ver=ver)
+        return response
+
+    future = search_executor().submit(send)
+    return lambda: fhir_id_from_search_response(future.result())
+
+
+def search_executor():
+    global _search_executor, _search_executor_pid
+    with _search_executor_lock:
+        if _search_executor is None or _search_executor_pid != os.getpid():
+            _search_executor = ThreadPoolExecutor(max_workers=fhir_settings.pool_maxsize,
+                                                  thread_name_prefix="fhir-id-search")
+            _search_executor_pid = os.getpid()
+        return _search_executor
+
+
+def fhir_id_from_search_response(response):
+    """
+        Return:  fhir_id = matched ID of a patient search response (or None for no match).
+
+        Raises exception:
+            UpstreamServerException: For backend response issues.
+    """
     response.raise_for_status()
     backend_data = response.json()
 
@@ -132,6 +185,8 @@ def match_fhir_id(mbi_hash, hicn_hash, request=None):
       using an MBI or HICN hash.
 
       Summary:
+        - With FHIR_MATCH_CONCURRENT_LOOKUPS, send the hicn_hash lookup
+          in the background while the mbi_hash lookup is performed.
         - Perform primary lookup using mbi_hash.
         - If there is an mbi_hash lookup issue, raise exception.
         - Perform secondary lookup using HICN_HASH
@@ -144,6 +199,12 @@ def match_fhir_id(mbi_hash, hicn_hash, request=None):
         UpstreamServerException: If hicn_hash or mbi_hash search found duplicates.
         NotFound: If both searches did not match a fhir_id.
     """
+    hicn_search = None
+    if mbi_hash and getattr(settings, "FHIR_MATCH_CONCURRENT_LOOKUPS", False):
+        # Search the HICN_HASH while the MBI_HASH is searched,
+        # its result is only used on an MBI_HASH miss.
+        hicn_search = start_search_fhir_id_by_identifier(hicn_hash_identifier(hicn_hash), request)
+
     # Perform primary lookup using MBI_HASH
     if mbi_hash:
         try:
@@ -161,7 +222,10 @@ def match_fhir_id(mbi_hash, hicn_hash, request=None):
 
     # Perform secondary lookup using HICN_HASH
     try:
-        fhir_id = search_fhir_id_by_identifier_hicn_hash(hicn_hash, request)
+        if hicn_search is not None:
+            fhir_id = hicn_search()
+        else:
+            fhir_id = search_fhir_id_by_identifier_hicn_hash(hicn_hash, request)
     except UpstreamServerException as err:
         log_match_fhir_id(request, None, mbi_hash, hicn_hash, False, "H", str(err))
         # Don't return a 404 because retrying later will not fix this.
@@ -0,0 +1,265 @@
+"""
+Circuit breaker and adaptive timeouts for the calls to the backend FHIR
+server (BFD), applied by apps.fhir.server.client to every backend call.
+
+The breaker keeps the outcome of the calls made in the last
+CIRCUIT_BREAKER_WINDOW seconds. A call fails when it raises (connection
+error, timeout) or BFD answers with a 5xx. Once CIRCUIT_BREAKER_MIN_CALLS
+calls were made and their error rate reaches CIRCUIT_BREAKER_ERROR_RATE
+the breaker opens: calls fail right away with a 503 and a Retry-After
+header instead of tying up a worker. After CIRCUIT_BREAKER_OPEN_TIME
+seconds it is half-open and lets CIRCUIT_BREAKER_HALF_OPEN_PROBES calls
+through, a successful probe closes it and a failed one opens it again.
+
+Timeouts are derived per endpoint (resource type) and page size (the
+_count of a search, so the 50 entry pages of _pages=all and $export do not
+share the latencies of the small pages) from the p99 latency of its last
+ADAPTIVE_TIMEOUT_SAMPLES calls, times ADAPTIVE_TIMEOUT_MULTIPLIER and
+bounded by ADAPTIVE_TIMEOUT_MIN and the timeout asked by the caller (the
+resource router / FHIR_SERVER WAIT_TIME). Until an endpoint and page size
+has CIRCUIT_BREAKER_MIN_CALLS samples the caller's timeout is used.
+
+The state is kept per worker process, it is reported by the bfd health
+checks (apps.health) and its transitions are logged.
+"""
+import math
+import threading
+import time
+
+from collections import deque
+from rest_framework import status
+from rest_framework.exceptions import APIException
+from urllib.parse import parse_qs, urlparse
+
+import apps.logging.request_logger as bb2logging
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+breaker_logger = bb2logging.getLogger(bb2logging.AUDIT_DATA_FHIR_LOGGER)
+
+
+class CircuitOpen(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'The backend FHIR server is temporarily unavailable, try again later.'
+    default_code = 'service_unavailable'
+
+    def __init__(self, wait, detail=None, code=None):
+        # Sent as the Retry-After header by the DRF exception handler
+        self.wait = max(1, math.ceil(wait))
+        super().__init__(detail, code)
+
+
+def endpoint_for(url):
+    """
+    Returns the resource type of a backend url,
+    e.g. ExplanationOfBenefit for .../v2/fhir/ExplanationOfBenefit/?patient=...
+    """
+    segments = [s for s in urlparse(str(url)).path.split('/') if s]
+    if 'fhir' in segments:
+        index = segments.index('fhir') + 1
+        if index < len(segments):
+            return segments[index]
+    return segments[-1] if segments else ''
+
+
+def latency_key(url):
+    """
+    Returns the endpoint of a backend url and, for a search, its page size,
+    e.g. "ExplanationOfBenefit _count=50"
+    """
+    count = parse_qs(urlparse(str(url)).query).get('_count')
+    endpoint = endpoint_for(url)
+    return "%s _count=%s" % (endpoint, count[-1]) if count else endpoint
+
+
+class CircuitBreaker(object):
+
+    def __init__(self, server_settings):
+        self.server_settings = server_settings
+        self._lock = threading.Lock()
+        self._latencies = {}
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._state = CLOSED
+            self._opened_at = 0
+            self._probes = 0
+            # (time, failed) of the calls in the window
+            self._calls = deque()
+            self._failures = 0
+            self._latencies.clear()
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._current_state(time.monotonic())
+
+    def _current_state(self, now):
+        if self._state == OPEN and now - self._opened_at >= self.server_settings.circuit_breaker_open_time:
+            self._transition(HALF_OPEN, now)
+        return self._state
+
+    def _transition(self, state, now):
+        previous, self._state = self._state, state
+        self._probes = 0
+        if state == OPEN:
+            self._opened_at = now
+        if state == CLOSED:
+            self._calls.clear()
+            self._failures = 0
+        breaker_logger.warning({"type": "bfd_circuit_breaker",
+                                "state": state,
+                                "previous_state": previous,
+                                **self._window_status(now)})
+
+    def _prune(self, now):
+        start = now - self.server_settings.circuit_breaker_window
+        while self._calls and self._calls[0][0] < start:
+            _, failed = self._calls.popleft()
+            self._failures -= failed
+
+    def _window_status(self, now):
+        self._prune(now)
+        calls = len(self._calls)
+        return {"calls": calls,
+                "failures": self._failures,
+                "error_rate": round(self._failures / calls, 3) if calls else 0}
+
+    def before_call(self):
+        """
+        Returns True when the call is a half-open probe,
+        raises CircuitOpen when the call is not allowed.
+        """
+        if not self.server_settings.circuit_breaker:
+            return False
+        now = time.monotonic()
+        with self._lock:
+            state = self._current_state(now)
+            if state == CLOSED:
+                return False
+            if state == HALF_OPEN and self._probes < self.server_settings.circuit_breaker_half_open_probes:
+                self._probes += 1
+                return True
+            if state == HALF_OPEN:
+                # Wait for the outcome of the probes in flight
+                raise CircuitOpen(1)
+            raise CircuitOpen(self._opened_at + self.server_settings.circuit_breaker_open_time - now)
+
+    def record(self, url, elapsed, failed, probe=False):
+        now = time.monotonic()
+        with self._lock:
+            if self.server_settings.adaptive_timeout:
+                key = latency_key(url)
+                samples = self._latencies.get(key)
+                if samples is None:
+                    samples = self._latencies[key] = deque(
+                        maxlen=self.server_settings.adaptive_timeout_samples)
+                samples.append(elapsed)
+
+            if not self.server_settings.circuit_breaker:
+                return
+
+            if probe and self._state == HALF_OPEN:
+                self._transition(OPEN if failed else CLOSED, now)
+                return
+
+            self._calls.append((now, failed))
+            self._failures += failed
+            self._prune(now)
+            if (self._state == CLOSED and failed
+                    and len(self._calls) >= self.server_settings.circuit_breaker_min_calls
+                    and self._failures / len(self._calls) >= self.server_settings.circuit_breaker_error_rate):
+                self._transition(OPEN, now)
+
+    def release(self, probe):
+        # A probe that ended without an outcome (e.g. cancelled)
+        if probe:
+            with self._lock:
+                if self._state == HALF_OPEN and self._probes:
+                    self._probes -= 1
+
+    def latency_percentile(self, url, percentile):
+        """
+        Returns the observed latency percentile of url's endpoint and page
+        size, None until it has CIRCUIT_BREAKER_MIN_CALLS samples.
+        """
+        with self._lock:
+            samples = self._latencies.get(latency_key(url))
+            if not samples or len(samples) < self.server_settings.circuit_breaker_min_calls:
+                return None
+            return self._percentile(samples, percentile)
+
+    def _percentile(self, samples, percentile):
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(math.ceil(percentile * len(ordered))) - 1)]
+
+    def timeout(self, url, timeout):
+        """
+        Returns the timeout of a call to url,
+        timeout is the upper bound asked by the caller.
+        """
+        if not self.server_settings.adaptive_timeout:
+            return timeout
+        p99 = self.latency_percentile(url, 0.99)
+        if p99 is None:
+            return timeout
+        adaptive = max(self.server_settings.adaptive_timeout_min,
+                       p99 * self.server_settings.adaptive_timeout_multiplier)
+        return adaptive if timeout is None else min(timeout, adaptive)
+
+    def call(self, url, timeout, send):
+        """
+        Returns send(timeout) through the breaker,
+        with timeout replaced by the adaptive timeout of url.
+        """
+        probe = self.before_call()
+        timeout = self.timeout(url, timeout)
+        start = time.monotonic()
+        recorded = False
+        try:
+            r = send(timeout)
+            self.record(url, time.monotonic() - start, r.status_code >= 500, probe)
+            recorded = True
+            return r
+        except Exception:
+            self.record(url, time.monotonic() - start, True, probe)
+            recorded = True
+            raise
+        finally:
+            if not recorded:
+                self.release(probe)
+
+    async def call_async(self, url, timeout, send):
+        probe = self.before_call()
+        timeout = self.timeout(url, timeout)
+        start = time.monotonic()
+        recorded = False
+        try:
+            r = await send(timeout)
+            self.record(url, time.monotonic() - start, r.status_code >= 500, probe)
+            recorded = True
+            return r
+        except Exception:
+            self.record(url, time.monotonic() - start, True, probe)
+            recorded = True
+            raise
+        finally:
+            if not recorded:
+                self.release(probe)
+
+    def status(self):
+        """
+        Breaker state and per endpoint and page size latencies, for the health checks
+        """
+        now = time.monotonic()
+        with self._lock:
+            state = self._current_state(now)
+            return {"state": state,
+                    **self._window_status(now),
+                    "retry_after": (max(0, math.ceil(self._opened_at + self.server_settings.circuit_breaker_open_time
+                                                     - now)) if state == OPEN else 0),
+                    "p99": {endpoint: round(self._percentile(samples, 0.99), 3)
+                            for endpoint, samples in self._latencies.items() if samples}}
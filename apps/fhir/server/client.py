@@ -0,0 +1,223 @@
+"""
+Process-wide HTTP client for calls to the backend FHIR server (BFD).
+
+All backend calls share one keep-alive connection pool per worker process,
+so the mTLS handshake with the client certificate is paid once per pooled
+connection instead of once per request.
+
+Pool sizing is configured in the FHIR_SERVER setting:
+
+FHIR_SERVER = {
+    "POOL_CONNECTIONS": 10,     # number of host pools to keep
+    "POOL_MAXSIZE": 10,         # max keep-alive connections per host
+    "POOL_IDLE_TIMEOUT": 60,    # seconds before an idle pool is recycled
+}
+
+async_backend_client is the non-blocking counterpart used by the ASGI
+FHIR views, on httpx.
+
+Both go through the circuit breaker of apps.fhir.server.breaker, and time
+the calls it lets through in the bfd metrics by resource type and version.
+"""
+import asyncio
+import logging
+import os
+import re
+import threading
+import time
+import weakref
+from urllib.parse import urlsplit
+
+import requests
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+try:
+    import httpx
+except ImportError:  # pragma: no cover
+    httpx = None
+
+import apps.logging.request_logger as bb2logging
+
+from apps.metrics.instruments import bfd_request_seconds, bfd_responses
+
+from .breaker import CircuitBreaker
+from .settings import fhir_settings
+
+logger = logging.getLogger(bb2logging.HHS_SERVER_LOGNAME_FMT.format(__name__))
+
+BACKEND_PATH = re.compile(r"/(v\d+)/fhir/([A-Za-z]+)")
+
+
+class BackendCallMetrics(object):
+    """
+    Times its block as a call to url in the bfd metrics, the block sets
+    .response to the response it got.
+    """
+
+    def __init__(self, url):
+        match = BACKEND_PATH.search(urlsplit(str(url)).path)
+        # e.g. ("Patient", "v2"), the metadata call is resource type "metadata"
+        self.labels = (match.group(2), match.group(1)) if match else ("other", "other")
+        self.response = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        status_code = self.response.status_code if self.response is not None else "error"
+        bfd_request_seconds.labels(*self.labels).observe(time.perf_counter() - self.start)
+        bfd_responses.labels(*(self.labels + (status_code,))).inc()
+
+
+class BackendClient(object):
+    """
+    Thin wrapper around a pooled requests.Session.
+
+    The session is created lazily (after a prefork server has forked) and is
+    re-created when the owning process changes or when the pool has been idle
+    longer than POOL_IDLE_TIMEOUT, so stale connections closed by BFD or the
+    load balancer are not reused.
+    """
+
+    def __init__(self, server_settings):
+        self.server_settings = server_settings
+        self._session = None
+        self._pid = None
+        self._last_used = 0
+        self._lock = threading.Lock()
+        self.breaker = CircuitBreaker(server_settings)
+
+    def certs(self):
+        if not self.server_settings.client_auth:
+            return None
+        # Join settings.FHIR_CLIENT_CERTSTORE to cert_file and key_file
+        return (os.path.join(settings.FHIR_CLIENT_CERTSTORE, self.server_settings.cert_file),
+                os.path.join(settings.FHIR_CLIENT_CERTSTORE, self.server_settings.key_file))
+
+    def _build_session(self):
+        s = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.server_settings.pool_connections,
+                              pool_maxsize=self.server_settings.pool_maxsize)
+        s.mount("https://", adapter)
+        s.mount("http://", adapter)
+        s.cert = self.certs()
+        s.verify = self.server_settings.verify_server
+        return s
+
+    @property
+    def session(self):
+        now = time.monotonic()
+        with self._lock:
+            idle_timeout = self.server_settings.pool_idle_timeout
+            if self._session is not None and (
+                    self._pid != os.getpid()
+                    or (idle_timeout and now - self._last_used > idle_timeout)):
+                logger.debug("Recycling backend FHIR connection pool")
+                self._close()
+            if self._session is None:
+                self._session = self._build_session()
+                self._pid = os.getpid()
+            self._last_used = now
+            return self._session
+
+    def prepare_request(self, req):
+        return self.session.prepare_request(req)
+
+    def send(self, prepped, timeout=None, **kwargs):
+        """
+        Send a prepared request over the shared pool.
+        timeout defaults to the FHIR_SERVER WAIT_TIME setting.
+        """
+        if timeout is None:
+            timeout = self.server_settings.wait_time
+        return self.breaker.call(prepped.url, timeout,
+                                 lambda timeout: self._send(prepped, timeout=timeout, **kwargs))
+
+    def _send(self, prepped, **kwargs):
+        with BackendCallMetrics(prepped.url) as call:
+            call.response = self.session.send(prepped, **kwargs)
+        return call.response
+
+    def get(self, url, timeout=None, **kwargs):
+        if timeout is None:
+            timeout = self.server_settings.wait_time
+        # With the query, the breaker times each page size on its own
+        breaker_url = requests.Request('GET', url, params=kwargs.get('params')).prepare().url
+        return self.breaker.call(breaker_url, timeout,
+                                 lambda timeout: self._get(url, timeout=timeout, **kwargs))
+
+    def _get(self, url, **kwargs):
+        with BackendCallMetrics(url) as call:
+            call.response = self.session.get(url, **kwargs)
+        return call.response
+
+    def _close(self):
+        if self._session is not None:
+            # Connections inherited from a parent process belong to it; just drop them.
+            if self._pid == os.getpid():
+                self._session.close()
+            self._session = None
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+
+class AsyncBackendClient(object):
+    """
+    Non-blocking counterpart of BackendClient.
+
+    One httpx.AsyncClient pool is kept per event loop. Where httpx is not
+    installed (it is in requirements.txt) the call falls back to the pooled
+    BackendClient in a worker thread, so the event loop is never blocked.
+    """
+
+    def __init__(self, server_settings, sync_client):
+        self.server_settings = server_settings
+        self.sync_client = sync_client
+        self._clients = weakref.WeakKeyDictionary()
+
+    def _client(self):
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            client = httpx.AsyncClient(
+                cert=self.sync_client.certs(),
+                verify=self.server_settings.verify_server,
+                limits=httpx.Limits(max_connections=None,
+                                    max_keepalive_connections=self.server_settings.pool_maxsize,
+                                    keepalive_expiry=self.server_settings.pool_idle_timeout))
+            self._clients[loop] = client
+        return client
+
+    def build_request(self, url, params=None, headers=None):
+        """
+        Returns an httpx.Request, or a requests.PreparedRequest without httpx.
+        Both expose the .headers used by the pre_fetch/post_fetch receivers.
+        """
+        if httpx is None:
+            return self.sync_client.prepare_request(
+                requests.Request('GET', url, params=params, headers=headers))
+        return self._client().build_request('GET', url, params=params, headers=headers)
+
+    async def send(self, req, timeout=None):
+        if timeout is None:
+            timeout = self.server_settings.wait_time
+        if httpx is None:
+            return await sync_to_async(self.sync_client.send, thread_sensitive=False)(req, timeout=timeout)
+
+        async def send(timeout):
+            req.extensions["timeout"] = httpx.Timeout(timeout).as_dict()
+            with BackendCallMetrics(req.url) as call:
+                call.response = await self._client().send(req)
+            return call.response
+
+        return await self.sync_client.breaker.call_async(str(req.url), timeout, send)
+
+
+backend_client = BackendClient(fhir_settings)
+async_backend_client = AsyncBackendClient(fhir_settings, backend_client)
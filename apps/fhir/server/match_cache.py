@@ -0,0 +1,73 @@
+"""
+In-process cache of recent match_fhir_id results, keyed by the MBI and
+HICN hashes, so repeated logins of a beneficiary do not search the
+backend Patient resource again.
+
+Settings:
+    FHIR_MATCH_CACHE_TTL = 300
+    FHIR_MATCH_CACHE_MAX_ENTRIES = 10000
+
+Entries are evicted least recently used past MAX_ENTRIES. Only matches
+are cached, a beneficiary that was not found is searched again on the
+next login.
+"""
+import threading
+import time
+
+from collections import OrderedDict
+from django.conf import settings
+
+
+class MatchCache(object):
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def ttl(self):
+        return getattr(settings, "FHIR_MATCH_CACHE_TTL", 0)
+
+    def get(self, mbi_hash, hicn_hash):
+        """
+        Returns (fhir_id, hash_lookup_type), or None on a miss.
+        """
+        if not self.ttl():
+            return None
+        key = (mbi_hash, hicn_hash)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, mbi_hash, hicn_hash, fhir_id, hash_lookup_type):
+        ttl = self.ttl()
+        if not ttl:
+            return
+        key = (mbi_hash, hicn_hash)
+        max_entries = getattr(settings, "FHIR_MATCH_CACHE_MAX_ENTRIES", 0)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.monotonic() + ttl, (fhir_id, hash_lookup_type))
+            while len(self._entries) > max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, fhir_id):
+        with self._lock:
+            for key in [k for k, entry in self._entries.items() if entry[1][0] == fhir_id]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+match_cache = MatchCache()
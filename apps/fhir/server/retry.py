@@ -0,0 +1,278 @@
+"""
+Retries and hedged requests for the idempotent (GET) calls of the FHIR
+views to the backend FHIR server (BFD).
+
+A call that fails with a connection error or a 502/503/504 response is
+retried after an exponential backoff with full jitter, up to
+RETRY_MAX_ATTEMPTS attempts. Retries are paid from a budget so they stay
+a bounded share of the load sent to BFD during an outage: every call adds
+RETRY_BUDGET_RATIO to the budget (capped at RETRY_BUDGET_MAX_TOKENS) and
+every retry or hedge spends 1.
+
+With HEDGE set, a second attempt is sent once the first has been running
+longer than the HEDGE_PERCENTILE latency of its endpoint (observed by the
+circuit breaker when ADAPTIVE_TIMEOUT is set), and the first response to
+arrive is used.
+
+The attempts of a call are set on its response as .attempts and are part
+of the fhir_post_fetch audit event.
+
+FHIR_SERVER = {
+    "RETRY_MAX_ATTEMPTS": 3,
+    "RETRY_BUDGET_RATIO": 0.1,
+    "RETRY_BUDGET_MAX_TOKENS": 10,
+    "RETRY_BACKOFF_BASE": 0.05,     # seconds
+    "RETRY_BACKOFF_MAX": 1,         # seconds
+    "HEDGE": False,
+    "HEDGE_PERCENTILE": 0.95,
+    "HEDGE_MAX_WORKERS": 20,        # threads sending the hedged calls
+}
+"""
+import asyncio
+import os
+import random
+import threading
+import time
+
+import requests
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+try:
+    import httpx
+except ImportError:  # pragma: no cover
+    httpx = None
+
+from .client import backend_client
+from .settings import fhir_settings
+
+IDEMPOTENT_METHODS = ('GET', 'HEAD')
+RETRY_STATUS_CODES = (502, 503, 504)
+
+# Errors raised before BFD could process the call. A read timeout is not
+# retried, the call may still be running on BFD.
+RETRY_EXCEPTIONS = (requests.ConnectionError,)
+if httpx is not None:
+    RETRY_EXCEPTIONS += (httpx.NetworkError, httpx.ConnectTimeout, httpx.RemoteProtocolError)
+
+
+class RetryBudget(object):
+
+    def __init__(self, server_settings):
+        self.server_settings = server_settings
+        self._lock = threading.Lock()
+        self.tokens = None
+
+    def deposit(self):
+        with self._lock:
+            max_tokens = self.server_settings.retry_budget_max_tokens
+            if self.tokens is None:
+                self.tokens = max_tokens
+            self.tokens = min(max_tokens, self.tokens + self.server_settings.retry_budget_ratio)
+
+    def withdraw(self):
+        with self._lock:
+            if self.tokens is None or self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class Attempts(list):
+    """
+    The attempts of a call, a hedged attempt is made from another thread.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.Lock()
+
+    def start(self, hedged):
+        with self.lock:
+            attempt = {"attempt": len(self) + 1, "hedged": hedged, "code": None, "error": None, "elapsed": None}
+            self.append(attempt)
+        return attempt
+
+    def update(self, attempt, **values):
+        with self.lock:
+            attempt.update(values)
+
+    def copy(self):
+        with self.lock:
+            return [dict(attempt) for attempt in self]
+
+
+def close_response(future):
+    # Releases the connection of an attempt whose response is not used
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+
+async def close_response_async(task):
+    if task.exception() is None:
+        r = task.result()
+        # An httpx response, or a requests one without httpx
+        await r.aclose() if hasattr(r, "aclose") else r.close()
+
+
+class BackendRetry(object):
+
+    def __init__(self, server_settings, breaker):
+        self.server_settings = server_settings
+        self.breaker = breaker
+        self.budget = RetryBudget(server_settings)
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def backoff(self, retry):
+        # Full jitter
+        cap = min(self.server_settings.retry_backoff_max,
+                  self.server_settings.retry_backoff_base * 2 ** (retry - 1))
+        return random.uniform(0, cap)
+
+    def hedge_delay(self, req):
+        if not self.server_settings.hedge:
+            return None
+        return self.breaker.latency_percentile(req.url, self.server_settings.hedge_percentile)
+
+    def executor(self):
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.server_settings.hedge_max_workers,
+                                                    thread_name_prefix="fhir-hedge")
+                self._pid = os.getpid()
+            return self._executor
+
+    def should_retry(self, attempt, r=None):
+        return ((r is None or r.status_code in RETRY_STATUS_CODES)
+                and attempt < self.server_settings.retry_max_attempts
+                and self.budget.withdraw())
+
+    def _attempt(self, req, send, timeout, attempts, hedged=False):
+        attempt = attempts.start(hedged)
+        start = time.monotonic()
+        try:
+            r = send(req, timeout=timeout)
+            attempts.update(attempt, code=r.status_code)
+            return r
+        except Exception as e:
+            attempts.update(attempt, error=type(e).__name__)
+            raise
+        finally:
+            attempts.update(attempt, elapsed=round(time.monotonic() - start, 3))
+
+    def _hedged_attempt(self, req, send, timeout, attempts):
+        delay = self.hedge_delay(req)
+        if delay is None:
+            return self._attempt(req, send, timeout, attempts)
+
+        first = self.executor().submit(self._attempt, req, send, timeout, attempts)
+        done, _ = wait([first], timeout=delay)
+        if done or not self.budget.withdraw():
+            return first.result()
+
+        second = self.executor().submit(self._attempt, req, send, timeout, attempts, True)
+        pending = {first, second}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    # The other attempt finishes in the background, its response is closed
+                    for other in {first, second} - {future}:
+                        other.add_done_callback(close_response)
+                    return future.result()
+        return first.result()
+
+    def send(self, req, send, timeout=None):
+        """
+        Returns send(req, timeout=timeout) with retries and hedging,
+        send makes one attempt.
+        """
+        if req.method not in IDEMPOTENT_METHODS:
+            return send(req, timeout=timeout)
+
+        self.budget.deposit()
+        attempts = Attempts()
+        attempt = 0
+        while True:
+            attempt += 1
+            if attempt > 1:
+                time.sleep(self.backoff(attempt - 1))
+            try:
+                r = self._hedged_attempt(req, send, timeout, attempts)
+            except RETRY_EXCEPTIONS:
+                if not self.should_retry(attempt):
+                    raise
+                continue
+            if not self.should_retry(attempt, r):
+                break
+        r.attempts = attempts.copy()
+        return r
+
+    async def _attempt_async(self, req, send, timeout, attempts, hedged=False):
+        attempt = attempts.start(hedged)
+        start = time.monotonic()
+        try:
+            r = await send(req, timeout=timeout)
+            attempts.update(attempt, code=r.status_code)
+            return r
+        except Exception as e:
+            attempts.update(attempt, error=type(e).__name__)
+            raise
+        finally:
+            attempts.update(attempt, elapsed=round(time.monotonic() - start, 3))
+
+    async def _hedged_attempt_async(self, req, send, timeout, attempts):
+        delay = self.hedge_delay(req)
+        if delay is None:
+            return await self._attempt_async(req, send, timeout, attempts)
+
+        first = asyncio.ensure_future(self._attempt_async(req, send, timeout, attempts))
+        done, _ = await asyncio.wait([first], timeout=delay)
+        if done or not self.budget.withdraw():
+            return await first
+
+        second = asyncio.ensure_future(self._attempt_async(req, send, timeout, attempts, True))
+        pending = {first, second}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        for other in done - {task}:
+                            # Both arrived, the other response is not used
+                            await close_response_async(other)
+                        return task.result()
+            return first.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def send_async(self, req, send, timeout=None):
+        """
+        Coroutine counterpart of send(), send is a coroutine function.
+        """
+        if req.method not in IDEMPOTENT_METHODS:
+            return await send(req, timeout=timeout)
+
+        self.budget.deposit()
+        attempts = Attempts()
+        attempt = 0
+        while True:
+            attempt += 1
+            if attempt > 1:
+                await asyncio.sleep(self.backoff(attempt - 1))
+            try:
+                r = await self._hedged_attempt_async(req, send, timeout, attempts)
+            except RETRY_EXCEPTIONS:
+                if not self.should_retry(attempt):
+                    raise
+                continue
+            if not self.should_retry(attempt, r):
+                break
+        r.attempts = attempts.copy()
+        return r
+
+
+backend_retry = BackendRetry(fhir_settings, backend_client.breaker)
@@ -22,6 +22,36 @@ DEFAULTS = {
     "SERVER_VERIFY": False,
     "WAIT_TIME": 30,
     "VERIFY_SERVER": False,
+    # Backend connection pool, see apps.fhir.server.client
+    "POOL_CONNECTIONS": 10,
+    "POOL_MAXSIZE": 10,
+    "POOL_IDLE_TIMEOUT": 60,
+    # Forward client If-None-Match / If-Modified-Since on searches
+    "FORWARD_CONDITIONAL_HEADERS": False,
+    # Coalesce identical concurrent backend calls, see apps.fhir.server.singleflight
+    "SINGLE_FLIGHT": True,
+    "SINGLE_FLIGHT_SHARED": False,
+    "SINGLE_FLIGHT_SHARED_TTL": 5,
+    # Circuit breaker and adaptive timeouts, see apps.fhir.server.breaker
+    "CIRCUIT_BREAKER": True,
+    "CIRCUIT_BREAKER_WINDOW": 60,
+    "CIRCUIT_BREAKER_MIN_CALLS": 20,
+    "CIRCUIT_BREAKER_ERROR_RATE": 0.5,
+    "CIRCUIT_BREAKER_OPEN_TIME": 30,
+    "CIRCUIT_BREAKER_HALF_OPEN_PROBES": 1,
+    "ADAPTIVE_TIMEOUT": True,
+    "ADAPTIVE_TIMEOUT_SAMPLES": 200,
+    "ADAPTIVE_TIMEOUT_MULTIPLIER": 2,
+    "ADAPTIVE_TIMEOUT_MIN": 5,
+    # Retries and hedged requests of the FHIR views, see apps.fhir.server.retry
+    "RETRY_MAX_ATTEMPTS": 3,
+    "RETRY_BUDGET_RATIO": 0.1,
+    "RETRY_BUDGET_MAX_TOKENS": 10,
+    "RETRY_BACKOFF_BASE": 0.05,
+    "RETRY_BACKOFF_MAX": 1,
+    "HEDGE": False,
+    "HEDGE_PERCENTILE": 0.95,
+    "HEDGE_MAX_WORKERS": 20,
 }
 
 # List of settings that cannot be empty
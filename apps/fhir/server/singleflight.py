@@ -0,0 +1,174 @@
+"""
+Single-flight coalescing of identical concurrent backend FHIR calls.
+
+Apps often send the same request several times in parallel on launch.
+While a backend call is in flight, identical calls (same beneficiary, url
+and conditional headers) wait for it and share its response instead of
+going to BFD themselves. Each caller gets its own copy of the response
+bound to its own request, so the fhir_post_fetch audit events are
+unchanged.
+
+Configured in the FHIR_SERVER setting:
+
+FHIR_SERVER = {
+    "SINGLE_FLIGHT": True,              # coalesce calls within a worker process
+    "SINGLE_FLIGHT_SHARED": False,      # also across workers, through the default cache
+    "SINGLE_FLIGHT_SHARED_TTL": 5,      # seconds a shared 200 response is kept
+}
+
+The shared mode stores backend responses in the Django cache for a few
+seconds, only enable it with a cache backend fit for beneficiary data.
+"""
+import asyncio
+import copy
+import hashlib
+import threading
+import time
+import weakref
+
+from datetime import timedelta
+from django.core.cache import cache
+from requests import Response
+from requests.structures import CaseInsensitiveDict
+
+from .settings import fhir_settings
+
+SHARED_KEY_PREFIX = "fhir_single_flight"
+SHARED_POLL_INTERVAL = 0.05
+
+
+class _Call(object):
+    __slots__ = ('event', 'response', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.response = None
+        self.error = None
+
+
+class SingleFlight(object):
+
+    def __init__(self, server_settings):
+        self.server_settings = server_settings
+        self._calls = {}
+        self._async_calls = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+        # Calls answered from another caller's response
+        self.coalesced = 0
+
+    def send(self, key, prepped, send, timeout=None):
+        """
+        Returns send() for the first caller of a key, and a copy of its
+        response for the identical calls made while it is in flight.
+        Waiting callers make their own call after timeout seconds.
+        """
+        if not self.server_settings.single_flight:
+            return send()
+
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            if not call.event.wait(timeout):
+                return send()
+            if call.error is not None:
+                raise call.error
+            self.coalesced += 1
+            return self._for_caller(call.response, prepped)
+
+        try:
+            if self.server_settings.single_flight_shared:
+                call.response = self._shared_send(key, prepped, send, timeout)
+            else:
+                call.response = send()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.response
+
+    async def send_async(self, key, req, send, timeout=None):
+        """
+        Coroutine counterpart of send() for the async views,
+        calls are coalesced per event loop.
+        """
+        if not self.server_settings.single_flight:
+            return await send()
+
+        calls = self._async_calls.setdefault(asyncio.get_running_loop(), {})
+        future = calls.get(key)
+        if future is not None:
+            try:
+                response = await asyncio.wait_for(asyncio.shield(future), timeout)
+            except asyncio.TimeoutError:
+                return await send()
+            self.coalesced += 1
+            return self._for_caller(response, req)
+
+        future = calls[key] = asyncio.get_running_loop().create_future()
+        try:
+            response = await send()
+            future.set_result(response)
+        except BaseException as e:
+            future.set_exception(e)
+            # Mark retrieved, there may be no waiter
+            future.exception()
+            raise
+        finally:
+            del calls[key]
+        return response
+
+    def _for_caller(self, response, req):
+        response = copy.copy(response)
+        response.request = req
+        return response
+
+    def _shared_send(self, key, prepped, send, timeout):
+        cache_key = "%s:%s" % (SHARED_KEY_PREFIX, hashlib.sha256(repr(key).encode('utf-8')).hexdigest())
+        lock_key = cache_key + ":lock"
+        ttl = self.server_settings.single_flight_shared_ttl
+
+        data = cache.get(cache_key)
+        if data is None and not cache.add(lock_key, 1, ttl):
+            # Another worker is making this call, wait while it holds the lock
+            deadline = time.monotonic() + (timeout or ttl)
+            while data is None and time.monotonic() < deadline and cache.get(lock_key) is not None:
+                time.sleep(SHARED_POLL_INTERVAL)
+                data = cache.get(cache_key)
+
+        if data is not None:
+            self.coalesced += 1
+            return self._from_shared(data, prepped)
+
+        try:
+            response = send()
+            if response.status_code == 200:
+                cache.set(cache_key, self._to_shared(response), ttl)
+        finally:
+            cache.delete(lock_key)
+        return response
+
+    def _to_shared(self, response):
+        return (response.status_code, dict(response.headers), response.content,
+                response.url, response.encoding, response.elapsed.total_seconds())
+
+    def _from_shared(self, data, prepped):
+        status_code, headers, content, url, encoding, elapsed = data
+        response = Response()
+        response.status_code = status_code
+        response.headers = CaseInsensitiveDict(headers)
+        response._content = content
+        response.url = url
+        response.encoding = encoding
+        response.elapsed = timedelta(seconds=elapsed)
+        response.request = prepped
+        return response
+
+
+backend_single_flight = SingleFlight(fhir_settings)
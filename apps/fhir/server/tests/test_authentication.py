@@ -1,4 +1,8 @@
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
 from django.test import RequestFactory
+from django.test.utils import override_settings
 from django.test.client import Client
 from httmock import HTTMock, urlmatch
 from requests.exceptions import HTTPError
@@ -233,3 +237,33 @@ class TestAuthentication(BaseApiTest):
                 fhir_id, hash_lookup_type = match_fhir_id(
                     mbi_hash=self.test_mbi_hash,
                     hicn_hash=self.test_hicn_hash, request=self.request)
+
+    @override_settings(FHIR_MATCH_CONCURRENT_LOOKUPS=True)
+    def test_match_fhir_id_concurrent_lookups(self):
+        '''
+            Same precedence rules with the HICN lookup sent concurrently:
+            MBI wins, then HICN, duplicates raise and both not_found raises NotFound
+        '''
+        cases = [
+            (self.fhir_match_hicn_success_mock, self.fhir_match_mbi_success_mock, ("-20000000002346", "M")),
+            (self.fhir_match_hicn_success_mock, self.fhir_match_mbi_not_found_mock, ("-20000000002346", "H")),
+            (self.fhir_match_hicn_duplicates_mock, self.fhir_match_mbi_success_mock, ("-20000000002346", "M")),
+            (self.fhir_match_hicn_error_mock, self.fhir_match_mbi_success_mock, ("-20000000002346", "M")),
+            (self.fhir_match_hicn_not_found_mock, self.fhir_match_mbi_not_found_mock, exceptions.NotFound),
+            (self.fhir_match_hicn_duplicates_mock, self.fhir_match_mbi_not_found_mock, UpstreamServerException),
+            (self.fhir_match_hicn_success_mock, self.fhir_match_mbi_duplicates_mock, UpstreamServerException),
+            (self.fhir_match_hicn_error_mock, self.fhir_match_mbi_not_found_mock, HTTPError),
+        ]
+        for hicn_mock, mbi_mock, expected in cases:
+            executor = ThreadPoolExecutor(max_workers=1)
+            with self.subTest(hicn=hicn_mock.__name__, mbi=mbi_mock.__name__), HTTMock(hicn_mock, mbi_mock), \
+                    patch('apps.fhir.server.authentication.search_executor', return_value=executor):
+                if isinstance(expected, tuple):
+                    self.assertEqual(match_fhir_id(mbi_hash=self.test_mbi_hash,
+                                                   hicn_hash=self.test_hicn_hash, request=self.request), expected)
+                else:
+                    with self.assertRaises(expected):
+                        match_fhir_id(mbi_hash=self.test_mbi_hash,
+                                      hicn_hash=self.test_hicn_hash, request=self.request)
+                # The HICN lookup is sent even when the MBI lookup matched
+                executor.shutdown(wait=True)
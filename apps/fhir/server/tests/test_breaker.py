@@ -0,0 +1,121 @@
+from unittest.mock import patch
+
+from django.test import SimpleTestCase
+
+from apps.fhir.server.settings import FHIRServerSettings, DEFAULTS
+from ..breaker import CircuitBreaker, CircuitOpen, CLOSED, HALF_OPEN, OPEN, endpoint_for, latency_key
+
+EOB_URL = "https://fhir.example.com/v2/fhir/ExplanationOfBenefit/?patient=-20140000008325"
+PATIENT_URL = "https://fhir.example.com/v2/fhir/Patient/-20140000008325"
+
+
+class Response(object):
+
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+class TestCircuitBreaker(SimpleTestCase):
+
+    def setUp(self):
+        self.now = 1000
+        monotonic = patch("apps.fhir.server.breaker.time.monotonic", side_effect=lambda: self.now)
+        monotonic.start()
+        self.addCleanup(monotonic.stop)
+
+    def _breaker(self, **user_settings):
+        return CircuitBreaker(FHIRServerSettings({"FHIR_URL": "https://fhir.example.com",
+                                                  "CIRCUIT_BREAKER_MIN_CALLS": 4,
+                                                  **user_settings},
+                                                 DEFAULTS))
+
+    def _call(self, breaker, status_code=200, url=EOB_URL, timeout=30):
+        return breaker.call(url, timeout, lambda timeout: Response(status_code))
+
+    def test_endpoint_for(self):
+        self.assertEqual(endpoint_for(EOB_URL), "ExplanationOfBenefit")
+        self.assertEqual(endpoint_for(PATIENT_URL), "Patient")
+        self.assertEqual(endpoint_for("https://fhir.example.com/v1/fhir/metadata"), "metadata")
+        self.assertEqual(latency_key(EOB_URL + "&_count=50"), "ExplanationOfBenefit _count=50")
+        self.assertEqual(latency_key(PATIENT_URL), "Patient")
+
+    def test_opens_on_error_rate(self):
+        breaker = self._breaker()
+        self._call(breaker)
+        self._call(breaker)
+        self._call(breaker, 500)
+        self.assertEqual(breaker.state, CLOSED)
+        self._call(breaker, 503)
+        self.assertEqual(breaker.state, OPEN)
+
+        with self.assertRaises(CircuitOpen) as cm:
+            self._call(breaker)
+        self.assertEqual(cm.exception.status_code, 503)
+        self.assertEqual(cm.exception.wait, 30)
+
+    def test_errors_outside_window_ignored(self):
+        breaker = self._breaker()
+        self._call(breaker, 500)
+        self._call(breaker, 500)
+        self.now += 61
+        self._call(breaker)
+        self._call(breaker, 500)
+        self.assertEqual(breaker.state, CLOSED)
+
+    def test_exceptions_are_failures(self):
+        breaker = self._breaker(CIRCUIT_BREAKER_MIN_CALLS=1)
+
+        def send(timeout):
+            raise ConnectionError()
+
+        with self.assertRaises(ConnectionError):
+            breaker.call(EOB_URL, 30, send)
+        self.assertEqual(breaker.state, OPEN)
+
+    def test_half_open_probe(self):
+        breaker = self._breaker(CIRCUIT_BREAKER_MIN_CALLS=1)
+        self._call(breaker, 500)
+        self.now += 30
+        self.assertEqual(breaker.state, HALF_OPEN)
+
+        # One probe at a time
+        self.assertTrue(breaker.before_call())
+        with self.assertRaises(CircuitOpen):
+            breaker.before_call()
+
+        # A failed probe opens the breaker again
+        breaker.record(EOB_URL, 0.1, True, probe=True)
+        self.assertEqual(breaker.state, OPEN)
+
+        self.now += 30
+        self._call(breaker)
+        self.assertEqual(breaker.state, CLOSED)
+        self.assertEqual(breaker.status()["calls"], 0)
+
+    def test_adaptive_timeout(self):
+        breaker = self._breaker(ADAPTIVE_TIMEOUT_MIN=1)
+        for elapsed in (1, 2, 3):
+            breaker.record(EOB_URL, elapsed, False)
+        # Not enough samples yet
+        self.assertEqual(breaker.timeout(EOB_URL, 30), 30)
+
+        breaker.record(EOB_URL, 4, False)
+        self.assertEqual(breaker.timeout(EOB_URL, 30), 8)
+        self.assertEqual(breaker.timeout(EOB_URL, 5), 5)
+        # Timeouts are per endpoint
+        self.assertEqual(breaker.timeout(PATIENT_URL, 30), 30)
+        self.assertEqual(breaker.status()["p99"], {"ExplanationOfBenefit": 4})
+        # and per page size
+        self.assertEqual(breaker.timeout(EOB_URL + "&_count=50", 30), 30)
+
+        breaker = self._breaker(ADAPTIVE_TIMEOUT_MIN=10)
+        for elapsed in (1, 2, 3, 4):
+            breaker.record(EOB_URL, elapsed, False)
+        self.assertEqual(breaker.timeout(EOB_URL, 30), 10)
+
+    def test_disabled(self):
+        breaker = self._breaker(CIRCUIT_BREAKER=False, ADAPTIVE_TIMEOUT=False, CIRCUIT_BREAKER_MIN_CALLS=1)
+        for _ in range(5):
+            self._call(breaker, 500)
+        self.assertEqual(breaker.state, CLOSED)
+        self.assertEqual(breaker.timeout(EOB_URL, 30), 30)
@@ -0,0 +1,41 @@
+from unittest.mock import patch
+
+from django.test import SimpleTestCase
+
+from apps.fhir.server.settings import FHIRServerSettings, DEFAULTS
+from ..client import BackendClient
+
+
+class TestBackendClient(SimpleTestCase):
+
+    def _client(self, **user_settings):
+        return BackendClient(FHIRServerSettings({"FHIR_URL": "https://fhir.example.com", **user_settings},
+                                                DEFAULTS))
+
+    def test_session_is_shared(self):
+        client = self._client()
+        self.assertIs(client.session, client.session)
+
+    def test_session_pool_settings(self):
+        client = self._client(POOL_CONNECTIONS=3, POOL_MAXSIZE=7, CLIENT_AUTH=True,
+                              CERT_FILE="/certs/cert.pem", KEY_FILE="/certs/key.pem")
+        adapter = client.session.get_adapter("https://fhir.example.com")
+        self.assertEqual(adapter._pool_connections, 3)
+        self.assertEqual(adapter._pool_maxsize, 7)
+        self.assertEqual(client.session.cert, ("/certs/cert.pem", "/certs/key.pem"))
+
+    def test_session_recycled_when_idle(self):
+        client = self._client(POOL_IDLE_TIMEOUT=10)
+        with patch("apps.fhir.server.client.time.monotonic", return_value=100):
+            first = client.session
+        with patch("apps.fhir.server.client.time.monotonic", return_value=105):
+            self.assertIs(client.session, first)
+        with patch("apps.fhir.server.client.time.monotonic", return_value=200):
+            self.assertIsNot(client.session, first)
+
+    def test_get_uses_wait_time(self):
+        client = self._client(WAIT_TIME=12)
+        with patch.object(client.session, "send") as mock_send:
+            mock_send.return_value.status_code = 200
+            client.get("https://fhir.example.com/v1/fhir/metadata")
+        self.assertEqual(mock_send.call_args[1]["timeout"], 12)
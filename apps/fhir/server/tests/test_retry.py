@@ -0,0 +1,154 @@
+import asyncio
+import threading
+
+import requests
+
+from unittest.mock import patch
+
+from django.test import SimpleTestCase
+
+from apps.fhir.server.settings import FHIRServerSettings, DEFAULTS
+from ..retry import BackendRetry
+
+EOB_URL = "https://fhir.example.com/v2/fhir/ExplanationOfBenefit/?patient=-20140000008325"
+
+
+class Request(object):
+
+    def __init__(self, method='GET', url=EOB_URL):
+        self.method = method
+        self.url = url
+
+
+class Response(object):
+
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.closed = threading.Event()
+
+    def close(self):
+        self.closed.set()
+
+
+class Breaker(object):
+
+    def __init__(self, percentile=None):
+        self.percentile = percentile
+
+    def latency_percentile(self, url, percentile):
+        return self.percentile
+
+
+@patch("apps.fhir.server.retry.time.sleep")
+class TestBackendRetry(SimpleTestCase):
+
+    def _retry(self, breaker=None, **user_settings):
+        return BackendRetry(FHIRServerSettings({"FHIR_URL": "https://fhir.example.com", **user_settings}, DEFAULTS),
+                            breaker or Breaker())
+
+    def _sender(self, *outcomes):
+        outcomes = list(outcomes)
+        calls = []
+
+        def send(req, timeout=None):
+            calls.append(req)
+            outcome = outcomes.pop(0)
+            if isinstance(outcome, Exception):
+                raise outcome
+            return Response(outcome)
+
+        return send, calls
+
+    def test_retries_connection_error(self, mock_sleep):
+        send, calls = self._sender(requests.ConnectionError("reset"), 200)
+        r = self._retry().send(Request(), send, timeout=30)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(mock_sleep.call_count, 1)
+        self.assertEqual([(a["attempt"], a["code"], a["error"]) for a in r.attempts],
+                         [(1, None, "ConnectionError"), (2, 200, None)])
+
+    def test_retries_gateway_errors(self, mock_sleep):
+        send, calls = self._sender(503, 502, 504)
+        r = self._retry().send(Request(), send)
+        # The last response is returned after RETRY_MAX_ATTEMPTS
+        self.assertEqual(r.status_code, 504)
+        self.assertEqual(len(calls), 3)
+
+    def test_no_retry(self, mock_sleep):
+        # Server errors, read timeouts and other methods are not retried
+        send, calls = self._sender(500)
+        self.assertEqual(self._retry().send(Request(), send).status_code, 500)
+
+        send, calls = self._sender(requests.ReadTimeout())
+        with self.assertRaises(requests.ReadTimeout):
+            self._retry().send(Request(), send)
+
+        send, calls = self._sender(503)
+        r = self._retry().send(Request(method='POST'), send)
+        self.assertEqual(r.status_code, 503)
+        self.assertFalse(hasattr(r, 'attempts'))
+
+    def test_retry_budget(self, mock_sleep):
+        retry = self._retry(RETRY_BUDGET_MAX_TOKENS=1, RETRY_BUDGET_RATIO=0.5)
+        send, calls = self._sender(503, 503, 200)
+        # One token, one retry
+        self.assertEqual(retry.send(Request(), send).status_code, 503)
+        self.assertEqual(len(calls), 2)
+
+        send, calls = self._sender(503, 200)
+        self.assertEqual(retry.send(Request(), send).status_code, 503)
+        send, calls = self._sender(503, 200)
+        self.assertEqual(retry.send(Request(), send).status_code, 200)
+
+    def test_backoff(self, mock_sleep):
+        retry = self._retry(RETRY_BACKOFF_BASE=0.1, RETRY_BACKOFF_MAX=0.3)
+        with patch("apps.fhir.server.retry.random.uniform", side_effect=lambda a, b: b):
+            self.assertEqual([retry.backoff(n) for n in (1, 2, 3, 4)], [0.1, 0.2, 0.3, 0.3])
+
+    def test_hedged_request(self, mock_sleep):
+        retry = self._retry(Breaker(percentile=0.01), HEDGE=True)
+        release = threading.Event()
+        calls = []
+        slow = Response(200)
+
+        def send(req, timeout=None):
+            calls.append(req)
+            if len(calls) == 1:
+                # The first attempt is slow
+                release.wait(5)
+                return slow
+            return Response(203)
+
+        r = retry.send(Request(), send)
+        release.set()
+        self.assertEqual(r.status_code, 203)
+        self.assertEqual([(a["attempt"], a["hedged"]) for a in r.attempts], [(1, False), (2, True)])
+        # The response of the slow attempt is closed once it arrives
+        self.assertTrue(slow.closed.wait(5))
+        self.assertFalse(r.closed.is_set())
+
+    def test_hedged_request_async(self, mock_sleep):
+        retry = self._retry(Breaker(percentile=0.01), HEDGE=True)
+        cancelled = []
+
+        async def send(req, timeout=None):
+            if not cancelled:
+                cancelled.append(False)
+                try:
+                    await asyncio.sleep(5)
+                except asyncio.CancelledError:
+                    cancelled[0] = True
+                    raise
+            return Response(200)
+
+        async def run():
+            r = await retry.send_async(Request(), send)
+            # Let the cancellation of the slow attempt run
+            await asyncio.sleep(0)
+            return r
+
+        r = asyncio.run(run())
+        self.assertEqual(r.status_code, 200)
+        self.assertTrue(r.attempts[1]["hedged"])
+        self.assertEqual(cancelled, [True])
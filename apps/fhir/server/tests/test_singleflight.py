@@ -0,0 +1,76 @@
+import threading
+
+from django.test import SimpleTestCase
+from requests import PreparedRequest, Response
+
+from apps.fhir.server.settings import FHIRServerSettings, DEFAULTS
+from ..singleflight import SingleFlight
+
+
+def prepared(url):
+    prepped = PreparedRequest()
+    prepped.prepare(method='GET', url=url)
+    return prepped
+
+
+class TestSingleFlight(SimpleTestCase):
+
+    def _single_flight(self, **user_settings):
+        return SingleFlight(FHIRServerSettings({"FHIR_URL": "https://fhir.example.com", **user_settings},
+                                               DEFAULTS))
+
+    def test_identical_calls_coalesced(self):
+        single_flight = self._single_flight()
+        release = threading.Event()
+        calls = []
+
+        def send():
+            calls.append(1)
+            release.wait(5)
+            response = Response()
+            response.status_code = 200
+            response._content = b'{}'
+            return response
+
+        results = {}
+
+        def call(name):
+            prepped = prepared('https://fhir.example.com/Patient/%s' % name)
+            results[name] = (prepped, single_flight.send('key', prepped, send, timeout=5))
+
+        leader = threading.Thread(target=call, args=('leader',))
+        leader.start()
+        while not calls:
+            pass
+        followers = [threading.Thread(target=call, args=(n,)) for n in ('a', 'b')]
+        for t in followers:
+            t.start()
+        while len(single_flight._calls['key'].event._cond._waiters) < 2:
+            pass
+        release.set()
+        for t in [leader] + followers:
+            t.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(single_flight.coalesced, 2)
+        for name in ('a', 'b'):
+            prepped, response = results[name]
+            # Each caller gets a response bound to its own request
+            self.assertIs(response.request, prepped)
+            self.assertEqual(response.content, b'{}')
+        self.assertEqual(single_flight._calls, {})
+
+    def test_error_raised(self):
+        single_flight = self._single_flight()
+
+        def send():
+            raise ConnectionError("backend down")
+
+        with self.assertRaises(ConnectionError):
+            single_flight.send('key', prepared('https://fhir.example.com/'), send)
+        self.assertEqual(single_flight._calls, {})
+
+    def test_disabled(self):
+        single_flight = self._single_flight(SINGLE_FLIGHT=False)
+        self.assertEqual(single_flight.send('key', None, lambda: 'response'), 'response')
+        self.assertEqual(single_flight._calls, {})
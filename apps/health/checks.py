@@ -1,10 +1,10 @@
 import logging
-import requests
 
 from django.db import connection
 
 from apps.fhir.bluebutton.utils import get_resourcerouter
-from apps.fhir.server import connection as backend_connection
+from apps.fhir.server.breaker import CLOSED, OPEN
+from apps.fhir.server.client import backend_client
 from apps.mymedicare_cb.authorization import OAuth2ConfigSLSx
 
 import apps.logging.request_logger as bb2logging
@@ -20,11 +20,9 @@ def django_rds_database(v2=False):
 def bfd_fhir_dataserver(v2=False):
     resource_router = get_resourcerouter()
     target_url = "{}{}".format(resource_router.fhir_url, "/v2/fhir/metadata" if v2 else "/v1/fhir/metadata")
-    r = requests.get(target_url,
-                     params={"_format": "json"},
-                     cert=backend_connection.certs(),
-                     verify=False,
-                     timeout=5)
+    r = backend_client.get(target_url,
+                           params={"_format": "json"},
+                           timeout=5)
     try:
         r.raise_for_status()
     except Exception:
@@ -33,6 +31,13 @@ def bfd_fhir_dataserver(v2=False):
     return r.json()
 
 
+def bfd_circuit_breaker(v2=False):
+    status = backend_client.breaker.status()
+    if status["state"] != CLOSED:
+        logger.warning("BFD circuit breaker is {state}: {status}".format(state=status["state"], status=status))
+    return status["state"] != OPEN
+
+
 def slsx(v2=False):
     # Perform health check on SLSx service
     slsx_client = OAuth2ConfigSLSx()
@@ -44,6 +49,7 @@ internal_services = (
 )
 
 external_services = (
+    bfd_circuit_breaker,
     bfd_fhir_dataserver,
     slsx,
 )
@@ -53,6 +59,7 @@ slsx_services = (
 )
 
 bfd_services = (
+    bfd_circuit_breaker,
     bfd_fhir_dataserver,
 )
 
@@ -0,0 +1,258 @@
+"""
+Background writer of the audit log records of BasicLogger/RequestLogger.
+
+The loggers put their records on a bounded queue and return. A writer
+thread per worker process takes them off in batches, serializes them to
+JSON and hands them to the logging handlers, so neither the serializing
+nor the handler I/O is paid by the request.
+
+When the queue is full AUDIT_LOG_QUEUE_OVERFLOW decides:
+    "block"  waits for room, no record is lost
+    "drop"   drops the record and counts it, the writer logs the count
+    "spill"  appends the record to a file of the process in
+             AUDIT_LOG_QUEUE_SPILL_DIR, read back by the writer once it
+             caught up with the queue
+
+Spill files are only readable by the server's user. A writer starting also
+reads back the files left by stopped workers, and by an earlier process
+with its pid.
+
+The queue is written out at exit, for at most AUDIT_LOG_QUEUE_SHUTDOWN_TIMEOUT
+seconds.
+
+Settings:
+    AUDIT_LOG_QUEUE_SIZE = 10000        # 0 logs on the calling thread
+    AUDIT_LOG_QUEUE_BATCH_SIZE = 100
+    AUDIT_LOG_QUEUE_OVERFLOW = "block"
+    AUDIT_LOG_QUEUE_SPILL_DIR = "/tmp/bb2_audit_spill"
+    AUDIT_LOG_QUEUE_SHUTDOWN_TIMEOUT = 10
+"""
+import atexit
+import itertools
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+from django.conf import settings
+
+from apps.metrics.instruments import audit_log_queue_depth, audit_log_records_dropped
+from apps.metrics.registry import pid_running
+
+logger = logging.getLogger("hhs_server.{}".format(__name__))
+
+STOP = object()
+
+
+class JSONMessage(object):
+    """
+    Message of a queued record, serialized by format_for_output() of its
+    logger when first formatted.
+    """
+    __slots__ = ("_logger", "_data_dict", "_cls", "_text")
+
+    def __init__(self, audit_logger, data_dict, cls=None):
+        self._logger = audit_logger
+        # A copy, the caller may reuse its dict
+        self._data_dict = dict(data_dict)
+        self._cls = cls
+        self._text = None
+
+    def __str__(self):
+        if self._text is None:
+            self._text = self._logger.format_for_output(self._data_dict, cls=self._cls)
+        return self._text
+
+
+class AuditLogQueue(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._spill_lock = threading.Lock()
+        self._claims = itertools.count()
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self.dropped = 0
+        self._reported_dropped = 0
+
+    def enabled(self):
+        return getattr(settings, "AUDIT_LOG_QUEUE_SIZE", 0) > 0
+
+    def _running(self):
+        return self._pid == os.getpid() and self._thread.is_alive()
+
+    def _start(self):
+        with self._lock:
+            # A forked worker starts a writer of its own
+            if self._pid is not None and self._running():
+                return
+            self._queue = queue.Queue(settings.AUDIT_LOG_QUEUE_SIZE)
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="audit-log-writer", daemon=True)
+            self._thread.start()
+
+    def put(self, record):
+        if self._pid is None or not self._running():
+            self._start()
+        overflow = getattr(settings, "AUDIT_LOG_QUEUE_OVERFLOW", "block")
+        if overflow == "block":
+            self._queue.put(record)
+            return
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            if overflow == "spill":
+                self._spill(record)
+            else:
+                with self._lock:
+                    self.dropped += 1
+                audit_log_records_dropped.inc()
+
+    def _spill_dir(self):
+        return settings.AUDIT_LOG_QUEUE_SPILL_DIR
+
+    def _spill_path(self):
+        return os.path.join(self._spill_dir(), "%s.log" % os.getpid())
+
+    def _spill(self, record):
+        entry = {
+            "name": record.name,
+            "levelno": record.levelno,
+            "created": record.created,
+            "msg": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc_text"] = logging.Formatter().formatException(record.exc_info)
+        with self._spill_lock:
+            # The records hold request details, only the server's user reads them
+            os.makedirs(self._spill_dir(), mode=0o700, exist_ok=True)
+            fd = os.open(self._spill_path(), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+            with os.fdopen(fd, "a") as spill:
+                spill.write(json.dumps(entry) + "\n")
+
+    def _claim(self, path, pid):
+        """
+        Moves a spill file to a name of this process, None when another
+        writer claimed it first.
+        """
+        claimed = os.path.join(self._spill_dir(), "%s.%s.%s.replay" % (pid, os.getpid(), next(self._claims)))
+        try:
+            os.rename(path, claimed)
+        except FileNotFoundError:
+            return None
+        return claimed
+
+    def _replay_spill(self):
+        with self._spill_lock:
+            claimed = self._claim(self._spill_path(), os.getpid())
+        if claimed is not None:
+            self._write_spilled(claimed)
+
+    def _replay_stale_spills(self):
+        # "<pid>.log" spilled, "<pid>.<writer pid>.<n>.replay" being read back
+        try:
+            names = sorted(os.listdir(self._spill_dir()))
+        except FileNotFoundError:
+            return
+        for name in names:
+            parts = name.split(".")
+            try:
+                owner = int(parts[1] if name.endswith(".replay") else parts[0])
+            except (IndexError, ValueError):
+                continue
+            if owner != os.getpid() and pid_running(owner):
+                continue
+            claimed = self._claim(os.path.join(self._spill_dir(), name), parts[0])
+            if claimed is not None:
+                self._write_spilled(claimed)
+
+    def _write_spilled(self, path):
+        with open(path) as spill:
+            for line in spill:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Cut short by a stopped worker
+                    continue
+                record = logging.makeLogRecord({
+                    "name": entry["name"],
+                    "levelno": entry["levelno"],
+                    "levelname": logging.getLevelName(entry["levelno"]),
+                    "created": entry["created"],
+                    "msg": entry["msg"],
+                    "exc_text": entry.get("exc_text"),
+                })
+                logging.getLogger(record.name).handle(record)
+        os.remove(path)
+
+    def _report_dropped(self):
+        with self._lock:
+            dropped = self.dropped - self._reported_dropped
+            self._reported_dropped = self.dropped
+        if dropped:
+            logger.warning("Dropped %s audit log records, the queue was full", dropped)
+
+    def _run(self):
+        records = self._queue
+        batch_size = getattr(settings, "AUDIT_LOG_QUEUE_BATCH_SIZE", 100)
+        try:
+            self._replay_stale_spills()
+        except Exception:
+            logger.exception("Could not write the spilled audit log records of stopped workers")
+        stopped = False
+        while not stopped:
+            batch = [records.get()]
+            try:
+                while len(batch) < batch_size:
+                    batch.append(records.get_nowait())
+            except queue.Empty:
+                pass
+            for record in batch:
+                if record is STOP:
+                    stopped = True
+                    continue
+                try:
+                    logging.getLogger(record.name).handle(record)
+                except Exception:
+                    logger.exception("Could not write an audit log record")
+            try:
+                if records.empty():
+                    self._replay_spill()
+                    self._report_dropped()
+            except Exception:
+                logger.exception("Could not write the spilled audit log records")
+            for record in batch:
+                records.task_done()
+            audit_log_queue_depth.set(records.qsize())
+
+    def flush(self, timeout=None):
+        """
+        Waits until the queued records are written, True when they are.
+        """
+        if self._pid is None or not self._running():
+            return True
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._queue.all_tasks_done.wait(remaining)
+        return True
+
+    def stop(self):
+        if self._pid is None or not self._running():
+            return
+        timeout = getattr(settings, "AUDIT_LOG_QUEUE_SHUTDOWN_TIMEOUT", 10)
+        try:
+            self._queue.put(STOP, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout)
+
+
+audit_log_queue = AuditLogQueue()
+atexit.register(audit_log_queue.stop)
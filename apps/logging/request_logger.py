@@ -1,8 +1,10 @@
 import logging
-import json
+import sys
 
 from django.conf import settings
+from apps.core import json_encoding
 from apps.dot_ext.loggers import get_session_auth_flow_trace
+from apps.logging.audit_queue import JSONMessage, audit_log_queue
 
 CRITICAL = logging.CRITICAL
 FATAL = logging.FATAL
@@ -64,31 +66,37 @@ class BasicLogger:
 
     def format_for_output(self, data_dict, cls=None):
         try:
-            if settings.LOG_JSON_FORMAT_PRETTY:
-                args = {"sort_keys": True, "indent": 2, "cls": cls}
-            else:
-                args = {"cls": cls}
-            return json.dumps(data_dict, **args)
+            return json_encoding.dumps(data_dict, cls=cls, pretty=bool(settings.LOG_JSON_FORMAT_PRETTY))
         except Exception:
             return "Could not turn the data_dict into a JSON dump"
 
+    def _log(self, level, data_dict, cls=None, exc_info=None):
+        if not audit_log_queue.enabled():
+            self._logger.log(level, self.format_for_output(data_dict, cls=cls), exc_info=exc_info)
+        elif self._logger.isEnabledFor(level):
+            # Serialized and written by the audit log writer thread
+            audit_log_queue.put(self._logger.makeRecord(
+                self._logger.name, level, "(unknown file)", 0,
+                JSONMessage(self, data_dict, cls), None, sys.exc_info() if exc_info else None,
+            ))
+
     def debug(self, data_dict, cls=None):
-        self._logger.debug(self.format_for_output(data_dict, cls=cls))
+        self._log(DEBUG, data_dict, cls=cls)
 
     def info(self, data_dict, cls=None):
-        self._logger.info(self.format_for_output(data_dict, cls=cls))
+        self._log(INFO, data_dict, cls=cls)
 
     def error(self, data_dict, cls=None):
-        self._logger.error(self.format_for_output(data_dict, cls=cls))
+        self._log(ERROR, data_dict, cls=cls)
 
     def warning(self, data_dict, cls=None):
-        self._logger.warning(self.format_for_output(data_dict, cls=cls))
+        self._log(WARNING, data_dict, cls=cls)
 
     def critical(self, data_dict, cls=None):
-        self._logger.critical(self.format_for_output(data_dict, cls=cls))
+        self._log(CRITICAL, data_dict, cls=cls)
 
     def exception(self, data_dict, cls=None):
-        self._logger.exception(self.format_for_output(data_dict, cls=cls))
+        self._log(ERROR, data_dict, cls=cls, exc_info=True)
 
     def setLevel(self, lvl):
         self._logger.setLevel(lvl)
@@ -134,19 +142,10 @@ class RequestLogger(BasicLogger):
         return super().format_for_output(merged_dict, cls=cls)
 
     def debug(self, data_dict, request=None, cls=None):
-        self._logger.debug(self.format_for_output(data_dict, cls=cls))
+        self._log(DEBUG, data_dict, cls=cls)
 
     def info(self, data_dict, request=None, cls=None):
-        self._logger.info(self.format_for_output(data_dict, cls=cls))
+        self._log(INFO, data_dict, cls=cls)
 
     def error(self, data_dict, request=None, cls=None):
-        self._logger.error(self.format_for_output(data_dict, cls=cls))
-
-    def warning(self, data_dict, cls=None):
-        self._logger.warning(self.format_for_output(data_dict, cls=cls))
-
-    def critical(self, data_dict, cls=None):
-        self._logger.critical(self.format_for_output(data_dict, cls=cls))
-
-    def exception(self, data_dict, cls=None):
-        self._logger.exception(self.format_for_output(data_dict, cls=cls))
+        self._log(ERROR, data_dict, cls=cls)
@@ -213,7 +213,9 @@ class Response:
         return self.resp.status_code
 
     def size(self):
-        return len(self.resp.content)
+        # streamed responses record their size as they are forwarded
+        streamed_size = getattr(self.resp, 'streamed_size', None)
+        return streamed_size if streamed_size is not None else len(self.resp.content)
 
     def elapsed(self):
         return self.resp.elapsed.total_seconds()
@@ -241,6 +243,10 @@ class FHIRResponse(Response):
         super_dict.update({"api_ver": self.api_ver if self.api_ver is not None else 'v1'})
         # over write type
         super_dict.update({"type": "fhir_post_fetch"})
+        # retried or hedged calls, see apps.fhir.server.retry
+        attempts = getattr(self.resp, 'attempts', None)
+        if attempts is not None:
+            super_dict.update({"attempts": attempts})
         return super_dict
 
 
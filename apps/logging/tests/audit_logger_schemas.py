@@ -249,6 +249,7 @@ def get_post_fetch_fhir_log_entry_schema(version):
             "code": {"type": "integer", "enum": [status.HTTP_200_OK]},
             "size": {"type": "integer"},
             "elapsed": {"type": "number"},
+            "attempts": {"type": "array", "items": {"type": "object", "required": ["attempt", "code", "elapsed"]}},
         },
         "required": [
             "type",
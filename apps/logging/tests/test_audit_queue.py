@@ -0,0 +1,122 @@
+import json
+import os
+import stat
+import tempfile
+import threading
+
+from django.test import SimpleTestCase, override_settings
+
+import apps.logging.request_logger as logging
+from apps.logging.audit_queue import AuditLogQueue, audit_log_queue
+from apps.logging.utils import cleanup_logger, get_log_content, redirect_loggers_custom
+
+TEST_LOGGER = "audit.test.queue"
+
+
+class BlockingHandler(logging.StreamHandler):
+    """
+    Holds the writer on its first record until released.
+    """
+
+    def __init__(self, stream):
+        super().__init__(stream)
+        self.entered = threading.Event()
+        self.released = threading.Event()
+
+    def emit(self, record):
+        self.entered.set()
+        self.released.wait(5)
+        super().emit(record)
+
+
+class TestAuditLogQueue(SimpleTestCase):
+
+    def setUp(self):
+        self.logger_registry = redirect_loggers_custom([TEST_LOGGER])
+        self.audit_logger = logging.getLogger(TEST_LOGGER)
+
+    def tearDown(self):
+        cleanup_logger(self.logger_registry)
+
+    def _lines(self):
+        return get_log_content(self.logger_registry, TEST_LOGGER, [TEST_LOGGER]).splitlines()
+
+    def _record(self, n):
+        return self.audit_logger.logger().makeRecord(
+            TEST_LOGGER, logging.INFO, "(unknown file)", 0, json.dumps({"n": n}), None, None)
+
+    def _fill(self, log_queue, handler):
+        # One record held by the writer and one queued fill the queue
+        log_queue.put(self._record(1))
+        handler.entered.wait(5)
+        log_queue.put(self._record(2))
+
+    @override_settings(AUDIT_LOG_QUEUE_SIZE=100)
+    def test_written_by_writer(self):
+        self.audit_logger.info({"type": "first"})
+        self.audit_logger.info({"type": "second"})
+        self.assertTrue(audit_log_queue.flush(5))
+        lines = self._lines()
+        self.assertEqual([json.loads(line)["type"] for line in lines], ["first", "second"])
+
+    @override_settings(AUDIT_LOG_QUEUE_SIZE=1, AUDIT_LOG_QUEUE_OVERFLOW="drop")
+    def test_drop(self):
+        log_queue = AuditLogQueue()
+        handler = BlockingHandler(self.logger_registry[TEST_LOGGER][0])
+        self.audit_logger.logger().addHandler(handler)
+        try:
+            self._fill(log_queue, handler)
+            log_queue.put(self._record(3))
+            self.assertEqual(log_queue.dropped, 1)
+            handler.released.set()
+            self.assertTrue(log_queue.flush(5))
+        finally:
+            self.audit_logger.logger().removeHandler(handler)
+        lines = self._lines()
+        self.assertEqual(sorted({json.loads(line)["n"] for line in lines}), [1, 2])
+
+    def test_spill(self):
+        with tempfile.TemporaryDirectory() as spill_dir:
+            with override_settings(AUDIT_LOG_QUEUE_SIZE=1, AUDIT_LOG_QUEUE_OVERFLOW="spill",
+                                   AUDIT_LOG_QUEUE_SPILL_DIR=spill_dir):
+                log_queue = AuditLogQueue()
+                handler = BlockingHandler(self.logger_registry[TEST_LOGGER][0])
+                self.audit_logger.logger().addHandler(handler)
+                try:
+                    self._fill(log_queue, handler)
+                    log_queue.put(self._record(3))
+                    spill_path = os.path.join(spill_dir, "%s.log" % os.getpid())
+                    self.assertEqual(stat.S_IMODE(os.stat(spill_path).st_mode), 0o600)
+                    handler.released.set()
+                    self.assertTrue(log_queue.flush(5))
+                finally:
+                    self.audit_logger.logger().removeHandler(handler)
+                self.assertEqual(os.listdir(spill_dir), [])
+        lines = self._lines()
+        self.assertEqual(sorted({json.loads(line)["n"] for line in lines}), [1, 2, 3])
+
+    def test_spill_of_stopped_worker(self):
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0)
+        os.waitpid(pid, 0)
+
+        with tempfile.TemporaryDirectory() as spill_dir:
+            with open(os.path.join(spill_dir, "%s.log" % pid), "w") as spill:
+                spill.write(json.dumps({"name": TEST_LOGGER, "levelno": logging.INFO, "created": 0,
+                                        "msg": json.dumps({"n": 1})}) + "\n")
+            with override_settings(AUDIT_LOG_QUEUE_SIZE=100, AUDIT_LOG_QUEUE_SPILL_DIR=spill_dir):
+                log_queue = AuditLogQueue()
+                log_queue.put(self._record(2))
+                self.assertTrue(log_queue.flush(5))
+                self.assertEqual(os.listdir(spill_dir), [])
+        lines = self._lines()
+        self.assertEqual([json.loads(line)["n"] for line in lines], [1, 2])
+
+    @override_settings(AUDIT_LOG_QUEUE_SIZE=100)
+    def test_stop_writes_queued_records(self):
+        log_queue = AuditLogQueue()
+        for n in range(10):
+            log_queue.put(self._record(n))
+        log_queue.stop()
+        self.assertEqual(len(self._lines()), 10)
@@ -0,0 +1,102 @@
+import json
+from unittest.mock import patch
+
+from django.http import HttpResponse
+from django.test import RequestFactory, override_settings
+from waffle.testutils import override_switch
+
+import apps.logging.request_logger as logging
+from apps.logging.timing import phase
+from apps.logging.utils import cleanup_logger, get_log_content, redirect_loggers
+from apps.test import BaseApiTest
+from hhs_oauth_server.request_logging import RequestResponseLog, RequestTimeLoggingMiddleware
+
+
+class RequestLoggingTestCase(BaseApiTest):
+
+    def setUp(self):
+        self.read_capability = self._create_capability('Read', [])
+        self.write_capability = self._create_capability('Write', [])
+        self.token = self.create_token('John', 'Smith')
+        self.application = self._get_user_application('John', 'John_Smith_test')
+        self.logger_registry = redirect_loggers()
+        self.middleware = RequestTimeLoggingMiddleware(lambda request: HttpResponse("{}"))
+
+    def tearDown(self):
+        cleanup_logger(self.logger_registry)
+
+    def _request(self):
+        request = RequestFactory().get(
+            '/v1/fhir/Patient', {'client_id': self.application.client_id},
+            HTTP_AUTHORIZATION='Bearer ' + self.token,
+        )
+        self.middleware.process_request(request)
+        return request
+
+    def _log(self):
+        return get_log_content(self.logger_registry, logging.AUDIT_HHS_AUTH_SERVER_REQ_LOGGER)
+
+
+class TestDeferredRequestLogging(RequestLoggingTestCase):
+
+    @override_settings(REQUEST_LOGGING_DEFERRED=True)
+    def test_enriched_once_sent(self):
+        request = self._request()
+        with self.assertNumQueries(0):
+            response = self.middleware.process_response(request, HttpResponse("{}"))
+        self.assertEqual(self._log(), "")
+
+        response.close()
+        log_dict = json.loads(self._log())
+        self.assertEqual(log_dict["req_app_id"], self.application.id)
+        self.assertEqual(log_dict["app_name"], self.application.name)
+        self.assertEqual(len(log_dict["access_token_hash"]), 64)
+        self.assertEqual(log_dict["size"], 2)
+
+    @override_settings(REQUEST_LOGGING_DEFERRED=True)
+    def test_enrich_error_logged(self):
+        request = self._request()
+        response = self.middleware.process_response(request, HttpResponse("{}"))
+        with patch.object(RequestResponseLog, "enrich", side_effect=ValueError("no crosswalk")):
+            response.close()
+        log_dict = json.loads(self._log())
+        self.assertEqual(log_dict["path"], "/v1/fhir/Patient")
+        self.assertEqual(log_dict["enrich_error"], "ValueError: no crosswalk")
+
+    @override_settings(REQUEST_LOGGING_DEFERRED=False, REQUEST_LOGGING_APPLICATION_MEMO_TTL=300)
+    def test_application_memo(self):
+        self.middleware.process_response(self._request(), HttpResponse("{}"))
+        # The access token and its scopes, not the application
+        with self.assertNumQueries(2):
+            self.middleware.process_response(self._request(), HttpResponse("{}"))
+
+
+@override_settings(REQUEST_LOGGING_DEFERRED=False)
+class TestPhaseTiming(RequestLoggingTestCase):
+
+    def _timed_response(self):
+        request = self._request()
+        with phase(request, 'bfd'):
+            pass
+        with phase(request, 'render'):
+            pass
+        return self.middleware.process_response(request, HttpResponse("{}"))
+
+    @override_switch('server_timing', active=True)
+    def test_server_timing_header(self):
+        response = self._timed_response()
+        names = [timing.split(';')[0] for timing in response['Server-Timing'].split(', ')]
+        self.assertEqual(names, ['bfd', 'render', 'total'])
+
+    @override_switch('server_timing', active=False)
+    def test_timing_fields_logged(self):
+        response = self._timed_response()
+        self.assertFalse(response.has_header('Server-Timing'))
+        log_dict = json.loads(self._log())
+        self.assertGreaterEqual(log_dict['timing_bfd'], 0)
+        self.assertGreaterEqual(log_dict['timing_render'], 0)
+
+    def test_untimed_request(self):
+        # Phases outside of the middleware are not timed
+        with phase(RequestFactory().get('/'), 'bfd'):
+            pass
@@ -0,0 +1,53 @@
+"""
+Per-request timing of the phases of an API call: authentication, throttles
+and permission checks, the backend call, parsing and the permission walk of
+the bundle, rendering and the fetch audit logging.
+
+RequestTimeLoggingMiddleware sets a PhaseTimer on each request and reports
+the phases in the request_response_middleware log record (timing_<phase>
+fields, in milliseconds) and, with the "server_timing" waffle switch on, in
+the Server-Timing response header. Phases of a request without a timer are
+not timed.
+"""
+import time
+from contextlib import contextmanager, nullcontext
+
+
+class PhaseTimer(object):
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        # phase -> seconds, in the order the phases first ran
+        self.phases = {}
+
+    def add(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def milliseconds(self):
+        return {name: round(seconds * 1000, 3) for name, seconds in self.phases.items()}
+
+    def server_timing(self):
+        timings = ["%s;dur=%s" % (name, ms) for name, ms in self.milliseconds().items()]
+        timings.append("total;dur=%s" % round((time.perf_counter() - self.started) * 1000, 3))
+        return ", ".join(timings)
+
+
+def get_phase_timer(request):
+    # The timer is set on the django request a DRF request wraps
+    return getattr(getattr(request, "_request", request), "_phase_timer", None)
+
+
+def phase(request, name):
+    """
+    Context manager timing its block as phase name of request.
+    """
+    timer = get_phase_timer(request)
+    return timer.phase(name) if timer is not None else nullcontext()
@@ -2,6 +2,8 @@ import io
 
 import apps.logging.request_logger as logging
 
+from apps.logging.audit_queue import audit_log_queue
+
 """
   Utility functions for logging, and logging manipulations (used in tests)
 """
@@ -60,6 +62,8 @@ def get_log_content(logger_registry: dict, logger_name: str, override_loggers=[]
 
 
 def collect_logs(logger_registry: dict, override_loggers=[]):
+    # Records still in the audit log queue are written first
+    audit_log_queue.flush()
     log_contents = {}
     logger_names = logging.LOGGER_NAMES if not override_loggers else override_loggers
     for n in logger_names:
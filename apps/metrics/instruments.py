@@ -0,0 +1,41 @@
+"""
+The metrics of the server, see apps.metrics.registry.
+"""
+from .registry import registry
+
+# Requests, see apps.metrics.middleware.MetricsMiddleware
+http_requests_in_flight = registry.gauge(
+    "http_requests_in_flight", "Requests being served, over the workers")
+http_request_seconds = registry.histogram(
+    "http_request_seconds", "Time to the response of a request", ["view", "method", "status"])
+db_queries_per_request = registry.histogram(
+    "db_queries_per_request", "Database queries made by a request", ["view"],
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200))
+db_query_seconds = registry.histogram(
+    "db_query_seconds", "Database query latency")
+auth_flow_step_seconds = registry.histogram(
+    "auth_flow_step_seconds", "Time to the response of an authorization flow step", ["step"])
+
+# Upstream services
+bfd_request_seconds = registry.histogram(
+    "bfd_request_seconds", "BFD latency, to the response headers of streamed calls",
+    ["resource_type", "version"])
+bfd_responses = registry.counter(
+    "bfd_responses", "BFD responses by status", ["resource_type", "version", "status"])
+slsx_request_seconds = registry.histogram(
+    "slsx_request_seconds", "SLSx call latency", ["call"])
+slsx_responses = registry.counter(
+    "slsx_responses", "SLSx responses by status, error when there was none", ["call", "status"])
+
+# Rate limits and caches
+throttle_rejections = registry.counter(
+    "throttle_rejections", "Requests denied by a throttle", ["scope"])
+cache_reads = registry.counter(
+    "cache_reads", "Reads of the tiered caches, result is hit (in process), shared_hit or miss",
+    ["cache", "prefix", "result"])
+
+# Audit log queue, see apps.logging.audit_queue
+audit_log_queue_depth = registry.gauge(
+    "audit_log_queue_depth", "Audit log records waiting for the writer, over the workers")
+audit_log_records_dropped = registry.counter(
+    "audit_log_records_dropped", "Audit log records dropped on a full queue")
@@ -0,0 +1,68 @@
+import asyncio
+import time
+
+from django.db import connection
+
+from apps.dot_ext.loggers import is_path_part_of_auth_flow_trace
+
+from . import instruments
+
+
+class QueryCounter(object):
+    """
+    Database execute wrapper counting and timing the queries of a request.
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            instruments.db_query_seconds.observe(time.perf_counter() - start)
+
+
+class MetricsMiddleware(object):
+    """
+    Counts the requests being served and records their latency, database
+    queries and, for the authorization flow, the time of each step.
+    Runs in the sync and async (ASGI) request paths.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = asyncio.iscoroutinefunction(get_response)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        queries = QueryCounter()
+        start = time.perf_counter()
+        with instruments.http_requests_in_flight.track_in_progress(), connection.execute_wrapper(queries):
+            response = self.get_response(request)
+        self.record(request, response, time.perf_counter() - start, queries)
+        return response
+
+    async def __acall__(self, request):
+        # Queries run in the threads of sync_to_async, on connections of
+        # their own, so they are not counted
+        start = time.perf_counter()
+        with instruments.http_requests_in_flight.track_in_progress():
+            response = await self.get_response(request)
+        self.record(request, response, time.perf_counter() - start)
+        return response
+
+    def record(self, request, response, elapsed, queries=None):
+        # Unresolved paths are not labelled by path, to bound the series
+        resolver_match = getattr(request, "resolver_match", None)
+        view = resolver_match.view_name if resolver_match is not None else "unmatched"
+        instruments.http_request_seconds.labels(view, request.method, response.status_code).observe(elapsed)
+        if queries is not None:
+            instruments.db_queries_per_request.labels(view).observe(queries.count)
+        if is_path_part_of_auth_flow_trace(request.path):
+            instruments.auth_flow_step_seconds.labels(view).observe(elapsed)
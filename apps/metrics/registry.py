@@ -0,0 +1,487 @@
+"""
+Counters, gauges and histograms of the server, added up across its worker
+processes for the "scrape" metrics view.
+
+With METRICS_MULTIPROCESS_DIR set, each process keeps the values of its
+metrics in files of its own in that directory, mapped in memory, and a
+scrape reads the files of all the processes:
+
+    counter_<pid>.db    counters and histograms, summed
+    gauge_<pid>.db      gauges, summed or maxed (the gauge's mode) over
+                        the processes still running
+
+The counters of stopped workers keep counting so the totals never go back,
+empty the directory when the server starts. Without a directory the values
+are kept in the process and a scrape only reports the worker serving it.
+
+Metrics are defined once, at import (see apps.metrics.instruments):
+
+    bfd_request_seconds = registry.histogram(
+        "bfd_request_seconds", "BFD request latency", ["resource_type", "version"])
+    bfd_request_seconds.labels("Patient", "v2").observe(0.25)
+"""
+import bisect
+import glob
+import json
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+
+from django.conf import settings
+
+COUNTER = "counter"
+GAUGE = "gauge"
+
+# Seconds, from a cached token lookup to a slow EOB search
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+INITIAL_MMAP_SIZE = 1 << 16
+
+
+def entry_padding(key_length):
+    # Entries are 8 byte aligned: length (4), key, padding, value (8)
+    return (8 - (4 + key_length) % 8) % 8
+
+
+def read_entries(data, used):
+    """
+    Yields (key, value, value offset) of the entries of a values file.
+    """
+    pos = 8
+    while pos < used:
+        length = struct.unpack_from("=i", data, pos)[0]
+        key = bytes(data[pos + 4:pos + 4 + length]).decode("utf-8")
+        pos += 4 + length + entry_padding(length)
+        yield key, struct.unpack_from("=d", data, pos)[0], pos
+        pos += 8
+
+
+def read_file(path):
+    """
+    Returns {key: value} of a values file, empty when it is gone.
+    """
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return {}
+    if len(data) < 8:
+        return {}
+    used = struct.unpack_from("=i", data, 0)[0]
+    return {key: value for key, value, _ in read_entries(data, min(used, len(data)))}
+
+
+class MmapValues(object):
+    """
+    Doubles by key in a file mapped in memory: the number of bytes used,
+    then the entries, appended as keys are first written.
+    """
+
+    def __init__(self, path, truncate=False):
+        self._file = open(path, "wb+" if truncate else "ab+")
+        self._size = os.fstat(self._file.fileno()).st_size
+        if self._size < INITIAL_MMAP_SIZE:
+            self._size = INITIAL_MMAP_SIZE
+            self._file.truncate(self._size)
+        self._map = mmap.mmap(self._file.fileno(), self._size)
+        self._used = struct.unpack_from("=i", self._map, 0)[0] or 8
+        self._positions = {key: pos for key, _, pos in read_entries(self._map, self._used)}
+
+    def _position(self, key):
+        pos = self._positions.get(key)
+        if pos is None:
+            encoded = key.encode("utf-8")
+            entry = struct.pack("=i%ssd" % (len(encoded) + entry_padding(len(encoded))),
+                                len(encoded), encoded, 0.0)
+            while self._used + len(entry) > self._size:
+                self._size *= 2
+                self._file.truncate(self._size)
+                self._map = mmap.mmap(self._file.fileno(), self._size)
+            self._map[self._used:self._used + len(entry)] = entry
+            pos = self._positions[key] = self._used + len(entry) - 8
+            # Readers only see the entry once it is written
+            self._used += len(entry)
+            struct.pack_into("=i", self._map, 0, self._used)
+        return pos
+
+    def inc(self, key, amount):
+        pos = self._position(key)
+        struct.pack_into("=d", self._map, pos, struct.unpack_from("=d", self._map, pos)[0] + amount)
+
+    def set(self, key, value):
+        struct.pack_into("=d", self._map, self._position(key), value)
+
+    def items(self):
+        return [(key, struct.unpack_from("=d", self._map, pos)[0]) for key, pos in self._positions.items()]
+
+
+class DictValues(dict):
+
+    def inc(self, key, amount):
+        self[key] = self.get(key, 0.0) + amount
+
+    def set(self, key, value):
+        self[key] = value
+
+
+def pid_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+# Registries reset in forked workers, registered once for the process
+_registries = weakref.WeakSet()
+
+
+def _reset_registries():
+    for registry in list(_registries):
+        registry._reset()
+
+
+os.register_at_fork(after_in_child=_reset_registries)
+
+
+class Registry(object):
+
+    def __init__(self, directory=None):
+        # None uses METRICS_MULTIPROCESS_DIR
+        self._directory = directory
+        self._metrics = {}
+        self._reset()
+        _registries.add(self)
+
+    def _reset(self):
+        # A forked worker writes files of its own
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._stores = {}
+
+    @property
+    def directory(self):
+        if self._directory is not None:
+            return self._directory
+        return getattr(settings, "METRICS_MULTIPROCESS_DIR", "")
+
+    def _store(self, kind):
+        store = self._stores.get(kind)
+        if store is None:
+            if self.directory:
+                # Gauges of an earlier process with the same pid are stale
+                store = MmapValues(os.path.join(self.directory, "%s_%s.db" % (kind, self._pid)),
+                                   truncate=kind == GAUGE)
+            else:
+                store = DictValues()
+            self._stores[kind] = store
+        return store
+
+    def inc(self, kind, key, amount):
+        with self._lock:
+            self._store(kind).inc(key, amount)
+
+    def set(self, kind, key, value):
+        with self._lock:
+            self._store(kind).set(key, value)
+
+    def _register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError("Metric %s is already registered" % metric.name)
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(self, name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=(), mode="sum"):
+        return self._register(Gauge(self, name, documentation, labelnames, mode))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(self, name, documentation, labelnames, buckets))
+
+    def _process_values(self, kind):
+        """
+        Returns [{key: value}] of the processes, counting only the running
+        ones for gauges.
+        """
+        if not self.directory:
+            with self._lock:
+                return [dict(self._store(kind).items())]
+        values = []
+        for path in glob.glob(os.path.join(self.directory, "%s_*.db" % kind)):
+            pid = int(os.path.basename(path)[len(kind) + 1:-3])
+            if kind == GAUGE and pid != self._pid and not pid_running(pid):
+                continue
+            values.append(read_file(path))
+        return values
+
+    def collect(self):
+        """
+        Returns [(metric, {(sample name, labels): value})] of the processes,
+        labels being a tuple of (name, value) pairs.
+        """
+        samples = {name: {} for name in self._metrics}
+        for kind in (COUNTER, GAUGE):
+            for values in self._process_values(kind):
+                for key, value in values.items():
+                    name, sample, labels = json.loads(key)
+                    metric = self._metrics.get(name)
+                    if metric is None or metric.kind != kind:
+                        continue
+                    sample_key = (sample, tuple(tuple(label) for label in labels))
+                    merged = samples[name]
+                    merged[sample_key] = metric.merge(merged.get(sample_key), value)
+        return [(metric, samples[name]) for name, metric in sorted(self._metrics.items())]
+
+    def render_text(self):
+        """
+        The metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        for metric, samples in self.collect():
+            lines.append("# HELP %s %s" % (metric.name, metric.documentation))
+            lines.append("# TYPE %s %s" % (metric.name, metric.type))
+            for (sample, labels), value in metric.samples(samples):
+                lines.append("%s%s %s" % (sample, format_labels(labels), format_value(value)))
+        return "\n".join(lines) + "\n"
+
+    def summary(self, quantiles=(0.5, 0.9, 0.99)):
+        """
+        {metric: {labels: value}}, histograms as {labels: {count, sum, p50, ...}}
+        with the quantiles estimated from the buckets.
+        """
+        summary = {}
+        for metric, samples in self.collect():
+            summary[metric.name] = metric.summarize(samples, quantiles)
+        return summary
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                             for name, value in labels)
+
+
+def format_value(value):
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+
+def bucket_quantile(q, buckets):
+    """
+    Estimates quantile q from [(upper bound, cumulative count)], by linear
+    interpolation in the bucket it falls in as Prometheus' histogram_quantile.
+    """
+    total = buckets[-1][1]
+    if not total:
+        return None
+    rank = q * total
+    lower, below = 0.0, 0
+    for upper, count in buckets:
+        if count >= rank:
+            if math.isinf(upper):
+                # Above the highest bound, which is all that is known
+                return lower
+            return lower + (upper - lower) * (rank - below) / (count - below)
+        lower, below = upper, count
+    return lower
+
+
+class Metric(object):
+    kind = COUNTER
+    type = None
+
+    def __init__(self, registry, name, documentation, labelnames=()):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._children_lock = threading.Lock()
+
+    def labels(self, *values):
+        values = tuple(str(value) for value in values)
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError("%s takes the labels %s" % (self.name, ", ".join(self.labelnames)))
+            with self._children_lock:
+                child = self._children.setdefault(values, self.child_class(self, values))
+        return child
+
+    def key(self, sample, labels):
+        return json.dumps([self.name, sample, [list(label) for label in labels]])
+
+    def merge(self, merged, value):
+        return value if merged is None else merged + value
+
+    def samples(self, samples):
+        return sorted(samples.items())
+
+    def summarize(self, samples, quantiles):
+        return {format_labels(labels): value for (sample, labels), value in sorted(samples.items())}
+
+
+class CounterChild(object):
+
+    def __init__(self, metric, values):
+        self._registry = metric.registry
+        self._key = metric.key(metric.name + "_total", tuple(zip(metric.labelnames, values)))
+
+    def inc(self, amount=1):
+        self._registry.inc(COUNTER, self._key, amount)
+
+
+class Counter(Metric):
+    type = "counter"
+    child_class = CounterChild
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class GaugeChild(object):
+
+    def __init__(self, metric, values):
+        self._registry = metric.registry
+        self._key = metric.key(metric.name, tuple(zip(metric.labelnames, values)))
+
+    def inc(self, amount=1):
+        self._registry.inc(GAUGE, self._key, amount)
+
+    def dec(self, amount=1):
+        self._registry.inc(GAUGE, self._key, -amount)
+
+    def set(self, value):
+        self._registry.set(GAUGE, self._key, value)
+
+    @contextmanager
+    def track_in_progress(self):
+        self.inc()
+        try:
+            yield
+        finally:
+            self.dec()
+
+
+class Gauge(Metric):
+    kind = GAUGE
+    type = "gauge"
+    child_class = GaugeChild
+
+    def __init__(self, registry, name, documentation, labelnames=(), mode="sum"):
+        super().__init__(registry, name, documentation, labelnames)
+        if mode not in ("sum", "max"):
+            raise ValueError("Gauge mode is sum or max")
+        self.mode = mode
+
+    def merge(self, merged, value):
+        if merged is None:
+            return value
+        return merged + value if self.mode == "sum" else max(merged, value)
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def dec(self, amount=1):
+        self.labels().dec(amount)
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def track_in_progress(self):
+        return self.labels().track_in_progress()
+
+
+class HistogramChild(object):
+
+    def __init__(self, metric, values):
+        self._registry = metric.registry
+        self._bounds = metric.buckets
+        labels = tuple(zip(metric.labelnames, values))
+        # Observations are counted in their own bucket, cumulated when collected
+        self._bucket_keys = [metric.key(metric.name + "_bucket", labels + (("le", format_value(bound)),))
+                             for bound in metric.buckets + (math.inf,)]
+        self._sum_key = metric.key(metric.name + "_sum", labels)
+
+    def observe(self, value):
+        index = bisect.bisect_left(self._bounds, value)
+        self._registry.inc(COUNTER, self._bucket_keys[index], 1)
+        self._registry.inc(COUNTER, self._sum_key, value)
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+
+class Histogram(Metric):
+    type = "histogram"
+    child_class = HistogramChild
+
+    def __init__(self, registry, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(registry, name, documentation, labelnames)
+        self.buckets = tuple(sorted(float(bound) for bound in buckets))
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+    def series(self, samples):
+        """
+        Returns {labels: ([(upper bound, cumulative count)], sum)}.
+        """
+        series = {}
+        for (sample, labels), value in samples.items():
+            if sample.endswith("_bucket"):
+                labels = dict(labels)
+                bound = float(labels.pop("le"))
+                series.setdefault(tuple(labels.items()), ({}, 0.0))[0][bound] = value
+            else:
+                buckets, _ = series.setdefault(labels, ({}, 0.0))
+                series[labels] = (buckets, value)
+        cumulated = {}
+        for labels, (buckets, total) in series.items():
+            count = 0
+            bounds = []
+            for bound in self.buckets + (math.inf,):
+                count += buckets.get(bound, 0)
+                bounds.append((bound, count))
+            cumulated[labels] = (bounds, total)
+        return cumulated
+
+    def samples(self, samples):
+        for labels, (buckets, total) in sorted(self.series(samples).items()):
+            for bound, count in buckets:
+                yield (self.name + "_bucket", labels + (("le", format_value(bound)),)), count
+            yield (self.name + "_sum", labels), total
+            yield (self.name + "_count", labels), buckets[-1][1]
+
+    def summarize(self, samples, quantiles):
+        summary = {}
+        for labels, (buckets, total) in sorted(self.series(samples).items()):
+            stats = {"count": buckets[-1][1], "sum": total}
+            for q in quantiles:
+                stats["p%s" % format_value(round(q * 100, 3))] = bucket_quantile(q, buckets)
+            summary[format_labels(labels)] = stats
+        return summary
+
+
+registry = Registry()
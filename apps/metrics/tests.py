@@ -0,0 +1,111 @@
+import os
+import shutil
+import tempfile
+
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import User
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase
+from django.urls import reverse
+
+from apps.metrics.middleware import MetricsMiddleware
+from apps.metrics.registry import Registry, registry
+
+
+class TestRegistry(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def _metrics(self, directory):
+        registry = Registry(directory)
+        return (registry,
+                registry.counter("calls", "Calls", ["call"]),
+                registry.gauge("in_flight", "In flight"),
+                registry.histogram("latency_seconds", "Latency", buckets=(0.1, 1.0)))
+
+    def test_workers_summed(self):
+        registry, calls, in_flight, latency = self._metrics(self.directory)
+        calls.labels("token").inc()
+        in_flight.set(1)
+
+        pid = os.fork()
+        if pid == 0:
+            # The worker stops, its counters keep counting and its gauges do not
+            calls.labels("token").inc(2)
+            in_flight.set(5)
+            latency.observe(0.5)
+            os._exit(0)
+        os.waitpid(pid, 0)
+
+        summary = registry.summary()
+        self.assertEqual(summary["calls"], {'{call="token"}': 3})
+        self.assertEqual(summary["in_flight"], {"": 1})
+        self.assertEqual(summary["latency_seconds"][""]["count"], 1)
+
+    def test_in_process(self):
+        registry, calls, in_flight, latency = self._metrics("")
+        calls.labels("token").inc()
+        self.assertEqual(registry.summary()["calls"], {'{call="token"}': 1})
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_histogram(self):
+        registry, calls, in_flight, latency = self._metrics(self.directory)
+        for value in [0.05] * 90 + [0.5] * 9 + [2]:
+            latency.observe(value)
+
+        stats = registry.summary()["latency_seconds"][""]
+        self.assertEqual(stats["count"], 100)
+        self.assertAlmostEqual(stats["sum"], 11.0)
+        self.assertAlmostEqual(stats["p50"], 0.1 * 50 / 90)
+        self.assertAlmostEqual(stats["p99"], 1.0)
+
+        text = registry.render_text()
+        self.assertIn("# TYPE latency_seconds histogram", text)
+        self.assertIn('latency_seconds_bucket{le="0.1"} 90\n', text)
+        self.assertIn('latency_seconds_bucket{le="1"} 99\n', text)
+        self.assertIn('latency_seconds_bucket{le="+Inf"} 100\n', text)
+        self.assertIn("latency_seconds_count 100\n", text)
+
+    def test_labels(self):
+        registry, calls, in_flight, latency = self._metrics(self.directory)
+        calls.labels('say "hi"').inc()
+        self.assertIn('calls_total{call="say \\"hi\\""} 1\n', registry.render_text())
+        with self.assertRaises(ValueError):
+            calls.labels("token", "extra")
+        with self.assertRaises(ValueError):
+            registry.counter("calls", "Calls")
+
+
+class TestScrapeView(TestCase):
+
+    def test_admin_only(self):
+        self.client.force_login(User.objects.create_user("user"))
+        self.assertEqual(self.client.get(reverse("scrape")).status_code, 403)
+
+    def test_scrape(self):
+        self.client.force_login(User.objects.create_superuser("admin", password="secret"))
+        self.client.get(reverse("scrape"))
+
+        response = self.client.get(reverse("scrape"))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["Content-Type"].startswith("text/plain"))
+        self.assertIn('http_request_seconds_count{view="scrape",method="GET",status="200"}',
+                      response.content.decode("utf-8"))
+
+        response = self.client.get(reverse("scrape"), {"format": "json"})
+        self.assertIn("p99", response.json()["http_request_seconds"]['{view="scrape",method="GET",status="200"}'])
+
+
+class TestMetricsMiddleware(TestCase):
+
+    def test_async(self):
+        async def get_response(request):
+            return HttpResponse(status=204)
+
+        middleware = MetricsMiddleware(get_response)
+        response = async_to_sync(middleware)(RequestFactory().get("/unknown"))
+        self.assertEqual(response.status_code, 204)
+        summary = registry.summary()["http_request_seconds"]
+        self.assertIn('{view="unmatched",method="GET",status="204"}', summary)
@@ -12,6 +12,8 @@ from .views import (
     ArchivedDataAccessGrantView,
     CheckDataAccessGrantsView,
     CheckCrosswalksView,
+    CacheStatsView,
+    ScrapeView,
 )
 
 admin.autodiscover()
@@ -21,6 +23,8 @@ urlpatterns = [
     url(r'^applications/(?P<pk>\d+)$', AppMetricsDetailView.as_view(), name='applications-detail'),
     url(r'^applications/$', AppMetricsView.as_view(), name='applications'),
     url(r'^crosswalks/check$', CheckCrosswalksView.as_view(), name='check-crosswalks'),
+    url(r'^caches$', CacheStatsView.as_view(), name='caches'),
+    url(r'^scrape$', ScrapeView.as_view(), name='scrape'),
     url(r'^developers/$', DevelopersView.as_view(), name='developers'),
     url(r'^tokens$', TokenMetricsView.as_view(), name='tokens'),
     url(r'^tokens/archive$', ArchivedTokenView.as_view(), name='archived-tokens'),
@@ -1,6 +1,9 @@
+import json
 import logging
 
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.cache import caches
 from django.db.models import (
     Count,
     QuerySet,
@@ -14,7 +17,7 @@ from rest_framework_csv.renderers import PaginatedCSVRenderer, CSVStreamingRende
 from rest_framework.generics import ListAPIView
 from rest_framework.pagination import PageNumberPagination
 from rest_framework.permissions import IsAuthenticated, IsAdminUser
-from rest_framework.renderers import JSONRenderer, BrowsableAPIRenderer
+from rest_framework.renderers import BaseRenderer, JSONRenderer, BrowsableAPIRenderer
 from rest_framework.response import Response
 from rest_framework.serializers import (
     ModelSerializer,
@@ -27,6 +30,7 @@ from rest_framework.serializers import (
 )
 from rest_framework.views import APIView
 from apps.accounts.models import UserProfile, UserIdentificationLabel
+from apps.core.cache import TieredCache
 from apps.authorization.models import (
     DataAccessGrant,
     ArchivedDataAccessGrant,
@@ -36,6 +40,7 @@ from apps.dot_ext.models import Application, ArchivedToken
 from apps.fhir.bluebutton.models import (
     Crosswalk,
     get_crosswalk_bene_counts)
+from apps.metrics.registry import registry
 
 import apps.logging.request_logger as bb2logging
 
@@ -347,6 +352,54 @@ class CheckCrosswalksView(APIView):
         return Response(get_crosswalk_bene_counts())
 
 
+class CacheStatsView(APIView):
+    """
+    Hit rates per key prefix of the tiered caches in the worker serving the request.
+    """
+    permission_classes = [
+        IsAuthenticated,
+        IsAdminUser,
+    ]
+
+    def get(self, request, format=None):
+        return Response({alias: caches[alias].stats() for alias in settings.CACHES
+                         if isinstance(caches[alias], TieredCache)})
+
+
+class PrometheusTextRenderer(BaseRenderer):
+    media_type = 'text/plain'
+    format = 'txt'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if not isinstance(data, str):
+            # Error details
+            data = json.dumps(data)
+        return data.encode(self.charset)
+
+
+class ScrapeView(APIView):
+    """
+    Counters, gauges and latency histograms of all the workers, see
+    apps.metrics.registry.
+
+    * Only admin users are able to access this view
+    * Default returns the Prometheus text format, ?format=json the values
+      with the p50, p90 and p99 of the histograms since the workers started
+    """
+    permission_classes = [
+        IsAuthenticated,
+        IsAdminUser,
+    ]
+
+    renderer_classes = (PrometheusTextRenderer, JSONRenderer)
+
+    def get(self, request, format=None):
+        if request.accepted_renderer.format == 'json':
+            return Response(registry.summary())
+        return Response(registry.render_text())
+
+
 class AppMetricsView(ListAPIView):
     """
     View to provide application metrics.
@@ -11,6 +11,7 @@ from rest_framework.exceptions import APIException
 
 from apps.fhir.bluebutton.models import hash_hicn, hash_mbi
 from apps.logging.serializers import SLSxTokenResponse, SLSxUserInfoResponse
+from apps.metrics.instruments import slsx_request_seconds, slsx_responses
 
 from .signals import response_hook_wrapper
 from .validators import is_mbi_format_valid, is_mbi_format_synthetic
@@ -142,6 +143,20 @@ class OAuth2ConfigSLSx(object):
             )
         return headers
 
+    def slsx_request(self, call, method, url, **kwargs):
+        """
+        requests.<method>(url, **kwargs), timed and counted by status in
+        the slsx metrics as call.
+        """
+        status_code = "error"
+        try:
+            with slsx_request_seconds.labels(call).time():
+                response = getattr(requests, method)(url, **kwargs)
+            status_code = response.status_code
+            return response
+        finally:
+            slsx_responses.labels(call, status_code).inc()
+
     def exchange_for_access_token(self, req_token, request):
         """
         Exchanges the request_token from the slsx -> medicare.gov
@@ -155,7 +170,8 @@ class OAuth2ConfigSLSx(object):
 
         headers = self.slsx_common_headers(request)
 
-        response = requests.post(
+        response = self.slsx_request(
+            "token", "post",
             self.token_endpoint,
             auth=self.basic_auth(),
             json=data_dict,
@@ -196,7 +212,8 @@ class OAuth2ConfigSLSx(object):
         headers = self.slsx_common_headers(request)
         headers.update(self.auth_header())
 
-        response = requests.get(
+        response = self.slsx_request(
+            "userinfo", "get",
             self.userinfo_endpoint + "/" + self.user_id,
             headers=headers,
             allow_redirects=False,
@@ -281,7 +298,8 @@ class OAuth2ConfigSLSx(object):
         """
         headers = self.slsx_common_headers(request)
 
-        response = requests.get(
+        response = self.slsx_request(
+            "health_check", "get",
             self.healthcheck_endpoint,
             headers=headers,
             allow_redirects=False,
@@ -303,7 +321,8 @@ class OAuth2ConfigSLSx(object):
         headers = self.slsx_common_headers(request)
         headers.update(self.auth_header())
 
-        response = requests.get(
+        response = self.slsx_request(
+            "signout", "get",
             self.signout_endpoint,
             headers=headers,
             allow_redirects=False,
@@ -335,7 +354,8 @@ class OAuth2ConfigSLSx(object):
         headers = self.slsx_common_headers(request)
         headers.update(self.auth_header())
 
-        response = requests.get(
+        response = self.slsx_request(
+            "validate_signout", "get",
             self.userinfo_endpoint + "/" + self.user_id,
             headers=headers,
             allow_redirects=False,
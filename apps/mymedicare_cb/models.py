@@ -1,14 +1,18 @@
 import apps.logging.request_logger as logging
 
+from datetime import timedelta
+from django.conf import settings
 from django.contrib.auth.models import User, Group
 from django.core.exceptions import ValidationError
 from django.db import models, transaction
+from django.utils import timezone
 from rest_framework import status
 from rest_framework.exceptions import APIException
 
 from apps.accounts.models import UserProfile
 from apps.fhir.bluebutton.models import ArchivedCrosswalk, Crosswalk
 from apps.fhir.server.authentication import match_fhir_id
+from apps.fhir.server.match_cache import match_cache
 
 from .authorization import OAuth2ConfigSLSx, MedicareCallbackExceptionType
 
@@ -28,6 +32,10 @@ def get_and_update_user(slsx_client: OAuth2ConfigSLSx, request=None):
     Find or create the user associated
     with the identity information from the ID provider.
 
+    A returning beneficiary whose crosswalk holds the same hashes is not
+    matched via the backend FHIR server again before
+    FHIR_MATCH_REVALIDATE_INTERVAL, see get_trusted_crosswalk().
+
     Args:
         Identity parameters passed in from ID provider.
         slsx_client = OAuth2ConfigSLSx encapsulates all slsx exchanges and user info values as listed below:
@@ -51,11 +59,45 @@ def get_and_update_user(slsx_client: OAuth2ConfigSLSx, request=None):
 
     logger = logging.getLogger(logging.AUDIT_AUTHN_MED_CALLBACK_LOGGER, request)
 
+    # Returning beneficiary with unchanged hashes, no need to match via the backend
+    crosswalk = get_trusted_crosswalk(slsx_client)
+    if crosswalk is not None:
+        logger.info({
+            "type": "mymedicare_cb:get_and_update_user",
+            "subject": slsx_client.user_id,
+            "fhir_id": crosswalk.fhir_id,
+            "mbi_hash": slsx_client.mbi_hash,
+            "hicn_hash": slsx_client.hicn_hash,
+            "hash_lookup_type": crosswalk.user_id_type,
+            "match_source": "crosswalk",
+            "status": "OK",
+            "user_id": crosswalk.user.id,
+            "user_username": crosswalk.user.username,
+            "hicn_updated": False,
+            "mbi_updated": False,
+            "mbi_updated_from_null": False,
+            "mesg": "RETURN existing beneficiary record",
+            "crosswalk": {
+                "id": crosswalk.id,
+                "user_hicn_hash": crosswalk.user_hicn_hash,
+                "user_mbi_hash": crosswalk.user_mbi_hash,
+                "fhir_id": crosswalk.fhir_id,
+                "user_id_type": crosswalk.user_id_type,
+            },
+            "crosswalk_before": {},
+        })
+        return crosswalk.user, "R"
+
     # Match a patient identifier via the backend FHIR server
-    fhir_id, hash_lookup_type = match_fhir_id(
-        mbi_hash=slsx_client.mbi_hash,
-        hicn_hash=slsx_client.hicn_hash, request=request
-    )
+    fhir_id, hash_lookup_type, match_source = get_fhir_id_match(slsx_client, request)
+
+    # fhir_id can not change for an existing user, a cached match may be stale
+    if (match_source == "cache"
+            and Crosswalk.objects.filter(user__username=slsx_client.user_id).exclude(_fhir_id=fhir_id).exists()):
+        match_cache.invalidate(fhir_id)
+        fhir_id, hash_lookup_type, match_source = get_fhir_id_match(slsx_client, request, use_cache=False)
+
+    date_validated = timezone.now() if match_source == "backend" else None
 
     log_dict = {
         "type": "mymedicare_cb:get_and_update_user",
@@ -64,6 +106,7 @@ def get_and_update_user(slsx_client: OAuth2ConfigSLSx, request=None):
         "mbi_hash": slsx_client.mbi_hash,
         "hicn_hash": slsx_client.hicn_hash,
         "hash_lookup_type": hash_lookup_type,
+        "match_source": match_source,
         "crosswalk": {},
         "crosswalk_before": {},
     }
@@ -124,7 +167,12 @@ def get_and_update_user(slsx_client: OAuth2ConfigSLSx, request=None):
                 user.crosswalk.user_id_type = hash_lookup_type
                 user.crosswalk.user_hicn_hash = slsx_client.hicn_hash
                 user.crosswalk.user_mbi_hash = slsx_client.mbi_hash
+                if date_validated is not None:
+                    user.crosswalk.date_validated = date_validated
                 user.crosswalk.save()
+        elif date_validated is not None:
+            user.crosswalk.date_validated = date_validated
+            Crosswalk.objects.filter(pk=user.crosswalk.pk).update(date_validated=date_validated)
 
         # Beneficiary has been successfully matched!
         log_dict.update({
@@ -149,7 +197,8 @@ def get_and_update_user(slsx_client: OAuth2ConfigSLSx, request=None):
     except User.DoesNotExist:
         pass
 
-    user = create_beneficiary_record(slsx_client, fhir_id=fhir_id, user_id_type=hash_lookup_type, request=request)
+    user = create_beneficiary_record(slsx_client, fhir_id=fhir_id, user_id_type=hash_lookup_type, request=request,
+                                     date_validated=date_validated)
 
     log_dict.update({
         "status": "OK",
@@ -172,8 +221,47 @@ def get_and_update_user(slsx_client: OAuth2ConfigSLSx, request=None):
     return user, "C"
 
 
+def get_trusted_crosswalk(slsx_client: OAuth2ConfigSLSx):
+    """
+    Returns the crosswalk of the SLSx user when its hashes are the ones
+    from SLSx and it was matched via the backend FHIR server less than
+    FHIR_MATCH_REVALIDATE_INTERVAL seconds ago, None otherwise.
+    """
+    interval = getattr(settings, "FHIR_MATCH_REVALIDATE_INTERVAL", 0)
+    if not interval:
+        return None
+
+    crosswalk = Crosswalk.objects.select_related("user").filter(user__username=slsx_client.user_id).first()
+    if (crosswalk is None
+            or crosswalk.date_validated is None
+            or crosswalk.date_validated < timezone.now() - timedelta(seconds=interval)
+            or crosswalk.user_hicn_hash != slsx_client.hicn_hash
+            or crosswalk.user_mbi_hash != slsx_client.mbi_hash):
+        return None
+    return crosswalk
+
+
+def get_fhir_id_match(slsx_client: OAuth2ConfigSLSx, request=None, use_cache=True):
+    """
+    Returns (fhir_id, hash_lookup_type, match_source) of the SLSx user's hashes,
+    match_source is "cache" for a recent match, or "backend".
+    """
+    if use_cache:
+        match = match_cache.get(slsx_client.mbi_hash, slsx_client.hicn_hash)
+        if match is not None:
+            return match + ("cache",)
+
+    fhir_id, hash_lookup_type = match_fhir_id(
+        mbi_hash=slsx_client.mbi_hash,
+        hicn_hash=slsx_client.hicn_hash, request=request
+    )
+    match_cache.set(slsx_client.mbi_hash, slsx_client.hicn_hash, fhir_id, hash_lookup_type)
+    return fhir_id, hash_lookup_type, "backend"
+
+
 # TODO default empty strings to null, requires non-null constraints to be fixed
-def create_beneficiary_record(slsx_client: OAuth2ConfigSLSx, fhir_id=None, user_id_type="H", request=None):
+def create_beneficiary_record(slsx_client: OAuth2ConfigSLSx, fhir_id=None, user_id_type="H", request=None,
+                              date_validated=None):
 
     logger = logging.getLogger(logging.AUDIT_AUTHN_MED_CALLBACK_LOGGER, request)
 
@@ -232,6 +320,7 @@ def create_beneficiary_record(slsx_client: OAuth2ConfigSLSx, fhir_id=None, user_
             user_mbi_hash=slsx_client.mbi_hash,
             fhir_id=fhir_id,
             user_id_type=user_id_type,
+            date_validated=date_validated,
         )
 
         # Extra user information
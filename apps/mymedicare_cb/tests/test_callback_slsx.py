@@ -12,6 +12,7 @@ from django.contrib.auth.models import Group, User
 from django.utils.dateparse import parse_duration
 from django.utils.text import slugify
 from django.urls import reverse
+from django.test import override_settings
 from django.test.client import Client
 from httmock import urlmatch, all_requests, HTTMock
 from jsonschema import validate
@@ -23,6 +24,7 @@ from apps.accounts.models import UserProfile
 from apps.capabilities.models import ProtectedCapability
 from apps.dot_ext.models import Approval, Application
 from apps.fhir.bluebutton.models import ArchivedCrosswalk, Crosswalk
+from apps.fhir.server.match_cache import match_cache
 from apps.logging.utils import redirect_loggers, cleanup_logger, get_log_lines_list, get_log_content
 from apps.mymedicare_cb.authorization import OAuth2ConfigSLSx
 from apps.mymedicare_cb.models import AnonUserState
@@ -256,6 +258,60 @@ class MyMedicareSLSxBlueButtonClientApiUserInfoTest(BaseApiTest):
             # assert login
             self.assertNotIn("_auth_user_id", self.client.session)
 
+    @override_settings(FHIR_MATCH_REVALIDATE_INTERVAL=3600, FHIR_MATCH_CACHE_TTL=300)
+    def test_callback_returning_beneficiary_not_matched(self):
+        match_cache.clear()
+        self.addCleanup(match_cache.clear)
+        patient_searches = []
+
+        @urlmatch(
+            netloc="fhir.backend.bluebutton.hhsdevcloud.us", path="/v1/fhir/Patient/"
+        )
+        def fhir_patient_info_mock(url, request):
+            patient_searches.append(url)
+            return {
+                "status_code": status.HTTP_200_OK,
+                "content": patient_response,
+            }
+
+        @all_requests
+        def catchall(url, request):
+            raise Exception(url)
+
+        with HTTMock(
+            self.mock_response.slsx_token_mock,
+            self.mock_response.slsx_user_info_mock,
+            self.mock_response.slsx_health_ok_mock,
+            self.mock_response.slsx_signout_ok_mock,
+            fhir_patient_info_mock,
+            catchall,
+        ):
+            for _ in range(2):
+                state = generate_nonce()
+                AnonUserState.objects.create(
+                    state=state,
+                    next_uri="http://www.google.com?client_id=test&redirect_uri=test.com&response_type=token&state=test",
+                )
+                s = self.client.session
+                s.update(
+                    {
+                        "auth_uuid": "84b4afdc-d85d-4ea4-b44c-7bde77634429",
+                        "auth_app_id": "2",
+                        "auth_app_name": "TestApp-001",
+                        "auth_client_id": "uouIr1mnblrv3z0PJHgmeHiYQmGVgmk5DZPDNfop",
+                    }
+                )
+                s.save()
+                response = self.client.get(
+                    self.callback_url,
+                    data={"req_token": "0000-test_req_token-0000", "relay": state},
+                )
+                self.assertEqual(response.status_code, status.HTTP_302_FOUND)
+
+        # The returning beneficiary's crosswalk is trusted, no backend match
+        self.assertEqual(len(patient_searches), 1)
+        self.assertEqual(Crosswalk.objects.count(), 1)
+
     def test_callback_url_failure(self):
         # create a state
         state = generate_nonce()
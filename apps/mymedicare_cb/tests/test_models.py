@@ -1,11 +1,18 @@
+from datetime import timedelta
+from unittest.mock import patch
+
 from django.test import TestCase
+from django.test.utils import override_settings
 from django.core.exceptions import ValidationError
 from django.contrib.auth.models import Group
+from django.utils import timezone
 
+from apps.fhir.bluebutton.models import Crosswalk
+from apps.fhir.server.match_cache import match_cache
 from apps.mymedicare_cb.models import BBMyMedicareCallbackCrosswalkCreateException
 from apps.mymedicare_cb.authorization import OAuth2ConfigSLSx
 
-from ..models import create_beneficiary_record
+from ..models import create_beneficiary_record, get_and_update_user
 
 
 class BeneficiaryLoginTest(TestCase):
@@ -287,3 +294,62 @@ class BeneficiaryLoginTest(TestCase):
                 arg1 = case["args"][1]
                 slsx_client1 = OAuth2ConfigSLSx(arg1)
                 create_beneficiary_record(slsx_client1, arg1["fhir_id"])
+
+
+@override_settings(FHIR_MATCH_REVALIDATE_INTERVAL=3600, FHIR_MATCH_CACHE_TTL=300, FHIR_MATCH_CACHE_MAX_ENTRIES=10)
+class GetAndUpdateUserTest(TestCase):
+
+    def setUp(self):
+        Group.objects.create(name='BlueButton')
+        match_cache.clear()
+        self.addCleanup(match_cache.clear)
+        self.args = {
+            "username": "00112233-4455-6677-8899-aabbccddeeff",
+            "user_hicn_hash": "50ad63a61f6bdf977f9796985d8d286a3d10476e5f7d71f16b70b1b4fbdad76b",
+            "user_mbi_hash": "987654321f6bdf977f9796985d8d286a3d10476e5f7d71f16b70b1b4fbdad76b",
+            "first_name": "Hello",
+            "last_name": "World",
+            "email": "fu@bar.bar",
+        }
+
+    @patch('apps.mymedicare_cb.models.match_fhir_id', return_value=("-20000000002346", "M"))
+    def test_returning_beneficiary_fast_path(self, mock_match):
+        user, action = get_and_update_user(OAuth2ConfigSLSx(self.args))
+        self.assertEqual(action, "C")
+        self.assertIsNotNone(user.crosswalk.date_validated)
+        self.assertEqual(mock_match.call_count, 1)
+
+        user, action = get_and_update_user(OAuth2ConfigSLSx(self.args))
+        self.assertEqual(action, "R")
+        self.assertEqual(user.crosswalk.fhir_id, "-20000000002346")
+        # Trusted crosswalk, no backend match
+        self.assertEqual(mock_match.call_count, 1)
+
+        # Revalidated once the interval has passed, from the match cache
+        Crosswalk.objects.update(date_validated=timezone.now() - timedelta(hours=2))
+        get_and_update_user(OAuth2ConfigSLSx(self.args))
+        self.assertEqual(mock_match.call_count, 1)
+        self.assertEqual(match_cache.hits, 1)
+
+        match_cache.clear()
+        get_and_update_user(OAuth2ConfigSLSx(self.args))
+        self.assertEqual(mock_match.call_count, 2)
+        self.assertGreater(Crosswalk.objects.get().date_validated, timezone.now() - timedelta(minutes=1))
+
+    @patch('apps.mymedicare_cb.models.match_fhir_id', return_value=("-20000000002346", "M"))
+    def test_changed_hash_matched_via_backend(self, mock_match):
+        get_and_update_user(OAuth2ConfigSLSx(self.args))
+        match_cache.clear()
+
+        self.args["user_mbi_hash"] = "887654321f6bdf977f9796985d8d286a3d10476e5f7d71f16b70b1b4fbdad76b"
+        user, action = get_and_update_user(OAuth2ConfigSLSx(self.args))
+        self.assertEqual(action, "R")
+        self.assertEqual(mock_match.call_count, 2)
+        self.assertEqual(user.crosswalk.user_mbi_hash, self.args["user_mbi_hash"])
+
+    @override_settings(FHIR_MATCH_REVALIDATE_INTERVAL=0, FHIR_MATCH_CACHE_TTL=0)
+    @patch('apps.mymedicare_cb.models.match_fhir_id', return_value=("-20000000002346", "M"))
+    def test_always_revalidate(self, mock_match):
+        get_and_update_user(OAuth2ConfigSLSx(self.args))
+        get_and_update_user(OAuth2ConfigSLSx(self.args))
+        self.assertEqual(mock_match.call_count, 2)
@@ -0,0 +1,25 @@
+import os
+import newrelic.agent
+# import dotenv
+from dotenv import load_dotenv
+from django.core.asgi import get_asgi_application
+
+# project root folder
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DJANGO_CUSTOM_SETTINGS_DIR = os.path.join(BASE_DIR, '..')
+
+# If the New Relic config file is present, load and configure the agent
+if os.path.isfile(os.path.join(DJANGO_CUSTOM_SETTINGS_DIR, 'newrelic.ini')):
+    newrelic.agent.initialize(os.path.join(DJANGO_CUSTOM_SETTINGS_DIR, 'newrelic.ini'))
+
+# If the .env file is present, load it
+if os.path.isfile(os.path.join(DJANGO_CUSTOM_SETTINGS_DIR, '.env')):
+    load_dotenv(os.path.join(DJANGO_CUSTOM_SETTINGS_DIR, '.env'))
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "hhs_oauth_server.settings.base")
+
+# The async FHIR views (DJANGO_FHIR_ASYNC_VIEWS) need async capable middleware
+# to serve requests without a worker thread, see
+# apps.fhir.bluebutton.views.generic.AsyncFhirDataViewMixin
+
+application = get_asgi_application()
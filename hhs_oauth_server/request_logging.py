@@ -1,21 +1,28 @@
 import datetime
 import hashlib
 import json
+import threading
+import time
 import uuid
+from collections import OrderedDict
 
 import apps.logging.request_logger as logging
 
+from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
 from django.utils.deprecation import MiddlewareMixin
 from oauth2_provider.models import AccessToken, RefreshToken, get_application_model
 from rest_framework.response import Response
+from waffle import switch_is_active
 
 from apps.dot_ext.loggers import (
     SESSION_AUTH_FLOW_TRACE_KEYS,
     get_session_auth_flow_trace,
     is_path_part_of_auth_flow_trace,
 )
+from apps.logging.timing import PhaseTimer
 from apps.fhir.bluebutton.utils import (
+    get_auth_context,
     get_ip_from_request,
     get_user_from_request,
     get_access_token_from_request,
@@ -23,6 +30,35 @@ from apps.fhir.bluebutton.utils import (
 
 audit = logging.getLogger("audit.%s" % __name__)
 
+# Number of applications the log messages keep the id and name of
+APPLICATION_MEMO_MAX_ENTRIES = 1000
+
+_application_memo = OrderedDict()
+_application_memo_lock = threading.Lock()
+
+
+def get_application_summary(client_id):
+    """
+    Returns {"id", "name"} of the application with client_id, or None,
+    memoized across requests.
+    """
+    ttl = getattr(settings, "REQUEST_LOGGING_APPLICATION_MEMO_TTL", 0)
+    now = time.monotonic()
+    if ttl:
+        with _application_memo_lock:
+            entry = _application_memo.get(client_id)
+            if entry is not None and entry[0] > now:
+                _application_memo.move_to_end(client_id)
+                return entry[1]
+    application = get_application_model().objects.filter(client_id=client_id).values("id", "name").first()
+    if ttl:
+        with _application_memo_lock:
+            _application_memo[client_id] = (now + ttl, application)
+            _application_memo.move_to_end(client_id)
+            while len(_application_memo) > APPLICATION_MEMO_MAX_ENTRIES:
+                _application_memo.popitem(last=False)
+    return application
+
 
 class RequestResponseLog(object):
     """Audit log message to JSON string
@@ -133,6 +169,8 @@ class RequestResponseLog(object):
         self.log_msg["dev_name"] = ""
         self.log_msg["location"] = ""
         self.log_msg["size"] = 0
+        # Captured values the log message is enriched from, see enrich()
+        self._deferred = {}
 
     def _log_msg_update_from_dict(self, from_dict, key, dict_key):
         # Log message update from a passed in dictionary
@@ -189,9 +227,10 @@ class RequestResponseLog(object):
             self.log_msg["app_id"] = self.log_msg["auth_app_id"]
             self.log_msg["app_name"] = self.log_msg["auth_app_name"]
 
-    def to_dict(self):
+    def capture(self):
         """
-        --- Logging custom items ---
+        Takes the cheap facts of the request and response (ids, status, sizes,
+        timings and the objects to enrich them from) before the response is sent.
         """
         self.log_msg["start_time"] = self.request._logging_start_dt.timestamp()
         self.log_msg["end_time"] = datetime.datetime.utcnow().timestamp()
@@ -202,6 +241,14 @@ class RequestResponseLog(object):
         self.log_msg["ip_addr"] = get_ip_from_request(self.request)
         self.log_msg["request_uuid"] = str(self.request._logging_uuid)
 
+        """
+        --- Phases of the request, in milliseconds ---
+        """
+        timer = getattr(self.request, "_phase_timer", None)
+        if timer is not None:
+            for name, milliseconds in timer.milliseconds().items():
+                self.log_msg["timing_%s" % name] = milliseconds
+
         """
         --- Logging items from request.POST ---
         """
@@ -250,28 +297,10 @@ class RequestResponseLog(object):
                 self._log_msg_update_from_dict(
                     request_body_dict, "req_client_id", "client_id"
                 )
-
-                if self.log_msg.get("req_client_id", False):
-                    try:
-                        application = get_application_model().objects.get(
-                            client_id=self.log_msg.get("req_client_id")
-                        )
-                        self._log_msg_update_from_object(application, "req_app_name", "name")
-                        self._log_msg_update_from_object(application, "req_app_id", "id")
-                    except ObjectDoesNotExist:
-                        self.log_msg["req_app_name"] = ""
-                        self.log_msg["req_app_id"] = ""
-
-                refresh_token = request_body_dict.get("refresh_token", None)
-                if refresh_token is not None:
-                    self.log_msg["req_refresh_token_hash"] = hashlib.sha256(
-                        str(refresh_token).encode("utf-8")
-                    ).hexdigest()
-
-                # Log AC passed from RequestTimeLoggingMiddleware.process_request() pre-response
-                self._log_msg_update_from_object(
-                    self.request, "req_access_token_hash", "_req_access_token_hash"
-                )
+                self._deferred["req_client_id"] = self.log_msg.get("req_client_id")
+                self._deferred["refresh_token"] = request_body_dict.get("refresh_token", None)
+                # AC passed from RequestTimeLoggingMiddleware.process_request() pre-response
+                self._deferred["req_access_token"] = getattr(self.request, "_req_access_token", None)
 
                 self._log_msg_update_from_dict(
                     request_body_dict, "req_response_type", "response_type"
@@ -294,8 +323,6 @@ class RequestResponseLog(object):
                     "share_demographic_scopes",
                 )
                 self._log_msg_update_from_dict(request_body_dict, "req_allow", "allow")
-            except ObjectDoesNotExist:
-                pass
             except ValueError:
                 pass
 
@@ -307,10 +334,7 @@ class RequestResponseLog(object):
             self._log_msg_update_from_object(
                 self.request.user, "req_user_username", "username"
             )
-            if getattr(self.request.user, "crosswalk", False):
-                self._log_msg_update_from_object(
-                    self.request.user.crosswalk, "req_fhir_id", "fhir_id"
-                )
+            self._deferred["req_user"] = self.request.user
 
         """
         --- Logging items from request.session for Auth Flow Tracing ---
@@ -345,17 +369,7 @@ class RequestResponseLog(object):
 
             self._log_msg_update_from_querydict("req_qparam_startindex", "startIndex")
             self._log_msg_update_from_querydict("req_qparam_type", "type")
-
-            if self.log_msg.get("req_qparam_client_id", False):
-                try:
-                    application = get_application_model().objects.get(
-                        client_id=self.log_msg.get("req_qparam_client_id")
-                    )
-                    self._log_msg_update_from_object(application, "req_app_name", "name")
-                    self._log_msg_update_from_object(application, "req_app_id", "id")
-                except ObjectDoesNotExist:
-                    self.log_msg["req_app_name"] = ""
-                    self.log_msg["req_app_id"] = ""
+            self._deferred["req_qparam_client_id"] = self.log_msg.get("req_qparam_client_id")
 
         """
         --- Logging items from request ---
@@ -370,6 +384,89 @@ class RequestResponseLog(object):
         user = get_user_from_request(self.request)
         if user:
             self.log_msg["user"] = str(user)
+            self._deferred["user"] = user
+
+        """
+        --- Request access token, the one loaded by the authentication if any ---
+        """
+        auth_context = get_auth_context(self.request)
+        self._deferred["access_token"] = auth_context.access_token if auth_context else getattr(
+            self.request, "auth", get_access_token_from_request(self.request)
+        )
+
+        """
+        --- Logging items from response ---
+        """
+        self.log_msg["response_code"] = getattr(self.response, "status_code", 0)
+        if self.log_msg["response_code"] in (300, 301, 302, 307):
+            self.log_msg["location"] = self.response.get("Location", "?")
+        elif getattr(self.response, "content", False):
+            self.log_msg["size"] = len(self.response.content)
+
+        """
+        --- Logging items from a FHIR type response ---
+        """
+        if type(self.response) == Response and isinstance(self.response.data, dict):
+            self.log_msg["fhir_bundle_type"] = self.response.data.get("type", None)
+            self.log_msg["fhir_resource_id"] = self.response.data.get("id", None)
+            self.log_msg["fhir_resource_type"] = self.response.data.get(
+                "resourceType", None
+            )
+            self.log_msg["fhir_attribute_count"] = len(self.response.data)
+            if self.response.data.get("entry", False):
+                self.log_msg["fhir_entry_count"] = len(self.response.data.get("entry"))
+            else:
+                self.log_msg["fhir_entry_count"] = None
+            self.log_msg["fhir_total"] = self.response.data.get("total", None)
+
+        """
+        --- Response content of a refresh_token grant, parsed when enriched ---
+        """
+        if (
+            self.log_msg.get("req_post_grant_type", False) == "refresh_token"
+            and self.log_msg.get("request_method", False) == "POST"
+            and getattr(self.response, "content", False)
+        ):
+            self._deferred["refresh_response_content"] = self.response.content
+
+    def _log_msg_update_from_application(self, client_id):
+        application = get_application_summary(client_id)
+        if application is None:
+            self.log_msg["req_app_name"] = ""
+            self.log_msg["req_app_id"] = ""
+        else:
+            self._log_msg_update_from_dict(application, "req_app_name", "name")
+            self._log_msg_update_from_dict(application, "req_app_id", "id")
+
+    def enrich(self):
+        """
+        Adds the items needing a query or a hash to the captured ones,
+        once the response is sent, and returns the log message.
+        """
+        if self._deferred.get("req_client_id"):
+            self._log_msg_update_from_application(self._deferred["req_client_id"])
+
+        refresh_token = self._deferred.get("refresh_token")
+        if refresh_token is not None:
+            self.log_msg["req_refresh_token_hash"] = hashlib.sha256(
+                str(refresh_token).encode("utf-8")
+            ).hexdigest()
+
+        req_access_token = self._deferred.get("req_access_token")
+        if req_access_token is not None:
+            self.log_msg["req_access_token_hash"] = hashlib.sha256(
+                str(req_access_token).encode("utf-8")
+            ).hexdigest()
+
+        req_user = self._deferred.get("req_user")
+        if req_user is not None and getattr(req_user, "crosswalk", False):
+            self._log_msg_update_from_object(req_user.crosswalk, "req_fhir_id", "fhir_id")
+
+        if self._deferred.get("req_qparam_client_id"):
+            self._log_msg_update_from_application(self._deferred["req_qparam_client_id"])
+
+        user = self._deferred.get("user")
+        if user:
             try:
                 self.log_msg["fhir_id"] = str(user.crosswalk.fhir_id)
             except ObjectDoesNotExist:
@@ -378,16 +475,18 @@ class RequestResponseLog(object):
         """
         --- Logging items from request access token ---
         """
-        access_token = getattr(
-            self.request, "auth", get_access_token_from_request(self.request)
-        )
-
+        access_token = self._deferred.get("access_token")
         if access_token:
             try:
-                at = AccessToken.objects.get(token=access_token)
+                if isinstance(access_token, AccessToken):
+                    at = access_token
+                else:
+                    at = AccessToken.objects.select_related(
+                        "application__user", "user"
+                    ).get(token=access_token)
 
                 self.log_msg["access_token_hash"] = hashlib.sha256(
-                    str(access_token).encode("utf-8")
+                    str(at.token).encode("utf-8")
                 ).hexdigest()
                 self.log_msg["access_token_scopes"] = " ".join([s for s in at.scopes])
                 self._log_msg_update_from_object(
@@ -412,104 +511,76 @@ class RequestResponseLog(object):
                 pass
 
         """
-        --- Logging items from response ---
+        --- Logging items from response content (refresh_token)
         """
-        self.log_msg["response_code"] = getattr(self.response, "status_code", 0)
-        if self.log_msg["response_code"] in (300, 301, 302, 307):
-            self.log_msg["location"] = self.response.get("Location", "?")
-        elif getattr(self.response, "content", False):
-            self.log_msg["size"] = len(self.response.content)
+        if self._deferred.get("refresh_response_content"):
+            try:
+                response_content = json.loads(self._deferred["refresh_response_content"])
+            except json.decoder.JSONDecodeError:
+                response_content = {}  # Set to empty DICT
 
-        """
-        --- Logging items from a FHIR type response ---
-        """
-        if type(self.response) == Response and isinstance(self.response.data, dict):
-            self.log_msg["fhir_bundle_type"] = self.response.data.get("type", None)
-            self.log_msg["fhir_resource_id"] = self.response.data.get("id", None)
-            self.log_msg["fhir_resource_type"] = self.response.data.get(
-                "resourceType", None
+            self._log_msg_update_from_dict(
+                response_content, "resp_fhir_id", "patient"
             )
-            self.log_msg["fhir_attribute_count"] = len(self.response.data)
-            if self.response.data.get("entry", False):
-                self.log_msg["fhir_entry_count"] = len(self.response.data.get("entry"))
-            else:
-                self.log_msg["fhir_entry_count"] = None
-            self.log_msg["fhir_total"] = self.response.data.get("total", None)
+            self._log_msg_update_from_dict(
+                response_content, "resp_expires_in", "expires_in"
+            )
+            self._log_msg_update_from_dict(
+                response_content, "resp_token_type", "token_type"
+            )
+            self._log_msg_update_from_dict(response_content, "resp_scope", "scope")
 
-        """
-        --- Logging items from response content (refresh_token)
-        """
-        if (
-            getattr(self.response, "content", False)
-            and self.log_msg.get("req_post_grant_type", False)
-            and self.log_msg.get("request_method", False)
-        ):
+            self.log_msg["resp_refresh_token_hash"] = hashlib.sha256(
+                str(response_content.get("refresh_token", None)).encode("utf-8")
+            ).hexdigest()
 
-            if (
-                self.log_msg["req_post_grant_type"] == "refresh_token"
-                and self.log_msg["request_method"] == "POST"
-            ):
+            resp_access_token = response_content.get("access_token", None)
+
+            if resp_access_token:
                 try:
-                    response_content = json.loads(self.response.content)
-                except json.decoder.JSONDecodeError:
-                    response_content = {}  # Set to empty DICT
+                    at = AccessToken.objects.select_related(
+                        "application__user", "user"
+                    ).get(token=resp_access_token)
 
-                self._log_msg_update_from_dict(
-                    response_content, "resp_fhir_id", "patient"
-                )
-                self._log_msg_update_from_dict(
-                    response_content, "resp_expires_in", "expires_in"
-                )
-                self._log_msg_update_from_dict(
-                    response_content, "resp_token_type", "token_type"
-                )
-                self._log_msg_update_from_dict(response_content, "resp_scope", "scope")
+                    self.log_msg["resp_access_token_hash"] = hashlib.sha256(
+                        str(at).encode("utf-8")
+                    ).hexdigest()
 
-                self.log_msg["resp_refresh_token_hash"] = hashlib.sha256(
-                    str(response_content.get("refresh_token", None)).encode("utf-8")
-                ).hexdigest()
+                    self.log_msg["resp_access_token_scopes"] = " ".join(
+                        [s for s in at.scopes]
+                    )
 
-                resp_access_token = response_content.get("access_token", None)
-
-                if resp_access_token:
-                    try:
-                        at = AccessToken.objects.get(token=resp_access_token)
-
-                        self.log_msg["resp_access_token_hash"] = hashlib.sha256(
-                            str(at).encode("utf-8")
-                        ).hexdigest()
-
-                        self.log_msg["resp_access_token_scopes"] = " ".join(
-                            [s for s in at.scopes]
-                        )
-
-                        self._log_msg_update_from_object(
-                            at.application, "resp_app_id", "id"
-                        )
-                        self._log_msg_update_from_object(
-                            at.application, "resp_app_name", "name"
-                        )
-                        self._log_msg_update_from_object(
-                            at.application,
-                            "resp_app_require_demographic_scopes",
-                            "require_demographic_scopes",
-                        )
-                        self._log_msg_update_from_object(
-                            at.application.user, "resp_dev_id", "id"
-                        )
-                        self._log_msg_update_from_object(
-                            at.application.user, "resp_dev_name", "username"
-                        )
-
-                        self._log_msg_update_from_object(at.user, "resp_user_id", "id")
-                        self._log_msg_update_from_object(
-                            at.user, "resp_user_username", "username"
-                        )
-                    except ObjectDoesNotExist:
-                        pass
+                    self._log_msg_update_from_object(
+                        at.application, "resp_app_id", "id"
+                    )
+                    self._log_msg_update_from_object(
+                        at.application, "resp_app_name", "name"
+                    )
+                    self._log_msg_update_from_object(
+                        at.application,
+                        "resp_app_require_demographic_scopes",
+                        "require_demographic_scopes",
+                    )
+                    self._log_msg_update_from_object(
+                        at.application.user, "resp_dev_id", "id"
+                    )
+                    self._log_msg_update_from_object(
+                        at.application.user, "resp_dev_name", "username"
+                    )
+
+                    self._log_msg_update_from_object(at.user, "resp_user_id", "id")
+                    self._log_msg_update_from_object(
+                        at.user, "resp_user_username", "username"
+                    )
+                except ObjectDoesNotExist:
+                    pass
         self._sync_app_name()
         return self.log_msg
 
+    def to_dict(self):
+        self.capture()
+        return self.enrich()
+
 ##############################################################################
 #
 # Request time logging middleware
@@ -518,6 +589,20 @@ class RequestResponseLog(object):
 ##############################################################################
 
 
+def log_enriched(log):
+    """
+    Logs the enriched message of log, or what was captured with the error
+    when the enrichment fails: the response closers it runs from swallow
+    exceptions, the record would be lost.
+    """
+    try:
+        log_msg = log.enrich()
+    except Exception as e:
+        log_msg = dict(log.log_msg)
+        log_msg["enrich_error"] = "%s: %s" % (type(e).__name__, e)
+    audit.info(log_msg)
+
+
 class RequestTimeLoggingMiddleware(MiddlewareMixin):
     """Middleware class logging request time to stderr.
 
@@ -533,8 +618,14 @@ class RequestTimeLoggingMiddleware(MiddlewareMixin):
 
     @staticmethod
     def log_message(request, response):
-        audit.info(RequestResponseLog(request, response).to_dict())
+        log = RequestResponseLog(request, response)
+        log.capture()
         request._logging_pass += 1
+        if getattr(settings, "REQUEST_LOGGING_DEFERRED", False) and hasattr(response, "_resource_closers"):
+            # Enriched and logged once the response is sent, when it is closed
+            response._resource_closers.append(lambda: log_enriched(log))
+        else:
+            log_enriched(log)
 
     def process_request(self, request):
         """
@@ -544,6 +635,8 @@ class RequestTimeLoggingMiddleware(MiddlewareMixin):
         request._logging_start_dt = datetime.datetime.utcnow()
         request._logging_pass = 1
         request._logger = audit
+        request._phase_timer = PhaseTimer()
+        request._server_timing = switch_is_active("server_timing")
 
         # Get access token to be refreshed pre-response, since it is removed
         if getattr(request, "body", False):
@@ -555,16 +648,14 @@ class RequestTimeLoggingMiddleware(MiddlewareMixin):
 
                 refresh_token = request_body_dict.get("refresh_token", None)
                 if refresh_token is not None:
-                    rt = RefreshToken.objects.get(token=refresh_token)
-                    if rt:
-                        request._req_access_token_hash = hashlib.sha256(
-                            str(rt.access_token).encode("utf-8")
-                        ).hexdigest()
+                    request._req_access_token = RefreshToken.objects.filter(
+                        token=refresh_token
+                    ).values_list("access_token__token", flat=True).first()
             except ValueError:
                 pass
-            except ObjectDoesNotExist:
-                pass
 
     def process_response(self, request, response):
+        if getattr(request, "_server_timing", False):
+            response["Server-Timing"] = request._phase_timer.server_timing()
         self.log_message(request, response)
         return response
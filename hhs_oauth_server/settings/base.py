@@ -202,6 +202,7 @@ if env("ENV_SPECIFIC_APPS", False):
 REST_FRAMEWORK = {
     "DEFAULT_THROTTLE_RATES": {
         "token": env("TOKEN_THROTTLE_RATE", "100000/s"),
+        "application": env("APPLICATION_THROTTLE_RATE", None),
     },
 }
 
@@ -225,6 +226,8 @@ if env("OPTIONAL_INSTALLED_APPS", False):
 
 
 MIDDLEWARE = [
+    # Request counts, latency and database queries, first to time the others
+    "apps.metrics.middleware.MetricsMiddleware",
     # Middleware that adds headers to the resposne
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
@@ -271,6 +274,10 @@ TEMPLATES = [
 
 WSGI_APPLICATION = "hhs_oauth_server.wsgi.application"
 
+# Rate limits are counted across the workers in the database by default,
+# this opts in to an in-process "throttle" cache counting them per worker
+THROTTLE_CACHE_PER_PROCESS = bool_env(env("DJANGO_THROTTLE_CACHE_PER_PROCESS", False))
+
 CACHES = {
     "default": {
         "BACKEND": os.environ.get(
@@ -278,7 +285,25 @@ CACHES = {
         ),
         "LOCATION": os.environ.get("CACHE_LOCATION", "django_cache"),
     },
+    # Rate limit counters, see apps/dot_ext/throttling.py
+    "throttle": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache" if THROTTLE_CACHE_PER_PROCESS
+        else os.environ.get("THROTTLE_CACHE_BACKEND", "apps.core.cache.AtomicDatabaseCache"),
+        "LOCATION": os.environ.get("THROTTLE_CACHE_LOCATION", "django_throttle_cache"),
+        "OPTIONS": {"MAX_ENTRIES": int(os.environ.get("THROTTLE_CACHE_MAX_ENTRIES", 100000))},
+    },
+    # Read-mostly lookups kept in process in front of "default", see apps/core/cache.py
+    "tiered": {
+        "BACKEND": "apps.core.cache.TieredCache",
+        "LOCATION": "default",
+        "OPTIONS": {
+            "MAX_ENTRIES": int(os.environ.get("TIERED_CACHE_MAX_ENTRIES", 10000)),
+            "LOCAL_TIMEOUT": int(os.environ.get("TIERED_CACHE_LOCAL_TIMEOUT", 60)),
+            "VERSION_CHECK_INTERVAL": int(os.environ.get("TIERED_CACHE_VERSION_CHECK_INTERVAL", 2)),
+        },
+    },
 }
+THROTTLE_CACHE_ALIAS = "throttle"
 
 # keep backward compatible with AutoField instead of BigAutoField
 DEFAULT_AUTO_FIELD = 'django.db.models.AutoField'
@@ -322,6 +347,7 @@ STATICFILES_DIRS = [
 
 # Waffle
 WAFFLE_FLAG_MODEL = "core.Flag"
+WAFFLE_CACHE_NAME = "tiered"
 
 # emails
 DEFAULT_FROM_EMAIL = env("DJANGO_FROM_EMAIL", "change-me@example.com")
@@ -561,7 +587,120 @@ FHIR_SERVER = {
         FHIR_CLIENT_CERTSTORE, env("FHIR_KEY_FILE", "ca.key.nocrypt.pem")
     ),
     "CLIENT_AUTH": True,
+    "POOL_CONNECTIONS": int(env("FHIR_POOL_CONNECTIONS", "10")),
+    "POOL_MAXSIZE": int(env("FHIR_POOL_MAXSIZE", "10")),
+    "POOL_IDLE_TIMEOUT": int(env("FHIR_POOL_IDLE_TIMEOUT", "60")),
+    "FORWARD_CONDITIONAL_HEADERS": bool_env(env("FHIR_FORWARD_CONDITIONAL_HEADERS", False)),
+    "SINGLE_FLIGHT": bool_env(env("FHIR_SINGLE_FLIGHT", True)),
+    "SINGLE_FLIGHT_SHARED": bool_env(env("FHIR_SINGLE_FLIGHT_SHARED", False)),
+    "SINGLE_FLIGHT_SHARED_TTL": int(env("FHIR_SINGLE_FLIGHT_SHARED_TTL", 5)),
+    "CIRCUIT_BREAKER": bool_env(env("FHIR_CIRCUIT_BREAKER", True)),
+    "CIRCUIT_BREAKER_WINDOW": int(env("FHIR_CIRCUIT_BREAKER_WINDOW", 60)),
+    "CIRCUIT_BREAKER_MIN_CALLS": int(env("FHIR_CIRCUIT_BREAKER_MIN_CALLS", 20)),
+    "CIRCUIT_BREAKER_ERROR_RATE": float(env("FHIR_CIRCUIT_BREAKER_ERROR_RATE", 0.5)),
+    "CIRCUIT_BREAKER_OPEN_TIME": int(env("FHIR_CIRCUIT_BREAKER_OPEN_TIME", 30)),
+    "CIRCUIT_BREAKER_HALF_OPEN_PROBES": int(env("FHIR_CIRCUIT_BREAKER_HALF_OPEN_PROBES", 1)),
+    "ADAPTIVE_TIMEOUT": bool_env(env("FHIR_ADAPTIVE_TIMEOUT", True)),
+    "ADAPTIVE_TIMEOUT_SAMPLES": int(env("FHIR_ADAPTIVE_TIMEOUT_SAMPLES", 200)),
+    "ADAPTIVE_TIMEOUT_MULTIPLIER": float(env("FHIR_ADAPTIVE_TIMEOUT_MULTIPLIER", 2)),
+    "ADAPTIVE_TIMEOUT_MIN": float(env("FHIR_ADAPTIVE_TIMEOUT_MIN", 5)),
+    "RETRY_MAX_ATTEMPTS": int(env("FHIR_RETRY_MAX_ATTEMPTS", 3)),
+    "RETRY_BUDGET_RATIO": float(env("FHIR_RETRY_BUDGET_RATIO", 0.1)),
+    "RETRY_BUDGET_MAX_TOKENS": int(env("FHIR_RETRY_BUDGET_MAX_TOKENS", 10)),
+    "RETRY_BACKOFF_BASE": float(env("FHIR_RETRY_BACKOFF_BASE", 0.05)),
+    "RETRY_BACKOFF_MAX": float(env("FHIR_RETRY_BACKOFF_MAX", 1)),
+    "HEDGE": bool_env(env("FHIR_HEDGE", False)),
+    "HEDGE_PERCENTILE": float(env("FHIR_HEDGE_PERCENTILE", 0.95)),
+    "HEDGE_MAX_WORKERS": int(env("FHIR_HEDGE_MAX_WORKERS", 20)),
+}
+
+# Serve the FHIR read/search views as async views (requires running under ASGI,
+# see hhs_oauth_server/asgi.py). Off by default: each sync only middleware in
+# MIDDLEWARE (e.g. AxesMiddleware) still takes a thread per request.
+FHIR_ASYNC_VIEWS = bool_env(env("DJANGO_FHIR_ASYNC_VIEWS", False))
+
+# Opt-in per-beneficiary cache of FHIR responses, see apps/fhir/bluebutton/cache.py
+FHIR_RESPONSE_CACHE_ENABLED = bool_env(env("DJANGO_FHIR_RESPONSE_CACHE_ENABLED", False))
+FHIR_RESPONSE_CACHE_MAX_BYTES = int(env("DJANGO_FHIR_RESPONSE_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+FHIR_RESPONSE_CACHE_TTLS = {
+    "Patient": int(env("DJANGO_FHIR_RESPONSE_CACHE_TTL_PATIENT", 300)),
+    "Coverage": int(env("DJANGO_FHIR_RESPONSE_CACHE_TTL_COVERAGE", 300)),
 }
+# Cache shared by the workers holding the beneficiary version stamps of the
+# response cache keys, bumped on revocation
+FHIR_RESPONSE_CACHE_STAMP_ALIAS = env("DJANGO_FHIR_RESPONSE_CACHE_STAMP_ALIAS", "tiered")
+
+# Seconds between background refreshes of the cached backend CapabilityStatement
+# served at /metadata, 0 calls the backend on every hit
+FHIR_CONFORMANCE_REFRESH_INTERVAL = int(env("DJANGO_FHIR_CONFORMANCE_REFRESH_INTERVAL", 300))
+
+# Concurrent backend page requests of an ExplanationOfBenefit search with _pages=all
+FHIR_ALL_PAGES_CONCURRENCY = int(env("DJANGO_FHIR_ALL_PAGES_CONCURRENCY", 4))
+
+# FHIR Bulk Data $export, see apps/fhir/bluebutton/export.py
+FHIR_EXPORT_STORAGE_DIR = env("DJANGO_FHIR_EXPORT_STORAGE_DIR", os.path.join(BASE_DIR, "exports"))
+FHIR_EXPORT_STALE_AFTER = int(env("DJANGO_FHIR_EXPORT_STALE_AFTER", 300))
+FHIR_EXPORT_MAX_ATTEMPTS = int(env("DJANGO_FHIR_EXPORT_MAX_ATTEMPTS", 3))
+FHIR_EXPORT_POLL_INTERVAL = int(env("DJANGO_FHIR_EXPORT_POLL_INTERVAL", 5))
+# Seconds the finished jobs and their files are kept
+FHIR_EXPORT_RETENTION = int(env("DJANGO_FHIR_EXPORT_RETENTION", 24 * 60 * 60))
+
+# Login flow: seconds a crosswalk whose hashes match the SLSx user info is trusted
+# before matching it against the backend again (0 always matches), and the
+# cache of recent hash to fhir_id matches, see apps/fhir/server/match_cache.py
+FHIR_MATCH_REVALIDATE_INTERVAL = int(env("DJANGO_FHIR_MATCH_REVALIDATE_INTERVAL", 24 * 60 * 60))
+FHIR_MATCH_CACHE_TTL = int(env("DJANGO_FHIR_MATCH_CACHE_TTL", 300))
+FHIR_MATCH_CACHE_MAX_ENTRIES = int(env("DJANGO_FHIR_MATCH_CACHE_MAX_ENTRIES", 10000))
+# Search the HICN hash concurrently with the MBI hash in match_fhir_id(),
+# one backend round trip on an MBI miss for one extra search on an MBI hit
+FHIR_MATCH_CONCURRENT_LOOKUPS = bool_env(env("DJANGO_FHIR_MATCH_CONCURRENT_LOOKUPS", False))
+
+# Seconds the Application first_active/last_active activity fields are buffered
+# before a bulk update (0 updates on every call), and whether the workers buffer
+# them in the cache for the flush_application_activity command instead,
+# see apps/dot_ext/activity.py
+APPLICATION_ACTIVITY_FLUSH_INTERVAL = int(env("DJANGO_APPLICATION_ACTIVITY_FLUSH_INTERVAL", 60))
+APPLICATION_ACTIVITY_SHARED = bool_env(env("DJANGO_APPLICATION_ACTIVITY_SHARED", False))
+
+# Seconds a validated bearer token is cached (bounded by its expires, 0 disables)
+# and the cache holding them, see apps/dot_ext/token_cache.py
+ACCESS_TOKEN_CACHE_TTL = int(env("DJANGO_ACCESS_TOKEN_CACHE_TTL", 300))
+ACCESS_TOKEN_CACHE_ALIAS = env("DJANGO_ACCESS_TOKEN_CACHE_ALIAS", "tiered")
+
+# Keep the compiled scope to route table of TokenHasProtectedCapability in
+# process, and the seconds between checks of its version stamp in the cache,
+# see apps/capabilities/scope_routes.py
+SCOPE_ROUTE_TABLE = bool_env(env("DJANGO_SCOPE_ROUTE_TABLE", True))
+SCOPE_ROUTE_TABLE_CHECK_INTERVAL = int(env("DJANGO_SCOPE_ROUTE_TABLE_CHECK_INTERVAL", 5))
+
+# Seconds a beneficiary/application DataAccessGrant lookup is cached (0 disables)
+# and the cache holding them, see apps/authorization/grant_cache.py
+DATA_ACCESS_GRANT_CACHE_TTL = int(env("DJANGO_DATA_ACCESS_GRANT_CACHE_TTL", 300))
+DATA_ACCESS_GRANT_CACHE_ALIAS = env("DJANGO_DATA_ACCESS_GRANT_CACHE_ALIAS", "tiered")
+
+# Enrich the request_response_middleware log (queries, hashes) once the response
+# is sent, and the seconds an application id/name is kept for it (0 disables),
+# see hhs_oauth_server/request_logging.py
+REQUEST_LOGGING_DEFERRED = bool_env(env("DJANGO_REQUEST_LOGGING_DEFERRED", True))
+REQUEST_LOGGING_APPLICATION_MEMO_TTL = int(env("DJANGO_REQUEST_LOGGING_APPLICATION_MEMO_TTL", 300))
+
+# Encode the FHIR responses and audit log records with orjson when it is
+# installed, see apps/core/json_encoding.py
+FAST_JSON_ENCODER = bool_env(env("DJANGO_FAST_JSON_ENCODER", True))
+
+# Audit log records are written by a background thread through a bounded queue
+# (0 writes them on the request thread), what to do when the queue is full:
+# "block", "drop" or "spill" to a file, see apps/logging/audit_queue.py
+AUDIT_LOG_QUEUE_SIZE = int(env("DJANGO_AUDIT_LOG_QUEUE_SIZE", 10000))
+AUDIT_LOG_QUEUE_BATCH_SIZE = int(env("DJANGO_AUDIT_LOG_QUEUE_BATCH_SIZE", 100))
+AUDIT_LOG_QUEUE_OVERFLOW = env("DJANGO_AUDIT_LOG_QUEUE_OVERFLOW", "block")
+AUDIT_LOG_QUEUE_SPILL_DIR = env("DJANGO_AUDIT_LOG_QUEUE_SPILL_DIR", "/tmp/bb2_audit_spill")
+AUDIT_LOG_QUEUE_SHUTDOWN_TIMEOUT = int(env("DJANGO_AUDIT_LOG_QUEUE_SHUTDOWN_TIMEOUT", 10))
+
+# Directory of the memory mapped metrics files of the worker processes, to be
+# emptied when the server starts. Unset, a scrape only reports the worker
+# serving it, see apps/metrics/registry.py
+METRICS_MULTIPROCESS_DIR = env("DJANGO_METRICS_MULTIPROCESS_DIR", "")
 
 """
     FHIR URL search query parameters for backend /Patient resource
@@ -10,6 +10,20 @@ LOGIN_RATE = '100/m'
 
 REQUEST_CALL_TIMEOUT = (5, 120)
 
+# No background refresh threads in tests
+FHIR_CONFORMANCE_REFRESH_INTERVAL = 0
+
+# Match every login against the (mocked) backend, the login and audit log
+# tests count the matches. Turned on by the tests of the returning beneficiary
+# fast path (apps.mymedicare_cb.tests)
+FHIR_MATCH_REVALIDATE_INTERVAL = 0
+FHIR_MATCH_CACHE_TTL = 0
+
+# Application activity is written on every call, the API tests read it back.
+# Turned on by the write-behind tests (apps.dot_ext.tests.test_activity,
+# apps.fhir.bluebutton.tests.test_read_and_search)
+APPLICATION_ACTIVITY_FLUSH_INTERVAL = 0
+
 OFFLINE = True
 
 # Should be set to True in production and False in all other dev and test environments
@@ -34,8 +48,19 @@ CACHES = {
     'axes_cache': {
         'BACKEND': 'django.core.cache.backends.dummy.DummyCache',
     },
+    'throttle': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'throttle',
+    },
+    # Checks the version stamps on every read, cache.clear() reaches the local tier
+    'tiered': {
+        'BACKEND': 'apps.core.cache.TieredCache',
+        'LOCATION': 'default',
+        'OPTIONS': {'VERSION_CHECK_INTERVAL': 0},
+    },
 }
 AXES_CACHE = 'axes_cache'
+THROTTLE_CACHE_PER_PROCESS = True
 
 AUTH_PASSWORD_VALIDATORS = [
     {